@@ -0,0 +1,34 @@
+"""add indexes for the journalsservice change feed
+
+Revision ID: b2d4f6a8c0e1
+Revises: f3b8d2a6c1e7
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b2d4f6a8c0e1'
+down_revision = 'f3b8d2a6c1e7'
+branch_labels = None
+depends_on = None
+
+# /changes finds updated and deleted rows in the _hist tables by editid,
+# and created rows in the live tables by their created time
+CHANGE_TABLES = ['master', 'names', 'abbrevs', 'idents', 'publisher',
+                 'titlehistory', 'raster']
+
+
+def upgrade():
+
+    for table in CHANGE_TABLES:
+        op.create_index('ix_%s_hist_editid' % table, '%s_hist' % table,
+                        ['editid'])
+        op.create_index('ix_%s_created' % table, table, ['created'])
+
+def downgrade():
+
+    for table in CHANGE_TABLES:
+        op.drop_index('ix_%s_created' % table, table)
+        op.drop_index('ix_%s_hist_editid' % table, '%s_hist' % table)
@@ -0,0 +1,62 @@
+"""move per-volume completeness details from master to their own table
+
+Revision ID: c41f2e8a9b10
+Revises: 883ea1acd79f
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+from adsputils import UTCDateTime, get_date
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'c41f2e8a9b10'
+down_revision = '883ea1acd79f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+
+    op.create_table('completeness',
+                    sa.Column('complid', sa.Integer(), autoincrement=True,
+                              nullable=False),
+                    sa.Column('masterid', sa.Integer(), nullable=False),
+                    sa.Column('volume', sa.String(), nullable=True),
+                    sa.Column('volume_number', sa.Integer(), nullable=True),
+                    sa.Column('details', sa.Text(), nullable=True),
+                    sa.Column('created', UTCDateTime, nullable=True,
+                              default=get_date),
+                    sa.ForeignKeyConstraint(['masterid'],
+                                            ['master.masterid']),
+                    sa.PrimaryKeyConstraint('complid'),
+                    sa.UniqueConstraint('complid'))
+
+    op.create_index('ix_completeness_masterid_volume_number', 'completeness',
+                    ['masterid', 'volume_number'])
+
+    # one row per element of master.completeness_details
+    op.execute("INSERT INTO completeness (masterid, volume, volume_number, details, created) "
+               "SELECT m.masterid, e.value->>'volume', "
+               "CASE WHEN e.value->>'volume' ~ '^[0-9]{1,9}$' THEN (e.value->>'volume')::integer END, "
+               "e.value::text, now() "
+               "FROM master m, jsonb_array_elements(m.completeness_details::jsonb->'completeness_by_volume') e "
+               "WHERE m.completeness_details IS NOT NULL")
+
+    with op.batch_alter_table('master') as batch_op:
+        batch_op.drop_column(column_name='completeness_details')
+
+def downgrade():
+
+    with op.batch_alter_table('master') as batch_op:
+        batch_op.add_column(sa.Column('completeness_details', sa.Text()))
+
+    op.execute("UPDATE master SET completeness_details = c.details "
+               "FROM (SELECT masterid, json_build_object('completeness_by_volume', "
+               "json_agg(details::json ORDER BY complid))::text AS details "
+               "FROM completeness GROUP BY masterid) c "
+               "WHERE master.masterid = c.masterid")
+
+    op.drop_index('ix_completeness_masterid_volume_number', 'completeness')
+    op.drop_table('completeness')
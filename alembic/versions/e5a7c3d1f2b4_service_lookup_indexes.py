@@ -0,0 +1,55 @@
+"""add indexes for the journalsservice lookup paths
+
+Revision ID: e5a7c3d1f2b4
+Revises: c41f2e8a9b10
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+from adsputils import UTCDateTime, get_date
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'e5a7c3d1f2b4'
+down_revision = 'c41f2e8a9b10'
+branch_labels = None
+depends_on = None
+
+# masterid is the second column of the composite primary keys of these
+# tables, so filter_by(masterid=...) can't use the primary key index.
+# (refsource.masterid is its whole primary key and needs nothing.)
+MASTERID_INDEXES = ['abbrevs', 'idents', 'names', 'titlehistory']
+
+# columns searched with ILIKE '%...%' by the journal endpoint
+TRIGRAM_INDEXES = [('abbrevs', 'abbreviation'),
+                   ('names', 'name_english_translated'),
+                   ('names', 'name_native_language'),
+                   ('names', 'name_normalized'),
+                   ('master', 'journal_name'),
+                   ('master', 'bibstem')]
+
+
+def upgrade():
+
+    for table in MASTERID_INDEXES:
+        op.create_index('ix_%s_masterid' % table, table, ['masterid'])
+
+    op.create_index('ix_idents_id_value_id_type', 'idents',
+                    ['id_value', 'id_type'])
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for (table, column) in TRIGRAM_INDEXES:
+        op.create_index('ix_%s_%s_trgm' % (table, column), table, [column],
+                        postgresql_using='gin',
+                        postgresql_ops={column: 'gin_trgm_ops'})
+
+def downgrade():
+
+    for (table, column) in TRIGRAM_INDEXES:
+        op.drop_index('ix_%s_%s_trgm' % (table, column), table)
+
+    op.drop_index('ix_idents_id_value_id_type', 'idents')
+
+    for table in MASTERID_INDEXES:
+        op.drop_index('ix_%s_masterid' % table, table)
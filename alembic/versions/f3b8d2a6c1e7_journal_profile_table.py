@@ -0,0 +1,38 @@
+"""precomputed summary and browse responses per journal
+
+Revision ID: f3b8d2a6c1e7
+Revises: e5a7c3d1f2b4
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+from adsputils import UTCDateTime, get_date
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f3b8d2a6c1e7'
+down_revision = 'e5a7c3d1f2b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+
+    # filled by the manager (run.py -rp); the service falls back to live
+    # queries for journals without a profile row
+    op.create_table('profile',
+                    sa.Column('masterid', sa.Integer(), nullable=False),
+                    sa.Column('bibstem', sa.String(), nullable=False),
+                    sa.Column('summary', sa.Text(), nullable=True),
+                    sa.Column('browse', sa.Text(), nullable=True),
+                    sa.Column('updated', UTCDateTime, nullable=True,
+                              default=get_date, onupdate=get_date),
+                    sa.ForeignKeyConstraint(['masterid'],
+                                            ['master.masterid']),
+                    sa.PrimaryKeyConstraint('masterid'),
+                    sa.UniqueConstraint('bibstem'))
+
+
+def downgrade():
+
+    op.drop_table('profile')
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+    asgi
+    ~~~~
+    entrypoint asgi script (e.g. uvicorn asgi:application)
+"""
+
+import uvicorn
+from journalsservice import asgi
+
+application = asgi.create_asgi_app()
+
+if __name__ == "__main__":
+    uvicorn.run(application, host='0.0.0.0', port=4000)
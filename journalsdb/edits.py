@@ -0,0 +1,181 @@
+'''
+Set-based writes the manager makes to the journals database: archiving
+and deleting journals, reverting edits and loading completeness data.
+
+Each function takes an open connection (or session) and commits nothing,
+so the caller decides the transaction boundary.
+'''
+import json
+
+from sqlalchemy import and_, bindparam, cast, delete, exists, func, insert, literal, select, update
+from journalsdb.models import Base
+
+TABLES = Base.metadata.tables
+
+# editcontrol.editfileid values of the edits recorded by command line
+# deletions and reverts
+DELETION_EDITFILEIDS = ['Command line deletion', 'Command line bulk deletion']
+REVERT_EDITFILEID = 'Command line revert'
+
+TABLE_UNIQID = {'master': 'masterid',
+                'names': 'nameid',
+                'abbrevs': 'abbrevid',
+                'idents': 'identid',
+                'publisher': 'publisherid',
+                'titlehistory': 'titlehistoryid',
+                'raster': 'rasterid',
+                'rastervol': 'rvolid'}
+
+
+def archive_and_delete(conn, masterids, editid):
+    # Copies every row belonging to masterids into the matching _hist
+    # table under editid and then deletes them, as one INSERT ... SELECT
+    # and one DELETE per table.  Returns the rows deleted per table.
+    counts = {}
+
+    # rastervolume rows hang off raster rather than master, and like
+    # refsource, completeness and profile they have no _hist table (all
+    # are reloadable or rebuilt)
+    raster = TABLES['raster']
+    rastervol = TABLES['rastervolume']
+    rasterids = select([raster.c.rasterid]).where(raster.c.masterid.in_(masterids))
+    result = conn.execute(delete(rastervol).where(rastervol.c.rasterid.in_(rasterids)))
+    counts['rastervol'] = result.rowcount
+
+    for dbname in ['names', 'abbrevs', 'idents', 'raster', 'titlehistory', 'refsource', 'completeness', 'profile', 'master']:
+        db = TABLES[dbname]
+        dbhist = TABLES.get(dbname + '_hist', None)
+        if dbhist is not None:
+            cols = [c for c in db.columns.keys() if c in dbhist.columns.keys()]
+            rows = select([db.c[c] for c in cols] + [literal(editid), func.now()]).where(db.c.masterid.in_(masterids))
+            conn.execute(insert(dbhist).from_select(cols + ['editid', 'superseded'], rows))
+        result = conn.execute(delete(db).where(db.c.masterid.in_(masterids)))
+        counts[dbname] = result.rowcount
+    return counts
+
+
+def revert_edit(conn, editid, reinsert=False, dry_run=False, revertid=None):
+    # Restores the rows saved in the _hist tables under editid with one
+    # UPDATE ... FROM x_hist per table.  With reinsert, _hist rows whose
+    # live row no longer exists (i.e. rows removed by archive_and_delete)
+    # are inserted back.  Tables are visited parents first so reinserted
+    # rows satisfy their foreign keys.  With revertid (the revert's own
+    # editcontrol row), the live rows are archived under it before they
+    # are overwritten, and reinserted rows take its created time, so the
+    # change feed reports the revert like any other edit.  With dry_run,
+    # only the number of rows that would be updated and inserted is
+    # returned.
+    counts = {}
+    editctrl = TABLES['editcontrol']
+    for tablename in ['master', 'publisher', 'names', 'abbrevs', 'idents', 'raster', 'titlehistory']:
+        t = TABLES[tablename]
+        th = TABLES[tablename + '_hist']
+        tk = TABLE_UNIQID[tablename]
+        cols = [c for c in t.columns.keys() if c in th.columns.keys()]
+        # _hist tables store enums as plain strings
+        histcols = {}
+        for c in cols:
+            if type(th.c[c].type) is type(t.c[c].type):
+                histcols[c] = th.c[c]
+            else:
+                histcols[c] = cast(th.c[c], t.c[c].type)
+        matched = and_(t.c[tk]==th.c[tk], th.c.editid==editid)
+        missing = and_(th.c.editid==editid, ~exists().where(t.c[tk]==th.c[tk]))
+
+        if dry_run:
+            nupdate = conn.execute(select([func.count()]).select_from(t.join(th, t.c[tk]==th.c[tk])).where(th.c.editid==editid)).scalar()
+            ninsert = 0
+            if reinsert:
+                ninsert = conn.execute(select([func.count()]).select_from(th).where(missing)).scalar()
+        else:
+            if revertid is not None:
+                live = select([t.c[c] for c in cols] + [literal(revertid), func.now()]).where(exists().where(matched))
+                conn.execute(insert(th).from_select(cols + ['editid', 'superseded'], live))
+            # updated is left to the column's onupdate, so the revert
+            # changes the table signatures caches are keyed on
+            setcols = [c for c in cols if c not in (tk, 'updated')]
+            if conn.dialect.name == 'postgresql':
+                values = dict((c, histcols[c]) for c in setcols)
+                stmt = update(t).where(matched).values(values)
+            else:
+                # the same update with correlated subqueries, for
+                # backends without UPDATE ... FROM (sqlite)
+                values = dict((c, select([histcols[c]]).where(matched).scalar_subquery()) for c in setcols)
+                stmt = update(t).where(exists().where(matched)).values(values)
+            nupdate = conn.execute(stmt).rowcount
+            ninsert = 0
+            if reinsert:
+                values = dict(histcols)
+                if revertid is not None and 'created' in values:
+                    values['created'] = select([editctrl.c.created]).where(editctrl.c.editid==revertid).scalar_subquery()
+                rows = select([values[c] for c in cols]).where(missing)
+                ninsert = conn.execute(insert(t).from_select(cols, rows)).rowcount
+        if nupdate or ninsert:
+            counts[tablename] = {'updated': nupdate, 'inserted': ninsert}
+    return counts
+
+
+def completeness_volume_rows(masterid, details):
+    # one completeness row per volume; volume_number is set for plain
+    # numeric volumes so they can be range-queried
+    rows = []
+    for d in details:
+        volume = d.get('volume', None) if isinstance(d, dict) else None
+        if volume is not None:
+            volume = str(volume)
+        volume_number = None
+        if volume and volume.isdigit() and len(volume) < 10:
+            volume_number = int(volume)
+        rows.append({'masterid': masterid,
+                     'volume': volume,
+                     'volume_number': volume_number,
+                     'details': json.dumps(d)})
+    return rows
+
+
+def load_completeness(conn, journals, masterdict, critc=0.0, batch_size=1000):
+    '''
+    Loads completeness_export.json entries (an iterable of dicts) with a
+    title_completeness_fraction of at least critc: per batch_size
+    journals, one executemany sets master.completeness_fraction and the
+    journals' completeness rows are replaced.  Returns the masterids
+    updated, the bibstems not in masterdict, the bibstems listed more
+    than once (the last entry is used) and the number below critc.
+    '''
+    mt = TABLES['master']
+    ct = TABLES['completeness']
+    stmt = update(mt).where(mt.c.masterid==bindparam('b_masterid')).values(completeness_fraction=bindparam('b_fraction'))
+
+    def flush(batch):
+        conn.execute(stmt, [v[0] for v in batch.values()])
+        conn.execute(delete(ct).where(ct.c.masterid.in_(list(batch.keys()))))
+        volumes = [r for v in batch.values() for r in v[1]]
+        if volumes:
+            conn.execute(insert(ct), volumes)
+
+    result = {'updated': set(), 'missing': [], 'duplicates': [], 'skipped': 0}
+    batch = {}
+    for d in journals:
+        fraction = d.get('title_completeness_fraction', 0)
+        bibstem = d.get('bibstem', None)
+        details = d.get("completeness_details", [])
+
+        if fraction >= critc:
+            masterid = masterdict.get(bibstem, None)
+            if not masterid:
+                result['missing'].append(bibstem)
+            else:
+                if masterid in result['updated']:
+                    result['duplicates'].append(bibstem)
+                result['updated'].add(masterid)
+                batch[masterid] = ({'b_masterid': masterid,
+                                    'b_fraction': fraction},
+                                   completeness_volume_rows(masterid, details))
+                if len(batch) >= batch_size:
+                    flush(batch)
+                    batch = {}
+        else:
+            result['skipped'] += 1
+    if batch:
+        flush(batch)
+    return result
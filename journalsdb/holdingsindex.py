@@ -0,0 +1,137 @@
+'''
+Memory-mapped index of the pages held per (bibstem, volume).
+
+The manager builds it from the canonical bibcodes; journalsservice maps the
+file and answers page-level holdings without calling the search API.
+
+File layout (little endian):
+    header   magic 'JHIX', version, number of keys
+    entries  one per key, sorted by key: key offset, key length, pages
+             offset, pages length (offsets into the data section)
+    data     keys as 'bibstem<TAB>volume' and pages as comma-separated
+             text, all UTF-8
+'''
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+MAGIC = b'JHIX'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+ENTRY = struct.Struct('<IIII')
+
+
+def index_key(bibstem, volume):
+    return (u'%s\t%s' % (bibstem, volume or '')).encode('utf-8')
+
+
+def page_order(page):
+    # numeric pages in numeric order, then the rest (L12, e012...) as text
+    return (0, int(page), '') if page.isdigit() else (1, 0, page)
+
+
+def write_index(path, holdings, mode=0o444):
+    '''
+    Writes holdings, a dict of (bibstem, volume): iterable of pages, to
+    path.  The file is written next to path and renamed over it, so a
+    reader never maps a partial index.  Returns the number of keys.
+    '''
+    keys = sorted((index_key(bibstem, volume), pages) for ((bibstem, volume), pages) in holdings.items())
+    data_start = HEADER.size + ENTRY.size * len(keys)
+    entries = []
+    data = []
+    offset = data_start
+    for (key, pages) in keys:
+        text = u','.join(sorted(set(pages), key=page_order)).encode('utf-8')
+        entries.append(ENTRY.pack(offset, len(key), offset + len(key), len(text)))
+        data.append(key)
+        data.append(text)
+        offset += len(key) + len(text)
+    filedir = os.path.dirname(path) or '.'
+    (fd, tmpfile) = tempfile.mkstemp(dir=filedir, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(keys)))
+            f.write(b''.join(entries))
+            f.write(b''.join(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpfile, mode)
+        os.replace(tmpfile, path)
+    except BaseException:
+        try:
+            os.unlink(tmpfile)
+        except OSError:
+            pass
+        raise
+    return len(keys)
+
+
+class HoldingsIndex(object):
+    '''
+    Read side of the index.  lookup does a binary search over the mapped
+    entries, so opening the file costs nothing and the pages stay in the
+    OS page cache shared by every worker process.  maybe_refresh remaps
+    the file once the manager has replaced it, checking at most every
+    refresh_interval seconds.
+    '''
+
+    def __init__(self, path, refresh_interval=300, clock=time.time):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.last_check = clock()
+        self.stat = None
+        self.map = None
+        self.count = 0
+        self.open()
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, count) = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or version != VERSION:
+            mapped.close()
+            raise ValueError('%s is not a version %s holdings index' % (self.path, VERSION))
+        # the old map stays valid for lookups still using it, and is
+        # unmapped once nothing refers to it
+        (self.map, self.count, self.stat) = (mapped, count, stat)
+
+    def maybe_refresh(self):
+        # the manager renames a new file into place, so a different inode
+        # means a new index; True if it was remapped
+        if self.clock() - self.last_check < self.refresh_interval:
+            return False
+        self.last_check = self.clock()
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        if (stat.st_ino, stat.st_mtime) == (self.stat.st_ino, self.stat.st_mtime):
+            return False
+        self.open()
+        return True
+
+    def lookup(self, bibstem, volume):
+        # the sorted pages of bibstem/volume, or None if it has none
+        (mapped, count) = (self.map, self.count)
+        key = index_key(bibstem, volume)
+        (lo, hi) = (0, count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (key_offset, key_len, pages_offset, pages_len) = ENTRY.unpack_from(mapped, HEADER.size + mid * ENTRY.size)
+            found = mapped[key_offset:key_offset + key_len]
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                pages = mapped[pages_offset:pages_offset + pages_len].decode('utf-8')
+                return pages.split(',') if pages else []
+        return None
+
+    def __len__(self):
+        return self.count
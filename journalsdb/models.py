@@ -30,7 +30,6 @@ class JournalsMaster(Base):
     refereed = Column(ref_status, nullable=False)
     collection = Column(String, nullable=True)
     completeness_fraction = Column(String, nullable=True)
-    completeness_details = Column(Text)
     notes = Column(Text)
     not_indexed = Column(Boolean, nullable=False, default=False)
     deprecated = Column(Boolean, nullable=False, default=False)
@@ -41,9 +40,6 @@ class JournalsMaster(Base):
         return "master.masterid='{self.masterid}'".format(self=self)
 
     def toJSON(self):
-        completeness_details = self.completeness_details
-        if completeness_details:
-            completeness_details = json.loads(completeness_details)
         return {'bibstem': self.bibstem,
                 'journal_name': self.journal_name,
                 'primary_language': self.primary_language,
@@ -53,7 +49,6 @@ class JournalsMaster(Base):
                 'refereed': self.refereed,
                 'collection': self.collection,
                 'completeness_fraction': self.completeness_fraction,
-                'completeness_details': completeness_details,
                 'notes': self.notes,
                 'not_indexed': self.not_indexed,
                 'deprecated': self.deprecated}
@@ -410,6 +405,43 @@ class JournalsRefSource(Base):
         return "refsource.masterid='{self.masterid}'".format(self=self)
 
 
+class JournalsCompleteness(Base):
+    __tablename__ = 'completeness'
+
+    complid = Column(Integer, primary_key=True, autoincrement=True,
+                     unique=True, nullable=False)
+    masterid = Column(Integer, ForeignKey('master.masterid'),
+                      nullable=False)
+    volume = Column(String)
+    volume_number = Column(Integer)
+    details = Column(Text)
+    created = Column(UTCDateTime, default=get_date)
+
+    def __repr__(self):
+        return "completeness.complid='{self.complid}'".format(self=self)
+
+    def toJSON(self):
+        details = self.details
+        if details:
+            details = json.loads(details)
+        return details
+
+
+
+class JournalsProfile(Base):
+    __tablename__ = 'profile'
+
+    masterid = Column(Integer, ForeignKey('master.masterid'),
+                      primary_key=True, nullable=False)
+    bibstem = Column(String, unique=True, nullable=False)
+    summary = Column(Text)
+    browse = Column(Text)
+    updated = Column(UTCDateTime, default=get_date, onupdate=get_date)
+
+    def __repr__(self):
+        return "profile.masterid='{self.masterid}'".format(self=self)
+
+
 class JournalsEditControl(Base):
     __tablename__ = 'editcontrol'
 
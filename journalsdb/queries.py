@@ -0,0 +1,372 @@
+'''
+Read-only Core queries behind the journalsservice endpoints.  Rows come back
+as plain tuples, with no ORM objects or identity map, and are serialized
+through the models' toJSON so the responses keep the same shape.
+'''
+import json
+
+from contextlib import contextmanager
+from sqlalchemy import Integer, String, and_, case, cast, func, literal, null, or_, select, text, tuple_, union
+from journalsdb.models import JournalsMaster, JournalsAbbreviations, JournalsIdentifiers, JournalsPublisher, JournalsRefSource, JournalsTitleHistory, JournalsNames, JournalsCompleteness, JournalsProfile, JournalsEditControl
+from journalsdb.edits import DELETION_EDITFILEIDS, REVERT_EDITFILEID
+from journalsdb.models import JournalsMasterHistory, JournalsNamesHistory, JournalsAbbreviationsHistory, JournalsIdentifiersHistory, JournalsPublisherHistory, JournalsTitleHistoryHistory, JournalsRaster, JournalsRasterHistory
+
+master = JournalsMaster.__table__
+abbrevs = JournalsAbbreviations.__table__
+idents = JournalsIdentifiers.__table__
+names = JournalsNames.__table__
+publisher = JournalsPublisher.__table__
+titlehistory = JournalsTitleHistory.__table__
+refsource = JournalsRefSource.__table__
+completeness = JournalsCompleteness.__table__
+profile = JournalsProfile.__table__
+editctrl = JournalsEditControl.__table__
+raster = JournalsRaster.__table__
+
+# editable tables, their key and their _hist table, for the change feed
+CHANGE_TABLES = [('master', master, 'masterid', JournalsMasterHistory.__table__),
+                 ('names', names, 'nameid', JournalsNamesHistory.__table__),
+                 ('abbrevs', abbrevs, 'abbrevid', JournalsAbbreviationsHistory.__table__),
+                 ('idents', idents, 'identid', JournalsIdentifiersHistory.__table__),
+                 ('publisher', publisher, 'publisherid', JournalsPublisherHistory.__table__),
+                 ('titlehistory', titlehistory, 'titlehistoryid', JournalsTitleHistoryHistory.__table__),
+                 ('raster', raster, 'rasterid', JournalsRasterHistory.__table__)]
+
+
+@contextmanager
+def read_only(engine):
+    # a single read-only transaction per request; it is rolled back rather
+    # than committed since nothing is ever written
+    with engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text('SET TRANSACTION READ ONLY'))
+            yield conn
+        finally:
+            trans.rollback()
+
+
+def get_master(conn, bibstem=None, masterid=None):
+    query = select([master])
+    if masterid is not None:
+        query = query.where(master.c.masterid==masterid)
+    else:
+        query = query.where(master.c.bibstem==bibstem)
+    return conn.execute(query.limit(1)).first()
+
+
+def get_abbreviations(conn, masterid, canonical=None):
+    query = select([abbrevs.c.abbreviation]).where(abbrevs.c.masterid==masterid)
+    if canonical is not None:
+        query = query.where(abbrevs.c.canonical==canonical)
+    return [r.abbreviation for r in conn.execute(query)]
+
+
+def get_identifiers(conn, masterid):
+    query = select([idents.c.id_type, idents.c.id_value]).where(idents.c.masterid==masterid)
+    return [JournalsIdentifiers.toJSON(r) for r in conn.execute(query)]
+
+
+def get_names(conn, masterid):
+    query = select([names]).where(names.c.masterid==masterid)
+    return [JournalsNames.toJSON(r) for r in conn.execute(query)]
+
+
+def get_publication_history(conn, masterid, missing=None):
+    # titlehistory with its publisher abbreviation in one outer join; rows
+    # without a publisher are skipped unless a placeholder is given
+    query = select([titlehistory, publisher.c.pubabbrev])\
+        .select_from(titlehistory.outerjoin(publisher, titlehistory.c.publisherid==publisher.c.publisherid))\
+        .where(titlehistory.c.masterid==masterid)
+    pubhist = []
+    for r in conn.execute(query):
+        title = JournalsTitleHistory.toJSON(r)
+        title.pop('publisherid', None)
+        if r.publisherid:
+            pubhist.append({'publisher': r.pubabbrev, 'title': title})
+        elif missing is not None:
+            pubhist.append({'publisher': missing, 'title': title})
+    return pubhist
+
+
+def get_completeness_details(conn, masterid, vol_start=None, vol_end=None):
+    query = select([completeness.c.details]).where(completeness.c.masterid==masterid)
+    if vol_start is not None:
+        query = query.where(completeness.c.volume_number >= vol_start)
+    if vol_end is not None:
+        query = query.where(completeness.c.volume_number <= vol_end)
+    query = query.order_by(completeness.c.complid.asc())
+    return {'completeness_by_volume': [json.loads(r.details) if r.details else r.details for r in conn.execute(query)]}
+
+
+def get_refsource(conn, bibstem):
+    query = select([refsource.c.refsource_list])\
+        .select_from(refsource.join(master, refsource.c.masterid==master.c.masterid))\
+        .where(master.c.bibstem==bibstem)
+    return conn.execute(query.limit(1)).scalar()
+
+
+def get_issn(conn, issn):
+    query = select([idents.c.masterid, idents.c.id_type, idents.c.id_value])\
+        .where(and_(idents.c.id_value==issn, idents.c.id_type.like('ISSN%')))
+    return conn.execute(query.limit(1)).first()
+
+
+def search_journals(conn, jname):
+    # masterids matching jname in abbreviations, names, or master, then
+    # one select for the matched journals
+    matched = union(select([abbrevs.c.masterid]).where(abbrevs.c.abbreviation.ilike(jname)),
+                    select([names.c.masterid]).where(or_(names.c.name_english_translated.ilike(jname),
+                                                         names.c.name_native_language.ilike(jname),
+                                                         names.c.name_normalized.ilike(jname))),
+                    select([master.c.masterid]).where(or_(master.c.journal_name.ilike(jname),
+                                                          master.c.bibstem.ilike(jname))))
+    query = select([master.c.bibstem, master.c.journal_name, master.c.pubtype, master.c.refereed])\
+        .where(master.c.masterid.in_(matched))
+    return [{'bibstem': r.bibstem, 'name': r.journal_name, 'pubtype': r.pubtype, 'refereed': r.refereed} for r in conn.execute(query)]
+
+
+def summary_json(conn, dat_master):
+    masterid = dat_master.masterid
+    return {'master': JournalsMaster.toJSON(dat_master),
+            'idents': get_identifiers(conn, masterid),
+            'abbrev': get_abbreviations(conn, masterid),
+            'pubhist': get_publication_history(conn, masterid, missing='n/a'),
+            'names': get_names(conn, masterid)}
+
+
+def browse_json(conn, dat_master):
+    masterid = dat_master.masterid
+    dat_abbrev = get_abbreviations(conn, masterid, canonical=True)
+    dat_names = get_names(conn, masterid)
+    pubhist = [{'publisher': p.get('publisher', ''),
+                'start_year': p.get('title', {}).get('year_start', ''),
+                'start_volume': p.get('title', {}).get('vol_start', '')}
+               for p in get_publication_history(conn, masterid)]
+    return {'canonical_name': dat_master.journal_name,
+            'classic_bibstem': dat_master.bibstem,
+            'canonical_abbreviation': dat_abbrev[0] if dat_abbrev else '',
+            'primary_language': dat_master.primary_language,
+            'native_language_title': dat_names[0].get('name_native_language', '') if dat_names else '',
+            'title_language': dat_names[0].get('title_language', '') if dat_names else '',
+            'completeness_estimate': dat_master.completeness_fraction,
+            'external_identifiers': get_identifiers(conn, masterid),
+            'publication_history': pubhist}
+
+
+
+def build_profiles(conn, masterids=None):
+    # profile rows (ready-to-serve summary and browse JSON) for masterids,
+    # or for every journal
+    query = select([master])
+    if masterids is not None:
+        query = query.where(master.c.masterid.in_(masterids))
+    return [{'masterid': m.masterid,
+             'bibstem': m.bibstem,
+             'summary': json.dumps(summary_json(conn, m)),
+             'browse': json.dumps(browse_json(conn, m))}
+            for m in conn.execute(query).fetchall()]
+
+
+def get_profile(conn, bibstem):
+    query = select([profile]).where(profile.c.bibstem==bibstem)
+    return conn.execute(query.limit(1)).first()
+
+
+def get_summary(conn, bibstem):
+    # (masterid, summary) from the profile table, or built from the live
+    # tables for journals without a profile row; (None, None) if not found
+    dat_profile = get_profile(conn, bibstem)
+    if dat_profile and dat_profile.summary:
+        return (dat_profile.masterid, json.loads(dat_profile.summary))
+    dat_master = get_master(conn, bibstem=bibstem)
+    if not dat_master:
+        return (None, None)
+    return (dat_master.masterid, summary_json(conn, dat_master))
+
+
+def get_browse(conn, bibstem):
+    dat_profile = get_profile(conn, bibstem)
+    if dat_profile and dat_profile.browse:
+        return json.loads(dat_profile.browse)
+    dat_master = get_master(conn, bibstem=bibstem)
+    if not dat_master:
+        return None
+    return browse_json(conn, dat_master)
+
+def iter_dump(conn, collection=None, pubtype=None, refereed=None, batch_size=500):
+    # summary JSON strings for every journal matching the filters, in
+    # masterid order and in lists of up to batch_size.  The rows come from
+    # a server-side cursor, so memory doesn't grow with the catalog.
+    query = select([master, profile.c.summary])\
+        .select_from(master.outerjoin(profile, master.c.masterid==profile.c.masterid))
+    if collection:
+        query = query.where(master.c.collection.ilike('%' + collection + '%'))
+    if pubtype:
+        query = query.where(master.c.pubtype==pubtype)
+    if refereed:
+        query = query.where(master.c.refereed==refereed)
+    result = conn.execution_options(stream_results=True).execute(query.order_by(master.c.masterid))
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [r.summary if r.summary else json.dumps(summary_json(conn, r)) for r in rows]
+    finally:
+        result.close()
+
+
+def issn_json(conn, issn):
+    dat_idents = get_issn(conn, issn)
+    if not dat_idents:
+        return {}
+    dat_master = get_master(conn, masterid=dat_idents.masterid)
+    pub_abbrev = None
+    for p in get_publication_history(conn, dat_idents.masterid):
+        if not p.get('title', {}).get('year_end', None):
+            if p.get('publisher', None):
+                pub_abbrev = p.get('publisher')
+    return {'ISSN': dat_idents.id_value,
+            'ISSN_type': dat_idents.id_type,
+            'bibstem': dat_master.bibstem,
+            'publisher': pub_abbrev,
+            'journal_name': dat_master.journal_name}
+
+
+def get_issn_records(conn):
+    # (id_value, id_type, bibstem, journal_name, publisher) for every ISSN,
+    # where publisher is the one of the last open-ended titlehistory row,
+    # as in issn_json
+    current = {}
+    query = select([titlehistory.c.masterid, titlehistory.c.year_end, publisher.c.pubabbrev])\
+        .select_from(titlehistory.join(publisher, titlehistory.c.publisherid==publisher.c.publisherid))\
+        .order_by(titlehistory.c.titlehistoryid.asc())
+    for r in conn.execute(query):
+        if not r.year_end and r.pubabbrev:
+            current[r.masterid] = r.pubabbrev
+    query = select([idents.c.id_value, idents.c.id_type, master.c.masterid, master.c.bibstem, master.c.journal_name])\
+        .select_from(idents.join(master, idents.c.masterid==master.c.masterid))\
+        .where(idents.c.id_type.like('ISSN%'))\
+        .order_by(idents.c.identid.asc())
+    return [(r.id_value, r.id_type, r.bibstem, r.journal_name, current.get(r.masterid, None)) for r in conn.execute(query)]
+
+
+def get_edit_signature(conn):
+    # changes whenever an edit is started, checked in, deleted or reverted
+    query = select([func.count(), func.max(editctrl.c.editid), func.max(editctrl.c.updated)])
+    return tuple(conn.execute(query).first())
+
+
+def get_master_signature(conn):
+    # changes whenever a journal is added, deleted or has its row updated
+    query = select([func.count(), func.max(master.c.masterid), func.max(master.c.updated)])
+    return ':'.join(str(v) for v in conn.execute(query).first())
+
+
+def get_issn_signature(conn):
+    # changes whenever a row the ISSN records are built from is added,
+    # deleted or updated, whether or not through an edit
+    parts = [get_edit_signature(conn), get_master_signature(conn)]
+    for (table, key) in [(idents, idents.c.identid), (titlehistory, titlehistory.c.titlehistoryid),
+                         (publisher, publisher.c.publisherid)]:
+        parts.append(tuple(conn.execute(select([func.count(), func.max(key), func.max(table.c.updated)])).first()))
+    return tuple(parts)
+
+
+def get_change_horizon(conn):
+    # the last edit the change feed may report: edits are numbered when
+    # they start, so nothing at or after the oldest active one is final yet
+    active = select([func.min(editctrl.c.editid)]).where(editctrl.c.editstatus=='active')
+    query = select([func.max(editctrl.c.editid)]).where(editctrl.c.editstatus!='active')
+    oldest_active = conn.execute(active).scalar()
+    if oldest_active is not None:
+        query = query.where(editctrl.c.editid < oldest_active)
+    return conn.execute(query).scalar() or 0
+
+
+def get_changes(conn, since, horizon, after=None, limit=1000):
+    # rows changed by edits since < editid <= horizon, as (editid,
+    # tablename, rowid, masterid, change, bibstem) in keyset order.
+    # Updated and deleted rows are the ones archived to a _hist table
+    # under the edit: a deletion's rows were deleted, and every other
+    # edit's (check-ins and reverts) were updated, whatever has happened
+    # to them since.  Created rows have no _hist entry and are the rows of
+    # the edit's table created while it was checked out; a revert creates
+    # the rows it reinserts, in any table.  Deleted journals keep the
+    # bibstem archived in master_hist.
+    edits = select([editctrl.c.editid, editctrl.c.tablename, editctrl.c.editfileid, editctrl.c.created, editctrl.c.updated])\
+        .where(and_(editctrl.c.editid > since, editctrl.c.editid <= horizon, editctrl.c.editstatus!='active'))\
+        .alias('edits')
+    change = case([(edits.c.editfileid.in_(DELETION_EDITFILEIDS), 'deleted')], else_='updated')
+    parts = []
+    for (tablename, t, key, th) in CHANGE_TABLES:
+        masterid = th.c.masterid if 'masterid' in th.c else cast(null(), Integer)
+        bibstem = th.c.bibstem if tablename == 'master' else cast(null(), String)
+        parts.append(select([th.c.editid, literal(tablename).label('tablename'), th.c[key].label('rowid'),
+                             masterid.label('masterid'), change.label('change'), bibstem.label('bibstem')])
+                     .select_from(th.join(edits, th.c.editid==edits.c.editid)))
+        masterid = t.c.masterid if 'masterid' in t.c else cast(null(), Integer)
+        parts.append(select([edits.c.editid, literal(tablename), t.c[key], masterid, literal('created'), cast(null(), String)])
+                     .select_from(t.join(edits, and_(or_(edits.c.tablename==tablename,
+                                                         edits.c.editfileid==REVERT_EDITFILEID),
+                                                     t.c.created>=edits.c.created,
+                                                     t.c.created<=edits.c.updated))))
+    changes = union(*parts).alias('changes')
+    query = select([changes.c.editid, changes.c.tablename, changes.c.rowid, changes.c.masterid, changes.c.change,
+                    func.coalesce(master.c.bibstem, changes.c.bibstem).label('bibstem')])\
+        .select_from(changes.outerjoin(master, changes.c.masterid==master.c.masterid))
+    if after:
+        query = query.where(tuple_(changes.c.editid, changes.c.tablename, changes.c.rowid) > tuple_(*after))
+    query = query.order_by(changes.c.editid, changes.c.tablename, changes.c.rowid).limit(limit)
+    return conn.execute(query).fetchall()
+
+
+def get_publisher_bibstems(conn, publisherids):
+    # bibstems of the journals whose title history names these publishers
+    if not publisherids:
+        return []
+    query = select([master.c.bibstem]).distinct()\
+        .select_from(titlehistory.join(master, titlehistory.c.masterid==master.c.masterid))\
+        .where(titlehistory.c.publisherid.in_(publisherids))
+    return [r.bibstem for r in conn.execute(query)]
+
+
+def changes_json(conn, since, after=None, limit=1000):
+    # one page of the change feed; 'next' is the keyset cursor of the
+    # following page, and once it is None 'latest' is the next 'since'
+    horizon = get_change_horizon(conn)
+    rows = get_changes(conn, since, horizon, after=after, limit=limit)
+    changes = []
+    bibstems = set()
+    publisherids = set()
+    for r in rows:
+        changes.append({'editid': r.editid,
+                        'table': r.tablename,
+                        'id': r.rowid,
+                        'masterid': r.masterid,
+                        'bibstem': r.bibstem,
+                        'change': r.change})
+        if r.bibstem:
+            bibstems.add(r.bibstem)
+        if r.tablename == 'publisher':
+            publisherids.add(r.rowid)
+    bibstems.update(get_publisher_bibstems(conn, list(publisherids)))
+    cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        cursor = '%s,%s,%s' % (last.editid, last.tablename, last.rowid)
+    return {'since': since,
+            'latest': max(horizon, since),
+            'next': cursor,
+            'bibstems': sorted(bibstems),
+            'changes': changes}
+
+
+def parse_change_cursor(cursor):
+    # 'editid,tablename,rowid' -> (editid, tablename, rowid)
+    (editid, tablename, rowid) = cursor.split(',')
+    if tablename not in [t[0] for t in CHANGE_TABLES]:
+        raise ValueError('unknown table %s' % tablename)
+    return (int(editid), tablename, int(rowid))
@@ -0,0 +1,213 @@
+'''
+Read-only SQLite snapshots of the journals database.
+
+The manager writes a new snapshot after check-ins and exports, and
+journalsservice replicas in snapshot mode serve every database endpoint
+from the newest one instead of from Postgres.  Each snapshot is a new
+file, journals-<version>.sqlite, that is never modified once it is
+published; the CURRENT file in the same directory names the one to use.
+'''
+import os
+import tempfile
+import time
+
+from datetime import datetime
+from sqlalchemy import Column, Index, MetaData, String, Table, create_engine, event, func, select, text
+from sqlalchemy.pool import QueuePool
+from journalsdb.models import Base
+
+POINTER = 'CURRENT'
+PREFIX = 'journals-'
+SUFFIX = '.sqlite'
+
+# the indexes the service's lookups rely on (see the alembic migrations)
+SNAPSHOT_INDEXES = [('abbrevs', ['masterid']),
+                    ('idents', ['masterid']),
+                    ('names', ['masterid']),
+                    ('titlehistory', ['masterid']),
+                    ('idents', ['id_value', 'id_type']),
+                    ('master_hist', ['editid']),
+                    ('names_hist', ['editid']),
+                    ('abbrevs_hist', ['editid']),
+                    ('idents_hist', ['editid']),
+                    ('publisher_hist', ['editid']),
+                    ('titlehistory_hist', ['editid']),
+                    ('raster_hist', ['editid'])]
+
+
+def snapshot_metadata():
+    # the journals schema for sqlite, which can't autoincrement composite
+    # primary keys (every id is copied anyway), plus snapshot_info
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        copy = table.to_metadata(metadata)
+        if len(copy.primary_key.columns) > 1:
+            for column in copy.primary_key.columns:
+                column.autoincrement = False
+    for (tablename, columns) in SNAPSHOT_INDEXES:
+        table = metadata.tables[tablename]
+        Index('ix_%s_%s' % (tablename, '_'.join(columns)), *[table.c[c] for c in columns])
+    Table('snapshot_info', metadata,
+          Column('key', String, primary_key=True),
+          Column('value', String))
+    return metadata
+
+
+def write_snapshot(source, directory, batch_size=5000, keep=3):
+    '''
+    Copies every table readable through the connection source into a new
+    snapshot in directory, points CURRENT at it, and removes all but the
+    newest keep snapshots.  Returns the path of the new snapshot and the
+    number of rows copied per table.
+    '''
+    if source.dialect.name == 'postgresql':
+        # one consistent view of all tables, even if an edit commits
+        # while they are being copied
+        source.execute(text('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY'))
+    version = datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    path = os.path.join(directory, PREFIX + version + SUFFIX)
+    tmpfile = path + '.tmp'
+    metadata = snapshot_metadata()
+    target = create_engine('sqlite:///' + tmpfile)
+    try:
+        metadata.create_all(target)
+        counts = {}
+        with target.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                result = source.execution_options(stream_results=True).execute(select([table]))
+                counts[table.name] = 0
+                while True:
+                    rows = result.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    conn.execute(metadata.tables[table.name].insert(), [dict(r) for r in rows])
+                    counts[table.name] += len(rows)
+            editid = source.execute(select([func.max(Base.metadata.tables['editcontrol'].c.editid)])).scalar()
+            conn.execute(metadata.tables['snapshot_info'].insert(),
+                         [{'key': 'version', 'value': version},
+                          {'key': 'editid', 'value': str(editid or 0)}])
+            conn.execute(text('ANALYZE'))
+        target.dispose()
+        os.chmod(tmpfile, 0o444)
+        os.replace(tmpfile, path)
+    except BaseException:
+        target.dispose()
+        try:
+            os.unlink(tmpfile)
+        except OSError:
+            pass
+        raise
+    set_current(directory, os.path.basename(path))
+    prune_snapshots(directory, keep)
+    return (path, counts)
+
+
+def set_current(directory, filename):
+    # replace CURRENT in one rename, so readers see the old or new name
+    (fd, tmpfile) = tempfile.mkstemp(dir=directory, prefix='.' + POINTER + '.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(filename + '\n')
+    os.chmod(tmpfile, 0o444)
+    os.replace(tmpfile, os.path.join(directory, POINTER))
+
+
+def current_snapshot(directory):
+    # path of the snapshot CURRENT names, or None if there is none yet
+    try:
+        with open(os.path.join(directory, POINTER)) as f:
+            filename = f.read().strip()
+    except IOError:
+        return None
+    if not filename:
+        return None
+    return os.path.join(directory, filename)
+
+
+def prune_snapshots(directory, keep):
+    # oldest first; a replica still reading a removed file keeps its open
+    # connections, and picks up CURRENT on its next refresh
+    current = current_snapshot(directory)
+    snapshots = sorted(f for f in os.listdir(directory) if f.startswith(PREFIX) and f.endswith(SUFFIX))
+    for filename in snapshots[0:max(len(snapshots) - keep, 0)]:
+        if os.path.join(directory, filename) != current:
+            os.unlink(os.path.join(directory, filename))
+
+
+def snapshot_engine(path, pool_size=10, mmap_size=256*1024*1024):
+    # read-only, immutable (no locking or change checks) and memory-mapped
+    engine = create_engine('sqlite:///file:%s?mode=ro&immutable=1&uri=true' % path,
+                           connect_args={'check_same_thread': False},
+                           poolclass=QueuePool, pool_size=pool_size, max_overflow=pool_size)
+
+    @event.listens_for(engine, 'connect')
+    def set_mmap(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA mmap_size=%d' % mmap_size)
+        cursor.close()
+
+    return engine
+
+
+class Snapshot(object):
+    '''
+    The newest snapshot in directory, usable wherever the service takes
+    an engine.  maybe_refresh switches to a newly published snapshot,
+    checking CURRENT at most every refresh_interval seconds.
+    '''
+
+    def __init__(self, directory, refresh_interval=60, pool_size=10,
+                 mmap_size=256*1024*1024, logger=None, clock=time.time):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.pool_size = pool_size
+        self.mmap_size = mmap_size
+        self.logger = logger
+        self.clock = clock
+        self.path = None
+        self.engine = None
+        self.info = {}
+        self.last_check = 0
+
+    def load(self):
+        # switch to the snapshot CURRENT names; True if it changed
+        self.last_check = self.clock()
+        path = current_snapshot(self.directory)
+        if path is None:
+            raise IOError('No snapshot in %s' % self.directory)
+        if path == self.path:
+            return False
+        engine = snapshot_engine(path, pool_size=self.pool_size, mmap_size=self.mmap_size)
+        with engine.connect() as conn:
+            info = dict((r.key, r.value) for r in conn.execute(text('SELECT key, value FROM snapshot_info')))
+        (old, self.engine, self.path, self.info) = (self.engine, engine, path, info)
+        if old is not None:
+            # connections checked out by running requests are closed when
+            # they are returned
+            old.dispose()
+        if self.logger:
+            self.logger.info('Serving journals snapshot %s' % path)
+        return True
+
+    def maybe_refresh(self):
+        if self.clock() - self.last_check >= self.refresh_interval:
+            try:
+                self.load()
+            except Exception as err:
+                if self.logger:
+                    self.logger.warning('Snapshot refresh failed, still serving %s: %s' % (self.path, err))
+
+    def connect(self):
+        return self.engine.connect()
+
+    @property
+    def pool(self):
+        return self.engine.pool
+
+    @property
+    def dialect(self):
+        return self.engine.dialect
+
+    def status(self):
+        status = dict(self.info)
+        status['path'] = self.path
+        return status
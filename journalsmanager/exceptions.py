@@ -105,6 +105,14 @@ class ActiveCheckoutException(Exception):
 class DeleteBibstemException(Exception):
     pass
 
+
+class RevertException(Exception):
+    pass
+
+
+class RevertEditHistoryException(Exception):
+    pass
+
 #Utils Exceptions
 class ReadBibstemException(Exception):
     pass
@@ -146,6 +154,14 @@ class ExportAbbrevException(Exception):
     pass
 
 
+class ExportISSNIdentException(Exception):
+    pass
+
+
+class ExportDeltaException(Exception):
+    pass
+
+
 class AutocompleteExportException(Exception):
     pass
 
@@ -160,3 +176,19 @@ class FileOwnershipError(Exception):
 
 class LoadCompletenessDataException(Exception):
     pass
+
+
+class RefreshProfilesException(Exception):
+    pass
+
+
+class PublishSnapshotException(Exception):
+    pass
+
+
+class HoldingsIndexExportException(Exception):
+    pass
+
+
+class LoadChunksException(Exception):
+    pass
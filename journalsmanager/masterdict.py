@@ -0,0 +1,121 @@
+'''
+On-disk cache of the bibstem -> masterid dictionary.
+
+Most run.py commands and several tasks need every bibstem's masterid.
+Rather than reading all of master each time, the dictionary is written
+to a file tagged with a signature of the master table (see
+queries.get_master_signature), and is reread only when the signature
+changes.  The file is memory-mapped and searched in place, so loading it
+costs nothing and every process using it shares the same pages.
+
+File layout (little endian):
+    header     magic 'JMDX', version, number of keys, signature length
+    signature  UTF-8
+    entries    one per bibstem, sorted: key offset, key length, masterid
+    data       the bibstems, UTF-8
+'''
+import mmap
+import os
+import struct
+import tempfile
+
+from collections.abc import Mapping
+
+MAGIC = b'JMDX'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+ENTRY = struct.Struct('<IIi')
+
+
+def write_masterdict(path, dictionary, signature, mode=0o644):
+    '''
+    Writes dictionary (bibstem: masterid) and signature to path,
+    renaming a temporary file over it so readers never map a partial
+    file.  Returns the number of bibstems written.
+    '''
+    sig = signature.encode('utf-8')
+    keys = sorted((bibstem.encode('utf-8'), masterid) for (bibstem, masterid) in dictionary.items())
+    data_start = HEADER.size + len(sig) + ENTRY.size * len(keys)
+    entries = []
+    offset = data_start
+    for (key, masterid) in keys:
+        entries.append(ENTRY.pack(offset, len(key), masterid))
+        offset += len(key)
+    filedir = os.path.dirname(path) or '.'
+    (fd, tmpfile) = tempfile.mkstemp(dir=filedir, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(keys), len(sig)))
+            f.write(sig)
+            f.write(b''.join(entries))
+            f.write(b''.join(k for (k, m) in keys))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpfile, mode)
+        os.replace(tmpfile, path)
+    except BaseException:
+        try:
+            os.unlink(tmpfile)
+        except OSError:
+            pass
+        raise
+    return len(keys)
+
+
+class MasterDict(Mapping):
+    '''
+    Read-only bibstem -> masterid mapping over a write_masterdict file,
+    usable wherever a masterdict dict is.  Lookups binary-search the
+    mapped entries; signature is the master table signature it was
+    written with.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.count, siglen) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError('%s is not a version %s masterdict file' % (path, VERSION))
+        self.signature = self.map[HEADER.size:HEADER.size + siglen].decode('utf-8')
+        self.entries = HEADER.size + siglen
+
+    def _entry(self, i):
+        (key_offset, key_len, masterid) = ENTRY.unpack_from(self.map, self.entries + i * ENTRY.size)
+        return (self.map[key_offset:key_offset + key_len], masterid)
+
+    def __getitem__(self, bibstem):
+        if not isinstance(bibstem, str):
+            raise KeyError(bibstem)
+        key = bibstem.encode('utf-8')
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (found, masterid) = self._entry(mid)
+            if found < key:
+                lo = mid + 1
+            elif found > key:
+                hi = mid
+            else:
+                return masterid
+        raise KeyError(bibstem)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._entry(i)[0].decode('utf-8')
+
+    def __len__(self):
+        return self.count
+
+
+def load_masterdict(path, signature):
+    # the cached MasterDict at path if it was written with signature,
+    # otherwise None
+    try:
+        cached = MasterDict(path)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    if cached.signature != signature:
+        return None
+    return cached
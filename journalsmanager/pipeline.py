@@ -0,0 +1,146 @@
+'''
+Runs the stages of a multi-step load as a dependency graph.
+
+A stage starts as soon as every stage it depends on has finished, so
+independent stages (loads into different tables) run at the same time.
+A failed stage doesn't stop the others; the stages that depend on it
+are skipped, and run_stages reports what ran, how long it took, and
+what failed or was skipped.
+
+dispatch_chunks and collect_chunks send one load to the Celery workers
+as a group of tasks, each loading a chunk of the records.
+'''
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+# func is called with the results of the stages in depends, as keyword
+# arguments named after them
+Stage = namedtuple('Stage', ['name', 'func', 'depends'])
+
+StageReport = namedtuple('StageReport', ['name', 'status', 'seconds', 'error'])
+
+
+def check_stages(stages):
+    # the stages by name; raises ValueError for duplicate names, unknown
+    # dependencies or a dependency cycle
+    graph = {}
+    for stage in stages:
+        if stage.name in graph:
+            raise ValueError('Duplicate stage %s' % stage.name)
+        graph[stage.name] = stage
+    for stage in stages:
+        for dep in stage.depends:
+            if dep not in graph:
+                raise ValueError('Stage %s depends on unknown stage %s' % (stage.name, dep))
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if set(s.depends) <= done]
+        if not ready:
+            raise ValueError('Dependency cycle among stages %s' % ', '.join(s.name for s in remaining))
+        done.update(s.name for s in ready)
+        remaining = [s for s in remaining if s.name not in done]
+    return graph
+
+
+def run_stages(stages, max_workers=4, logger=None, clock=time.time):
+    '''
+    Runs stages (a list of Stage) on up to max_workers threads.  Returns
+    a list of StageReport in the order of stages, and the results of the
+    stages that succeeded, by name.
+    '''
+    check_stages(stages)
+    results = {}
+    reports = {}
+    pending = dict((s.name, s) for s in stages)
+    running = {}
+
+    def timed(stage, kwargs):
+        start = clock()
+        try:
+            return (stage.func(**kwargs), clock() - start, None)
+        except Exception as err:
+            return (None, clock() - start, err)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for (name, stage) in list(pending.items()):
+                failed = [d for d in stage.depends if d in reports and reports[d].status != OK]
+                if failed:
+                    reports[name] = StageReport(name, SKIPPED, 0.0, 'depends on %s' % ', '.join(failed))
+                    del pending[name]
+                    if logger:
+                        logger.warning('Skipping stage %s: %s' % (name, reports[name].error))
+                elif all(d in results for d in stage.depends):
+                    kwargs = dict((d, results[d]) for d in stage.depends)
+                    running[executor.submit(timed, stage, kwargs)] = name
+                    del pending[name]
+                    if logger:
+                        logger.debug('Started stage %s' % name)
+            if not running:
+                continue
+            (finished, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                (result, seconds, err) = future.result()
+                if err is None:
+                    results[name] = result
+                    reports[name] = StageReport(name, OK, seconds, None)
+                else:
+                    reports[name] = StageReport(name, FAILED, seconds, err)
+                    if logger:
+                        logger.warning('Stage %s failed after %.1fs: %s' % (name, seconds, err))
+    return ([reports[s.name] for s in stages], results)
+
+
+def log_report(logger, reports):
+    # one line per stage, then the stages that didn't succeed
+    for r in reports:
+        logger.info('%-16s %-8s %8.1fs%s' % (r.name, r.status, r.seconds, ('  %s' % r.error) if r.error else ''))
+    bad = [r.name for r in reports if r.status != OK]
+    if bad:
+        logger.warning('Stages not completed: %s' % ', '.join(bad))
+
+
+def chunked(recs, chunk_size):
+    return [recs[i:i + chunk_size] for i in range(0, len(recs), chunk_size)]
+
+
+def dispatch_chunks(task, recs, chunk_size, *args):
+    # a group of task calls, one per chunk_size records, sent to the
+    # task's queue; returns the GroupResult for collect_chunks
+    from celery import group
+    return group(task.s(chunk, *args) for chunk in chunked(list(recs), chunk_size)).apply_async()
+
+
+def collect_chunks(result, label, logger=None, timeout=None):
+    '''
+    Waits for the chunks of result (a dispatch_chunks GroupResult),
+    logging progress as they finish.  Returns a dict with the number of
+    chunks, the sum of the counts the chunk tasks returned (loaded), and
+    the errors of the chunks that failed.
+    '''
+    summary = {'chunks': len(result.results), 'loaded': 0, 'errors': []}
+    done = []
+
+    def progress(task_id, value):
+        done.append(task_id)
+        if isinstance(value, Exception):
+            summary['errors'].append(value)
+        else:
+            summary['loaded'] += value or 0
+        if logger:
+            logger.debug('%s: %s of %s chunks done' % (label, len(done), summary['chunks']))
+
+    result.join(timeout=timeout, propagate=False, callback=progress)
+    if logger:
+        logger.info('%s: %s records loaded in %s chunks, %s failed' %
+                    (label, summary['loaded'], summary['chunks'], len(summary['errors'])))
+    return summary
@@ -5,6 +5,7 @@ import io
 import json
 import os
 from kombu import Queue
+from sqlalchemy import delete, insert
 from journalsmanager import app as app_module
 from journalsdb.models import JournalsMaster as master
 from journalsdb.models import JournalsMasterHistory as master_hist
@@ -22,11 +23,15 @@ from journalsdb.models import JournalsRasterVolume as rastervol
 from journalsdb.models import JournalsRefSource as refsource
 from journalsdb.models import JournalsTitleHistory as titlehistory
 from journalsdb.models import JournalsTitleHistoryHistory as titlehistory_hist
+from journalsdb.models import JournalsCompleteness as completeness
+from journalsdb.models import JournalsProfile as profile
 from journalsdb.models import JournalsEditControl as editctrl
+from journalsdb import queries
+from journalsdb.edits import DELETION_EDITFILEIDS, REVERT_EDITFILEID, TABLE_UNIQID, archive_and_delete, load_completeness, revert_edit
+from journalsdb.snapshot import write_snapshot
+from journalsmanager.masterdict import load_masterdict, write_masterdict
 from journalsmanager.utils import *
 from journalsmanager.exceptions import *
-from journalsmanager.sheetmanager import SpreadsheetManager
-from journalsmanager.slackhandler import SlackPublisher
 import journalsmanager.refsource as refsrc
 
 TABLES = {'master': master, 'master_hist': master_hist,
@@ -36,16 +41,11 @@ TABLES = {'master': master, 'master_hist': master_hist,
           'publisher': publisher, 'publisher_hist': publisher_hist,
           'raster': raster, 'raster_hist': raster_hist,
           'titlehistory': titlehistory, 'titlehistory_hist': titlehistory_hist,
-          'refsource': refsource, 'rastervol': rastervol}
+          'refsource': refsource, 'rastervol': rastervol,
+          'completeness': completeness, 'profile': profile}
 
-TABLE_UNIQID = {'master': 'masterid',
-                'names': 'nameid',
-                'abbrevs': 'abbrevid',
-                'idents': 'identid',
-                'publisher': 'publisherid',
-                'titlehistory': 'titlehistoryid',
-                'raster': 'rasterid',
-                'rastervol': 'rvolid'}
+# tables whose rows make up a journal profile (summary/browse responses)
+PROFILE_TABLES = ['master', 'abbrevs', 'idents', 'names', 'titlehistory']
 
 proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
 
@@ -118,78 +118,205 @@ def task_db_bibstems_to_master(recs):
                 raise DBCommitException("Could not commit to db, stopping now.")
 
 
-@app.task(queue='load-datafiles')
-def task_export_classic_files():
-
-    # pending successful returns...
-    result_bibstems = 'failed'
-    result_issn = 'failed'
-
-    # bibstems
+def get_classic_export_rows(masterids=None):
+    # rows for each of the classic export files; if masterids is given,
+    # only the rows belonging to those journals are returned
+    rowsets = {}
     with app.session_scope() as session:
-        result = session.query(master.bibstem,master.pubtype,master.refereed,master.journal_name).filter_by(not_indexed=False).order_by(master.bibstem.asc()).all()
+
+        # bibstems
+        query = session.query(master.bibstem,master.pubtype,master.refereed,master.journal_name).filter_by(not_indexed=False)
+        if masterids is not None:
+            query = query.filter(master.masterid.in_(masterids))
         rows = []
-        for r in result:
+        for r in query.order_by(master.bibstem.asc()).all():
             (bibstem,pubtype,refereed,journal_name) = r
             rows.append({'bibstem': bibstem, 'pubtype': pubtype, 'refereed': refereed, 'pubname':journal_name})
-        try:
-            result_bibstems = export_to_bibstemsdat(rows)
-        except Exception as err:
-            logger.error("Problem exporting master to bibstems.dat: %s" % err)
+        rowsets['bibstems'] = rows
 
-    # ISSNs
-    with app.session_scope() as session:
-        result = session.query(idents.id_value, master.bibstem, master.journal_name).join(master, idents.masterid == master.masterid).filter(idents.id_type=='ISSN_print').all()
+        # ISSNs
+        query = session.query(idents.id_value, master.bibstem, master.journal_name).join(master, idents.masterid == master.masterid).filter(idents.id_type=='ISSN_print')
+        if masterids is not None:
+            query = query.filter(master.masterid.in_(masterids))
         rows = []
-        for r in result:
+        for r in query.all():
             (issn, bibstem, name) = r
             bibstem = bibstem.ljust(5, '.')
             rows.append({'bibstem': bibstem, 'issn': issn, 'name': name})
-        try:
-            result_issn = export_issns(rows)
-        except Exception as err:
-            logger.error("Problem exporting ISSNs to files: %s" % err)
+        rowsets['issns'] = rows
 
-    # Publishers
-    with app.session_scope() as session:
-        result = session.query(master.bibstem, titlehistory.publisherid, publisher.pubabbrev).join(master, titlehistory.masterid == master.masterid).join(publisher, titlehistory.publisherid == publisher.publisherid).all()
+        # Publishers
+        query = session.query(master.bibstem, titlehistory.publisherid, publisher.pubabbrev).join(master, titlehistory.masterid == master.masterid).join(publisher, titlehistory.publisherid == publisher.publisherid)
+        if masterids is not None:
+            query = query.filter(master.masterid.in_(masterids))
         rows = []
-        for r in result:
+        for r in query.all():
             (bibstem, pubid, pubabbrev) = r
             bibstem = bibstem.ljust(5, '.')
             rows.append({'bibstem': bibstem, 'publisher': pubabbrev})
-        try:
-            result_publisher = export_publishers(rows)
-        except Exception as err:
-            logger.error("Problem exporting publishers to file: %s" % err)
+        rowsets['publishers'] = rows
 
-    # ISSNs for IngestParser
-    with app.session_scope() as session:
-        result = session.query(master.bibstem, idents.id_type, idents.id_value).join(master, idents.masterid == master.masterid).all()
+        # ISSNs for IngestParser
+        query = session.query(master.bibstem, idents.id_type, idents.id_value).join(master, idents.masterid == master.masterid)
+        if masterids is not None:
+            query = query.filter(master.masterid.in_(masterids))
         rows = []
-        for r in result:
+        for r in query.all():
             (bibstem, id_type, id_value) = r
             if "ISSN" in id_type:
                 rows.append({"bibstem": bibstem, "id_type": id_type, "id_value": id_value})
-        try:
-            result_issn_ident = export_issn_identifiers(rows)
-        except Exception as err:
-            logger.error("Problem exporting issn-identifier mapping to file: %s" % err)
+        rowsets['issn_identifiers'] = rows
 
-    # Journal Canonical Abbreviations
-    with app.session_scope() as session:
-        result = session.query(master.bibstem, abbrevs.abbreviation).join(master, abbrevs.masterid == master.masterid).filter(abbrevs.canonical == True).order_by(master.bibstem.asc()).all()
+        # Journal Canonical Abbreviations
+        query = session.query(master.bibstem, abbrevs.abbreviation).join(master, abbrevs.masterid == master.masterid).filter(abbrevs.canonical == True)
+        if masterids is not None:
+            query = query.filter(master.masterid.in_(masterids))
         rows = []
-        for r in result:
+        for r in query.order_by(master.bibstem.asc()).all():
             (bibstem, abbrev) = r
             rows.append({"bibstem": bibstem, "abbrev": abbrev})
-        try:
-            result_abbrevs = export_abbreviations(rows)
-        except Exception as err:
-            logger.error("Problem exporting journal abbreviations to file: %s" % err)
+        rowsets['abbreviations'] = rows
+
+    return rowsets
+
+
+@app.task(queue='load-datafiles')
+def task_export_classic_files():
+
+    # pending successful returns...
+    result_bibstems = 'failed'
+    result_issn = 'failed'
+
+    rowsets = get_classic_export_rows()
+
+    # bibstems
+    try:
+        result_bibstems = export_to_bibstemsdat(rowsets['bibstems'])
+    except Exception as err:
+        logger.error("Problem exporting master to bibstems.dat: %s" % err)
+
+    # ISSNs
+    try:
+        result_issn = export_issns(rowsets['issns'])
+    except Exception as err:
+        logger.error("Problem exporting ISSNs to files: %s" % err)
+
+    # Publishers
+    try:
+        result_publisher = export_publishers(rowsets['publishers'])
+    except Exception as err:
+        logger.error("Problem exporting publishers to file: %s" % err)
+
+    # ISSNs for IngestParser
+    try:
+        result_issn_ident = export_issn_identifiers(rowsets['issn_identifiers'])
+    except Exception as err:
+        logger.error("Problem exporting issn-identifier mapping to file: %s" % err)
+
+    # Journal Canonical Abbreviations
+    try:
+        result_abbrevs = export_abbreviations(rowsets['abbreviations'])
+    except Exception as err:
+        logger.error("Problem exporting journal abbreviations to file: %s" % err)
+
+
+def get_edit_masterids(session, editid, tablenames):
+    # masterids with rows in the _hist tables of tablenames under editid,
+    # plus the journals of any publisher edited under editid
+    changed = set()
+    for tablename in tablenames:
+        th = TABLES[tablename + '_hist']
+        changed.update(x[0] for x in session.query(th.masterid).filter(th.editid==editid).distinct())
+    pubids = [x[0] for x in session.query(publisher_hist.publisherid).filter(publisher_hist.editid==editid).distinct()]
+    if pubids:
+        changed.update(x[0] for x in session.query(titlehistory.masterid).filter(titlehistory.publisherid.in_(pubids)).distinct())
+    return changed
+
+
+@app.task(queue='load-datafiles')
+def task_export_classic_delta(editid, masterids=None):
+    # Patch the classic files for the journals touched by edit editid:
+    # those with rows in a _hist table for editid, plus masterids (rows
+    # created by the edit, which have no _hist entry).  Falls back to a
+    # full export when the delta is large or the patch fails.
+    changed = set(x for x in (masterids or []) if x)
+    bibstems = set()
+    with app.session_scope() as session:
+        changed.update(get_edit_masterids(session, editid, ['master', 'abbrevs', 'idents', 'titlehistory']))
+        # old bibstems (renamed or deleted journals) and current ones
+        bibstems.update(x[0] for x in session.query(master_hist.bibstem).filter(master_hist.editid==editid))
+        if changed:
+            bibstems.update(x[0] for x in session.query(master.bibstem).filter(master.masterid.in_(changed)))
+
+    if not bibstems:
+        logger.info("Edit %s changed nothing in the classic files" % editid)
+        return
+
+    if len(bibstems) > app.conf.get('CLASSIC_EXPORT_MAX_DELTA', 250):
+        logger.info("Edit %s touched %s bibstems, regenerating all classic files" % (editid, len(bibstems)))
+        task_export_classic_files()
+        return
+
+    try:
+        rowsets = get_classic_export_rows(masterids=list(changed))
+        result = patch_classic_exports(rowsets, bibstems)
+        logger.info("Classic files patched for edit %s: %s" % (editid, result))
+    except Exception as err:
+        logger.warning("Unable to patch classic files for edit %s, regenerating all: %s" % (editid, err))
+        task_export_classic_files()
+
+
+@app.task(queue='load-datafiles')
+def task_refresh_profiles(masterids=None):
+    # Rebuilds the profile rows served by the summary and browse endpoints
+    # for masterids, or for every journal when masterids is None.  Profiles
+    # are replaced a batch at a time in a single transaction.
+    batch_size = app.conf.get('PROFILE_BATCH_SIZE', 500)
+    pt = profile.__table__
+    count = 0
+    try:
+        with app.session_scope() as session:
+            conn = session.connection()
+            if masterids is None:
+                session.execute(delete(pt))
+                masterids = [x[0] for x in session.query(master.masterid).order_by(master.masterid.asc())]
+            else:
+                masterids = sorted(set(x for x in masterids if x))
+            for i in range(0, len(masterids), batch_size):
+                batch = masterids[i:i+batch_size]
+                session.execute(delete(pt).where(pt.c.masterid.in_(batch)))
+                rows = queries.build_profiles(conn, batch)
+                if rows:
+                    session.execute(insert(pt), rows)
+                count += len(rows)
+    except Exception as err:
+        raise RefreshProfilesException("Problem refreshing journal profiles: %s" % err)
+    logger.info("Refreshed %s journal profiles" % count)
+    return count
+
+
+def task_publish_snapshot():
+    # Writes a new read-only snapshot of the database for journalsservice
+    # replicas in snapshot mode.  Does nothing unless SNAPSHOT_DIRECTORY is
+    # set; returns the path of the snapshot.
+    directory = app.conf.get('SNAPSHOT_DIRECTORY', None)
+    if not directory:
+        return None
+    try:
+        with app.session_scope() as session:
+            (path, counts) = write_snapshot(session.connection(), directory,
+                                            batch_size=app.conf.get('SNAPSHOT_BATCH_SIZE', 5000),
+                                            keep=app.conf.get('SNAPSHOT_KEEP', 3))
+    except Exception as err:
+        raise PublishSnapshotException("Problem publishing database snapshot: %s" % err)
+    logger.info("Published snapshot %s with %s rows" % (path, sum(counts.values())))
+    return path
+
 
 @app.task(queue='load-datafiles')
 def task_db_load_abbrevs(recs):
+    # returns the number of abbreviations added
+    loaded = 0
     with app.session_scope() as session:
         if recs:
             for r in recs:
@@ -197,15 +324,19 @@ def task_db_load_abbrevs(recs):
                     session.add(abbrevs(masterid=r[0],
                                         abbreviation=r[1]))
                     session.commit()
+                    loaded += 1
                 except Exception as err:
                     logger.debug("Problem with abbreviation: %s,%s" %
                                 (r[0], r[1]))
         else:
             logger.info("There were no abbreviations to load!")
+    return loaded
 
 
 @app.task(queue='load-datafiles')
 def task_db_load_identifier(recs, idtype='ISSN_print'):
+    # returns the number of identifiers added
+    loaded = 0
     with app.session_scope() as session:
         if recs:
             for r in recs:
@@ -214,6 +345,7 @@ def task_db_load_identifier(recs, idtype='ISSN_print'):
                                        id_type=idtype,
                                        id_value=r[1]))
                     session.commit()
+                    loaded += 1
                 except Exception as err:
                     logger.debug("Duplicate %s skipped: %s,%s" %
                                 (idtype, r[0], r[1]))
@@ -221,6 +353,7 @@ def task_db_load_identifier(recs, idtype='ISSN_print'):
                     session.flush()
         else:
             logger.info("No %s loaded!" % idtype)
+    return loaded
 
 
 @app.task(queue='load-datafiles')
@@ -341,15 +474,30 @@ def task_db_load_raster(recs):
 
 @app.task(queue='load-datafiles')
 def task_db_get_bibstem_masterid():
+    # with MASTERDICT_CACHE_FILE set, the dictionary is served from the
+    # cache file (a read-only MasterDict) until master changes
+    cachefile = None
+    if config.get('MASTERDICT_CACHE_FILE', None):
+        cachefile = JDB_DATA_DIR + '/' + config.get('MASTERDICT_CACHE_FILE')
     dictionary = {}
     with app.session_scope() as session:
         try:
+            if cachefile:
+                signature = queries.get_master_signature(session.connection())
+                cached = load_masterdict(cachefile, signature)
+                if cached is not None:
+                    return cached
             for record in session.query(master.masterid,
                                         master.bibstem):
                 dictionary[record.bibstem] = record.masterid
         except Exception as err:
             logger.error("Failed to read bibstem-masterid dict from table master: %s" % err)
             raise DBReadException("Could not read from master: %s" % err)
+    if cachefile:
+        try:
+            write_masterdict(cachefile, dictionary, signature)
+        except Exception as err:
+            logger.warning("Unable to write masterdict cache %s: %s" % (cachefile, err))
     return dictionary
 
 
@@ -398,6 +546,32 @@ def task_db_load_refsource(masterid, refsrc):
     return
 
 
+@app.task(queue='load-datafiles')
+def task_db_load_refsources(recs):
+    # recs are (masterid, RefSource.toJSON()) pairs, so they can be sent
+    # to a worker; returns the number of refsource rows added
+    loaded = 0
+    if not recs:
+        logger.error("No refsource data to load!")
+        return loaded
+    with app.session_scope() as session:
+        for (masterid, refsrc) in recs:
+            if not (masterid and refsrc):
+                logger.error("No refsource data to load for masterid %s!" % masterid)
+                continue
+            try:
+                session.add(refsource(masterid=masterid,
+                                      refsource_list=json.dumps(refsrc)))
+                session.commit()
+                loaded += 1
+            except Exception as err:
+                logger.warning("Error adding refsources for %s: %s" %
+                               (masterid, err))
+                session.rollback()
+                session.commit()
+    return loaded
+
+
 @app.task(queue='load-datafiles')
 def task_db_insert_nonindexed_bibstems(nonindexed_dict):
     with app.session_scope() as session:
@@ -487,6 +661,9 @@ def task_export_table_data(tablename, results):
 
 @app.task(queue='load-datafiles')
 def task_checkout_table(tablename, results):
+    # gspread and the Google API clients are imported only by the commands
+    # that use Sheets
+    from journalsmanager.sheetmanager import SpreadsheetManager
 
     if tablename.lower() not in app.conf.EDITABLE_TABLES:
         raise InvalidTableException("Tablename %s is not valid" % tablename)
@@ -526,6 +703,7 @@ def task_checkout_table(tablename, results):
             try:
                 fileurl = 'https://docs.google.com/spreadsheets/d/' + sheet.sheetid
                 message = 'Table %s checked out to %s' % (tablename, fileurl)
+                from journalsmanager.slackhandler import SlackPublisher
                 slack = SlackPublisher()
                 slack.publish(message)
             except Exception as err:
@@ -535,7 +713,8 @@ def task_checkout_table(tablename, results):
 
 
 @app.task(queue='load-datafiles')
-def task_checkin_table(tablename, masterdict, delete_flag=False):
+def task_checkin_table(tablename, masterdict=None, delete_flag=False):
+    from journalsmanager.sheetmanager import SpreadsheetManager
 
     if tablename.lower() not in app.conf.EDITABLE_TABLES:
         raise InvalidTableException("Tablename %s is not valid" % tablename)
@@ -570,12 +749,18 @@ def task_checkin_table(tablename, masterdict, delete_flag=False):
 
 
 @app.task(queue='load-datafiles')
-def task_update_table(checkin, masterdict):
+def task_update_table(checkin, masterdict=None, refresh=True):
+    # masterdict is looked up here when it isn't passed in, so it needn't
+    # be sent with the task; refresh=False skips the profile refresh,
+    # classic export and snapshot, for a caller that runs them itself
+    if masterdict is None:
+        masterdict = task_db_get_bibstem_masterid()
     try:
         tablename = checkin['tablename']
         editid = checkin['editid']
         checkin_data = checkin['data']
         create = list()
+        created_ids = list()
         modify = list()
         discard = list()
         failure = list()
@@ -659,6 +844,7 @@ def task_update_table(checkin, masterdict):
                         setattr(data, k, v)
                     session.add(data)
                     session.commit()
+                    created_ids.append(getattr(data, 'masterid', None))
                 except Exception as err:
                     logger.warning('problem with commit: %s' % err)
                     failure.append(r)
@@ -684,6 +870,18 @@ def task_update_table(checkin, masterdict):
 
         logger.info('Total records from sheet: %s New; %s Updates; %s Ignored; %s Problematic' % (len(create), len(modify), len(discard), len(failure)))
 
+        # committed rows change the served profiles even if others failed
+        if refresh and (modify or created_ids):
+            try:
+                if editid > 0:
+                    with app.session_scope() as session:
+                        changed = get_edit_masterids(session, editid, PROFILE_TABLES)
+                    task_refresh_profiles(changed.union(created_ids))
+                else:
+                    task_refresh_profiles()
+            except Exception as err:
+                logger.error('Unable to refresh journal profiles: %s' % err)
+
         # Finishing up: mark table as failed or completed, re-export failed
         # rows, and send messages to slack
         if len(failure) != 0:
@@ -693,6 +891,7 @@ def task_update_table(checkin, masterdict):
             if editid > 0:
                 task_setstatus(editid, status)
                 message = 'Table %s checked in from Sheets with status: %s' % (tablename, status)
+                from journalsmanager.slackhandler import SlackPublisher
                 slack = SlackPublisher()
                 slack.publish(message)
         except Exception as err:
@@ -710,12 +909,21 @@ def task_update_table(checkin, masterdict):
             except Exception as err:
                 logger.warning('unable to re-export failed rows: %s' % err)
         else:
-            if status == 'completed':
+            if refresh and status == 'completed':
                 try:
-                    task_export_classic_files()
+                    if editid > 0:
+                        task_export_classic_delta(editid, created_ids)
+                    else:
+                        task_export_classic_files()
                 except Exception as err:
                     raise TableCheckinException("Failed to export classic files: %s" % err)
 
+        if refresh and (modify or created_ids):
+            try:
+                task_publish_snapshot()
+            except Exception as err:
+                logger.error('Unable to publish database snapshot: %s' % err)
+
 
     except Exception as err:
         raise UpdateTableException(err)
@@ -743,44 +951,74 @@ def task_export_autocomplete_data():
 
 
 @app.task(queue='load-datafiles')
-def task_revert_editid(idno):
+def task_export_holdings_index():
     try:
+        count = export_holdings_index()
+    except Exception as err:
+        logger.error("Failed to export holdings index: %s" % err)
+    else:
+        logger.info("Holdings index exported for %s volumes" % count)
+
+
+@app.task(queue='load-datafiles')
+def task_revert_editid(idno, dry_run=False):
+    revertid = None
+    try:
+        idno = int(idno)
         with app.session_scope() as session:
-            result = session.query(editctrl.editid, editctrl.editstatus, editctrl.tablename).filter_by(editid=idno).all()
+            result = session.query(editctrl.editid, editctrl.editstatus, editctrl.tablename, editctrl.editfileid).filter_by(editid=idno).all()
         if len(result) == 0:
             raise RevertException("History id %s does not exist" % idno)
         elif len(result) > 1:
             raise RevertException("Multiple revisions (%s) with id %s!" % (len(result), idno))
         elif len(result) == 1:
-            # you will read from tablename_hist and write to tablename
-            tablename = result[0][2]
-            tablehist = tablename + '_hist'
-            t = TABLES[tablename]
-            th = TABLES[tablehist]
-            tk = TABLE_UNIQID[tablename]
+            # only a deletion removes live rows, so only a deletion
+            # needs rows inserted back
+            reinsert = result[0][3] in DELETION_EDITFILEIDS
+            if not dry_run:
+                # the revert is an edit of its own, so the rows it
+                # overwrites are archived and the change feed reports it
+                with app.session_scope() as session:
+                    new_status = editctrl(tablename=result[0][2],
+                                          editstatus='active',
+                                          editfileid=REVERT_EDITFILEID)
+                    session.add(new_status)
+                    session.commit()
+                    revertid = new_status.editid
             with app.session_scope() as session:
-                revert_data = session.query(th).filter_by(editid=idno).all()
-                for r in revert_data:
-                    uid = getattr(r,tk)
-                    d = session.query(t).filter(t.__table__.c[tk]==uid).first()
-                    for k in d.__table__.columns.keys():
-                        dnew = getattr(r,k)
-                        setattr(d,k,dnew)
-                    try:
-                        session.commit()
-                    except Exception as err:
-                        session.rollback()
-                        logger.warning("Unable to rollback editid %s, record %s: %s" % (idno, uid, err))
+                counts = revert_edit(session, idno, reinsert=reinsert, dry_run=dry_run, revertid=revertid)
+                if dry_run:
+                    session.rollback()
+            for tablename, c in counts.items():
+                logger.info("Revert editid %s, table %s: %s rows updated, %s rows inserted%s" % (idno, tablename, c['updated'], c['inserted'], ' (dry run)' if dry_run else ''))
+            if reinsert:
+                logger.info("Revert editid %s: refsource, rastervolume and completeness rows are not archived, reload them from their files" % idno)
 
     except Exception as err:
+        if revertid:
+            task_setstatus(revertid, 'failed')
         raise RevertEditHistoryException(err)
     else:
+        if dry_run:
+            return counts
         try:
+            task_setstatus(revertid, 'completed')
             task_setstatus(idno, 'reverted')
         except Exception as err:
             raise DBCommitException("Could not update editstatus: %s" % err)
         else:
-            logger.info("Revision %s in editcontrol has been reverted" % idno)
+            logger.info("Revision %s in editcontrol has been reverted by revision %s" % (idno, revertid))
+        try:
+            with app.session_scope() as session:
+                changed = get_edit_masterids(session, idno, PROFILE_TABLES)
+            task_refresh_profiles(changed)
+        except Exception as err:
+            logger.error("Unable to refresh journal profiles: %s" % err)
+        try:
+            task_publish_snapshot()
+        except Exception as err:
+            logger.error("Unable to publish database snapshot: %s" % err)
+        return counts
 
 def task_cancel_checkout(idno):
     try:
@@ -804,39 +1042,38 @@ def task_abandon_active_checkouts():
 
 
 def task_load_completeness_data():
+    infile = app.conf.get('JDB_DATA_DIR', '/') + app.conf.get('COMPLETENESS_JSON_FILE', '/error.dat')
+    critc = app.conf.get('COMPLETENESS_CRIT_VALUE', 0.0)
+    batch_size = app.conf.get('COMPLETENESS_BATCH_SIZE', 1000)
+    masterdict = task_db_get_bibstem_masterid()
+
     try:
-        infile = app.conf.get('JDB_DATA_DIR', '/') + app.conf.get('COMPLETENESS_JSON_FILE', '/error.dat')
-        critc = app.conf.get('COMPLETENESS_CRIT_VALUE', 0.0)
-        with open(infile, 'r') as fj:
-            completeness_data = json.load(fj)
+        with app.session_scope() as session:
+            # journals are read from the file one at a time, so memory
+            # is bounded by the batch size rather than the file size
+            result = load_completeness(session, iter_json_array(infile), masterdict,
+                                       critc=critc, batch_size=batch_size)
     except Exception as err:
         raise LoadCompletenessDataException("Problem loading completeness data from JSON file: %s" % err)
-    else:
-        for d in completeness_data:
-            fraction = d.get('title_completeness_fraction', 0)
-            bibstem = d.get('bibstem', None)
-            volume_year = json.dumps(d.get("volume_by_year", '{}'))
-            details = d.get("completeness_details", [])
-            new_details = json.dumps({"completeness_by_volume": details})
-                      
-            if fraction >= critc:
-                try:
-                    with app.session_scope() as session:
-                        q = session.query(master).filter(master.bibstem==bibstem).all()
-                        if len(q) != 1:
-                            logger.warn("Error: There should be exactly one record that matches the bibstem '%s' in master, not %s!" % (bibstem, len(q)))
-                        else:
-                            r = q[0]
-                            setattr(r, 'completeness_fraction', fraction)
-                            setattr(r, 'completeness_details', new_details)
-                            setattr(r, 'year', volume_year)
-                            session.commit()
-                except Exception as err:
-                    session.rollback()
-                    session.flush()
-                    logger.warn("Can't write completeness data for %s: %s" % (bibstem, err))
+    (seen, missing, duplicates, skipped) = (result['updated'], result['missing'], result['duplicates'], result['skipped'])
 
-def task_delete_masterid(masterid):
+    logger.info("Completeness data: %s journals updated, %s below %s, %s not in master, %s duplicated" % (len(seen), skipped, critc, len(missing), len(duplicates)))
+    if missing:
+        logger.warning("Completeness bibstems not in master: %s" % ", ".join([str(x) for x in missing]))
+    if duplicates:
+        logger.warning("Completeness bibstems listed more than once (last entry used): %s" % ", ".join(duplicates))
+
+    try:
+        task_refresh_profiles(seen)
+    except Exception as err:
+        logger.error("Unable to refresh journal profiles: %s" % err)
+
+    try:
+        task_publish_snapshot()
+    except Exception as err:
+        logger.error("Unable to publish database snapshot: %s" % err)
+
+def task_delete_masterids(masterids, editfileid=DELETION_EDITFILEIDS[0]):
     editid = None
     try:
         with app.session_scope() as session:
@@ -847,49 +1084,21 @@ def task_delete_masterid(masterid):
             else:
                 new_status = editctrl(tablename="master",
                                       editstatus="active",
-                                      editfileid="Command line deletion")
+                                      editfileid=editfileid)
                 session.add(new_status)
                 session.commit()
                 editid = new_status.editid
 
-        for dbname in ['names', 'abbrevs', 'idents', 'raster', 'titlehistory', 'refsource', 'master']:
-            db = TABLES.get(dbname, None)
-            dbhist = TABLES.get(dbname+'_hist', None)
-
-            backup_rows = []
-            delete_rows = []
-            with app.session_scope() as session:
-                q = session.query(db).filter(db.masterid==masterid).all()
-                if len(q) > 0:
-                    for r in q:
-                        data = {}
-                        for k in r.__table__.columns.keys():
-                            data[k] = getattr(r,k)
-                        data['editid'] = editid
-                        backup_rows.append(data)
-                    delete_rows.append(masterid)
-
-            if backup_rows:
-                try:
-                    with app.session_scope() as session:
-                        if dbname != 'refsource':
-                            for row in backup_rows:
-                                data = dbhist()
-                                for k,v in row.items():
-                                    setattr(data, k, v)
-                                session.add(data)
-                            session.commit()
-                        for row in delete_rows:
-                            session.query(db).filter(db.masterid==row).delete()
-                        session.commit()
-                except Exception as err:
-                    session.rollback()
-                    session.flush()
-                    raise Exception("Well, what? %s" % err)
-            else:
-                logger.debug("Nothing for table %s" % dbname)
+        with app.session_scope() as session:
+            counts = archive_and_delete(session, list(masterids), editid)
+        logger.debug("Deleted masterids %s: %s" % (masterids, counts))
         task_setstatus(editid, "completed")
     except Exception as err:
         if editid:
             task_setstatus(editid, "failed")
-        raise Exception("Failed to delete masterid %s: %s" % (masterid, err))
+        raise DeleteBibstemException("Failed to delete masterids %s: %s" % (masterids, err))
+    return editid
+
+
+def task_delete_masterid(masterid):
+    return task_delete_masterids([masterid])
@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+import unittest
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../../'))
+
+# imported only by the commands that need them
+HEAVY_MODULES = ['gspread', 'googleapiclient', 'bs4', 'html5lib', 'chardet']
+
+# run.py path modules that don't need the Celery app, and the most time
+# (seconds) each may take to import in a fresh interpreter once SETUP has
+# loaded adsputils and SQLAlchemy; measured at about 0.013, 0.002, 0.003,
+# 0.05-0.1 and 0.05-0.1, so a budget is only missed by a new import of
+# some weight
+IMPORT_BUDGETS = [('journalsmanager.utils', 0.1),
+                  ('journalsmanager.masterdict', 0.02),
+                  ('journalsmanager.pipeline', 0.03),
+                  ('journalsdb.queries', 0.5),
+                  ('journalsdb.edits', 0.5)]
+
+# run before the import being checked: the Celery app is replaced by a
+# stand-in, so tasks can be imported without a broker or a celery that
+# adsputils supports, and where adsputils itself can't be imported the
+# few functions the run.py path uses at import time are filled in
+SETUP = '''
+import datetime, logging, sys, types
+import sqlalchemy
+try:
+    import adsputils
+except ImportError:
+    adsputils = sys.modules['adsputils'] = types.ModuleType('adsputils')
+for (name, value) in [('load_config', lambda **kwargs: {}),
+                      ('setup_logging', lambda name, **kwargs: logging.getLogger(name)),
+                      ('get_date', datetime.datetime.utcnow),
+                      ('UTCDateTime', sqlalchemy.DateTime)]:
+    if not hasattr(adsputils, name):
+        setattr(adsputils, name, value)
+
+class ADSJournalsCelery(object):
+
+    def __init__(self, name, **kwargs):
+        self.conf = types.SimpleNamespace()
+        self.logger = logging.getLogger(name)
+        self.exchange = None
+
+    def task(self, **kwargs):
+        return lambda func: func
+
+sys.modules['journalsmanager.app'] = types.ModuleType('journalsmanager.app')
+sys.modules['journalsmanager.app'].ADSJournalsCelery = ADSJournalsCelery
+'''
+
+
+def run_import(statement, importtime=False):
+    # (cumulative import time per module in seconds, modules loaded) for
+    # an import statement run after SETUP in a fresh interpreter; only
+    # the modules the statement itself loaded are listed
+    code = SETUP + '\nbefore = set(sys.modules)\n%s\nprint(",".join(sorted(set(sys.modules) - before)))\n' % statement
+    options = ['-X', 'importtime'] if importtime else []
+    proc = subprocess.run([sys.executable] + options + ['-c', code],
+                          cwd=proj_home, capture_output=True, text=True)
+    if proc.returncode:
+        raise AssertionError('%s failed:\n%s' % (statement, proc.stderr[-2000:]))
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:'):
+            (self_us, cumulative_us, name) = line[len('import time:'):].split('|')
+            if cumulative_us.strip().isdigit():
+                times[name.strip()] = int(cumulative_us) / 1e6
+    return (times, proc.stdout.strip().splitlines()[-1].split(','))
+
+
+class TestImports(unittest.TestCase):
+
+    def test_import_budgets(self):
+        for (module, budget) in IMPORT_BUDGETS:
+            # the best of three, so a busy machine doesn't fail the test
+            seconds = min(run_import('import %s' % module, importtime=True)[0][module] for i in range(3))
+            self.assertLess(seconds, budget, '%s took %.3fs to import' % (module, seconds))
+
+    def test_light_modules(self):
+        for (module, budget) in IMPORT_BUDGETS:
+            (times, modules) = run_import('import %s' % module)
+            self.assertEqual([m for m in HEAVY_MODULES if m in modules], [], '%s imports heavy modules' % module)
+
+    def test_run(self):
+        (times, modules) = run_import('import run')
+        self.assertIn('journalsmanager.tasks', modules)
+        self.assertEqual([m for m in HEAVY_MODULES if m in modules], [], 'run.py imports heavy modules')
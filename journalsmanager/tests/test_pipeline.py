@@ -0,0 +1,79 @@
+import logging
+import threading
+import unittest
+
+from celery import Celery
+from mock import patch
+from journalsmanager import pipeline
+from journalsmanager.pipeline import Stage
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_dependencies_and_results(self):
+        stages = [Stage('master', lambda: {'ApJ': 1}, []),
+                  Stage('publisher', lambda master: 'AAS', ['master']),
+                  Stage('titlehistory', lambda master, publisher: (master['ApJ'], publisher), ['master', 'publisher'])]
+        (reports, results) = pipeline.run_stages(stages, max_workers=2)
+        self.assertEqual([r.status for r in reports], ['ok', 'ok', 'ok'])
+        self.assertEqual(results['titlehistory'], (1, 'AAS'))
+
+    def test_independent_stages_overlap(self):
+        # each waits for the other to start, so they must run concurrently
+        barrier = threading.Barrier(2, timeout=5)
+        stages = [Stage('master', lambda: None, []),
+                  Stage('abbrevs', lambda master: barrier.wait(), ['master']),
+                  Stage('raster', lambda master: barrier.wait(), ['master'])]
+        (reports, results) = pipeline.run_stages(stages, max_workers=2)
+        self.assertEqual([r.status for r in reports], ['ok', 'ok', 'ok'])
+
+    def test_failure_isolation(self):
+        def fail(master):
+            raise Exception('bad raster file')
+        stages = [Stage('master', lambda: None, []),
+                  Stage('raster', fail, ['master']),
+                  Stage('abbrevs', lambda master: 'loaded', ['master']),
+                  Stage('profiles', lambda raster, abbrevs: None, ['raster', 'abbrevs'])]
+        (reports, results) = pipeline.run_stages(stages)
+        self.assertEqual([(r.name, r.status) for r in reports],
+                         [('master', 'ok'), ('raster', 'failed'), ('abbrevs', 'ok'), ('profiles', 'skipped')])
+        self.assertEqual(str(reports[1].error), 'bad raster file')
+        self.assertEqual(results['abbrevs'], 'loaded')
+
+    def test_check_stages(self):
+        with self.assertRaises(ValueError):
+            pipeline.check_stages([Stage('a', None, ['b']), Stage('b', None, ['a'])])
+        with self.assertRaises(ValueError):
+            pipeline.check_stages([Stage('a', None, ['missing'])])
+
+
+class TestChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Celery('test_pipeline')
+        self.app.conf.task_always_eager = True
+        self.loaded = []
+
+        @self.app.task(queue='load-datafiles')
+        def load_idents(recs, idtype):
+            if ('bad', 'issn') in recs:
+                raise Exception('bad record')
+            self.loaded.extend((r[0], idtype, r[1]) for r in recs)
+            return len(recs)
+
+        self.task = load_idents
+
+    def test_dispatch_and_collect(self):
+        recs = [(i, 'issn%s' % i) for i in range(7)]
+        result = pipeline.dispatch_chunks(self.task, recs, 3, 'ISSN_print')
+        summary = pipeline.collect_chunks(result, 'ISSN_print')
+        self.assertEqual(summary, {'chunks': 3, 'loaded': 7, 'errors': []})
+        self.assertEqual(sorted(self.loaded), sorted((r[0], 'ISSN_print', r[1]) for r in recs))
+
+    def test_failed_chunk(self):
+        recs = [(1, 'a'), (2, 'b'), ('bad', 'issn'), (3, 'c')]
+        # the eager trace logs the failure with its traceback
+        with patch.object(logging.getLogger('celery.app.trace'), 'disabled', True):
+            summary = pipeline.collect_chunks(pipeline.dispatch_chunks(self.task, recs, 2, 'Crossref'), 'Crossref')
+        self.assertEqual((summary['chunks'], summary['loaded']), (2, 2))
+        self.assertEqual([str(e) for e in summary['errors']], ['bad record'])
@@ -4,5 +4,328 @@ import os
 import unittest
 import json
 import re
+import shutil
+import stat
+import tempfile
 import mock
 from mock import patch
+
+from journalsmanager import utils
+from journalsmanager.masterdict import MasterDict, load_masterdict, write_masterdict
+
+
+def parse_bibcode(bibcode):
+    # one bibcode sliced with string operations, the reference the block
+    # parser is checked against; {} if it isn't a string of at least 19
+    # characters
+    if not isinstance(bibcode, str) or len(bibcode) < 19:
+        return {}
+    year = bibcode[0:4]
+    stem = bibcode[4:9]
+    volm = bibcode[9:13]
+    if volm in utils.BIBSTEM_VOLUMES:
+        stem = year + stem + volm
+        volm = None
+    return {"bibcode": bibcode, "year": year, "bibstem": stem,
+            "volume": volm, "qualifier": bibcode[13], "page": bibcode[14:18],
+            "initial": bibcode[18]}
+
+
+class TestAtomicWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.tmpdir, 'export.dat')
+        with open(self.outfile, 'w') as f:
+            f.write('old data\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('journalsmanager.utils.chowner')
+    def test_replaces_file(self, mock_chowner):
+        os.chmod(self.outfile, 0o664)
+        with utils.atomic_write(self.outfile) as f:
+            f.write('new data\n')
+        with open(self.outfile, 'r') as f:
+            self.assertEqual(f.read(), 'new data\n')
+        # the replaced file's mode is kept
+        self.assertEqual(stat.S_IMODE(os.stat(self.outfile).st_mode), 0o664)
+        self.assertEqual(os.listdir(self.tmpdir), ['export.dat'])
+        self.assertFalse(mock_chowner.called)
+
+    @patch('journalsmanager.utils.chowner')
+    def test_read_only_export(self, mock_chowner):
+        with utils.atomic_write(self.outfile, mode=0o444, owner=True) as f:
+            f.write('new data\n')
+        self.assertEqual(stat.S_IMODE(os.stat(self.outfile).st_mode), 0o444)
+        self.assertTrue(mock_chowner.called)
+
+    def test_new_file_mode(self):
+        newfile = os.path.join(self.tmpdir, 'new.dat')
+        umask = os.umask(0o022)
+        try:
+            with utils.atomic_write(newfile) as f:
+                f.write('data\n')
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(newfile).st_mode), 0o644)
+
+    @patch('journalsmanager.utils.chowner')
+    def test_failure_keeps_old_file(self, mock_chowner):
+        with self.assertRaises(ValueError):
+            with utils.atomic_write(self.outfile) as f:
+                f.write('partial')
+                raise ValueError('export failed')
+        with open(self.outfile, 'r') as f:
+            self.assertEqual(f.read(), 'old data\n')
+        self.assertEqual(os.listdir(self.tmpdir), ['export.dat'])
+        self.assertFalse(mock_chowner.called)
+
+
+class TestPatchExportFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.tmpdir, 'bibstems.dat')
+        with open(self.outfile, 'w') as f:
+            f.write(' 3\n')
+            f.write('....AJ.......\tR\tAstronomical Journal\n')
+            f.write('....ApJ......\tR\tAstrophysical Journal\n')
+            f.write('....PASP.....\tR\tPASP\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @patch('journalsmanager.utils.chowner')
+    def test_patch_replaces_and_merges(self, mock_chowner):
+        lines = ['....MNRAS....\tR\tMonthly Notices\n',
+                 '....ApJ......\tR\tThe Astrophysical Journal\n']
+        nrows = utils.patch_export_file(self.outfile, lines,
+                                        set(['ApJ', 'MNRAS']),
+                                        header=lambda n: ' %s\n' % n)
+        self.assertEqual(nrows, 4)
+        with open(self.outfile, 'r') as f:
+            self.assertEqual(f.read(),
+                             ' 4\n'
+                             '....AJ.......\tR\tAstronomical Journal\n'
+                             '....ApJ......\tR\tThe Astrophysical Journal\n'
+                             '....MNRAS....\tR\tMonthly Notices\n'
+                             '....PASP.....\tR\tPASP\n')
+
+    @patch('journalsmanager.utils.chowner')
+    def test_patch_removes_deleted(self, mock_chowner):
+        utils.patch_export_file(self.outfile, [], set(['AJ']),
+                                header=lambda n: ' %s\n' % n)
+        with open(self.outfile, 'r') as f:
+            self.assertEqual(f.readline(), ' 2\n')
+            self.assertNotIn('AJ.', f.read())
+
+
+class TestPatchClassicExports(unittest.TestCase):
+
+    FILES = ['BIBSTEMS_FILE', 'ISSN_JOURNAL_FILE', 'JOURNAL_ISSN_FILE',
+             'BIBSTEM_PUBLISHER_FILE', 'ISSN_IDENTIFIER', 'BIBSTEM_CANONICAL_ABBREV']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def journal(self, bibstem, name, issn, publisher, abbrev):
+        # the rows get_classic_export_rows returns for one journal
+        return {'bibstems': [{'bibstem': bibstem, 'pubtype': 'Journal', 'refereed': 'yes', 'pubname': name}],
+                'issns': [{'bibstem': bibstem.ljust(5, '.'), 'issn': issn, 'name': name}],
+                'publishers': [{'bibstem': bibstem.ljust(5, '.'), 'publisher': publisher}],
+                'issn_identifiers': [{'bibstem': bibstem, 'id_type': 'ISSN_print', 'id_value': issn}],
+                'abbreviations': [{'bibstem': bibstem, 'abbrev': abbrev}]}
+
+    def rowsets(self, journals):
+        rowsets = dict((k, []) for k in ['bibstems', 'issns', 'publishers', 'issn_identifiers', 'abbreviations'])
+        for j in journals:
+            for (k, rows) in j.items():
+                rowsets[k].extend(rows)
+        return rowsets
+
+    def export_all(self, datadir, rowsets):
+        # the exports back up the current file first, so it has to exist
+        for name in self.FILES:
+            open(datadir + '/' + utils.config.get(name), 'a').close()
+        with patch('journalsmanager.utils.JDB_DATA_DIR', datadir):
+            utils.export_to_bibstemsdat(rowsets['bibstems'])
+            utils.export_issns(rowsets['issns'])
+            utils.export_publishers(rowsets['publishers'])
+            utils.export_issn_identifiers(rowsets['issn_identifiers'])
+            utils.export_abbreviations(rowsets['abbreviations'])
+
+    def read_all(self, datadir):
+        contents = {}
+        for name in self.FILES:
+            with open(datadir + '/' + utils.config.get(name), 'r') as f:
+                contents[name] = f.read()
+        return contents
+
+    @patch('journalsmanager.utils.chowner')
+    def test_patch_matches_full_export(self, mock_chowner):
+        aj = self.journal('AJ', 'Astronomical Journal', '0004-6256', 'IOP', 'Astron. J.')
+        apj = self.journal('ApJ', 'Astrophysical Journal', '0004-637X', 'IOP', 'Astrophys. J.')
+        mnras = self.journal('MNRAS', 'Monthly Notices', '0035-8711', 'OUP', 'Mon. Not. R. Astron. Soc.')
+        pasp = self.journal('PASP', 'PASP', '0004-6280', 'IOP', 'Publ. Astron. Soc. Pac.')
+        new_apj = self.journal('ApJ', 'The Astrophysical Journal', '1538-4357', 'AAS', 'Astrophys. J.')
+        aa = self.journal('A&A', 'Astronomy and Astrophysics', '0004-6361', 'EDP', 'Astron. Astrophys.')
+
+        # the query results are in no particular order
+        patched = os.path.join(self.tmpdir, 'patched')
+        full = os.path.join(self.tmpdir, 'full')
+        os.mkdir(patched)
+        os.mkdir(full)
+        self.export_all(patched, self.rowsets([pasp, mnras, apj, aj]))
+        with patch('journalsmanager.utils.JDB_DATA_DIR', patched):
+            utils.patch_classic_exports(self.rowsets([new_apj, aa]), set(['ApJ', 'MNRAS', 'A&A']))
+        self.export_all(full, self.rowsets([pasp, aa, aj, new_apj]))
+        self.assertEqual(self.read_all(patched), self.read_all(full))
+
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.tmpdir, 'completeness_export.json')
+        self.data = [{'bibstem': 'ApJ', 'title_completeness_fraction': 0.98,
+                      'completeness_details': [{'volume': str(v), 'completeness_fraction': 1.0} for v in range(50)]},
+                     {'bibstem': 'A&A', 'title_completeness_fraction': 0.5,
+                      'completeness_details': []},
+                     12, 'Astronomische Nachrichten', None]
+        with open(self.infile, 'w') as f:
+            f.write(' [\n' + ',\n '.join([json.dumps(d) for d in self.data]) + '\n]\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fallback_reader(self):
+        with patch('journalsmanager.utils.ijson', None):
+            for chunk_size in [1, 7, 65536]:
+                items = list(utils.iter_json_array(self.infile, chunk_size=chunk_size))
+                self.assertEqual(items, self.data)
+
+    def test_fallback_reader_not_array(self):
+        with open(self.infile, 'w') as f:
+            f.write('{"bibstem": "ApJ"}')
+        with patch('journalsmanager.utils.ijson', None):
+            with self.assertRaises(ValueError):
+                list(utils.iter_json_array(self.infile))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestHoldingsIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.tmpdir, 'holdings_index.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_and_lookup(self):
+        from journalsdb.holdingsindex import HoldingsIndex, write_index
+        bibcodes = ['2019ApJ...880..100S\n',
+                    '2019ApJ...880....9K\n',
+                    '2019ApJ...880L..12B\n',
+                    '2019ApJ...880..100T\n',
+                    '2019ApJ...881....1A\n',
+                    '2001sdss.conf...45M\n',
+                    '2018MNRAS.48112345X\n',
+                    '2020PhRvD.101h4001X\n',
+                    '2020PhRvD.101a..12X\n',
+                    'garbage\n']
+        holdings = utils.build_holdings_index(bibcodes)
+        self.assertEqual(holdings[('ApJ', '880')], set(['9', '100', 'L12']))
+        # pages over 9999 start in the qualifier column
+        self.assertEqual(holdings[('MNRAS', '481')], set(['12345']))
+        # Phys. Rev. article ids, as the search API's page field has them
+        self.assertEqual(holdings[('PhRvD', '101')], set(['084001', '010012']))
+        self.assertEqual(holdings[('2001sdss.conf', None)], set(['45']))
+        self.assertEqual(write_index(self.outfile, holdings), 5)
+
+        index = HoldingsIndex(self.outfile, refresh_interval=0)
+        self.assertEqual(index.lookup('ApJ', '880'), ['9', '100', 'L12'])
+        self.assertEqual(index.lookup('ApJ', '881'), ['1'])
+        self.assertEqual(index.lookup('2001sdss.conf', None), ['45'])
+        self.assertIsNone(index.lookup('ApJ', '882'))
+        self.assertIsNone(index.lookup('AJ', '1'))
+        self.assertFalse(index.maybe_refresh())
+
+        write_index(self.outfile, {('AJ', '1'): ['3']})
+        self.assertTrue(index.maybe_refresh())
+        self.assertEqual(index.lookup('AJ', '1'), ['3'])
+        self.assertIsNone(index.lookup('ApJ', '880'))
+
+
+class TestParseBibcodes(unittest.TestCase):
+
+    bibcodes = ['2019ApJ...880..100S',
+                '2019ApJ...880L..12B',
+                '2001sdss.conf...45M',
+                '1999A&A...341L..1PQ',
+                '2020Natur.577..364W',
+                '2019ApJ...880',
+                '2019Jéunk..12...34Z',
+                None,
+                '']
+
+    def test_single(self):
+        self.assertEqual(utils.parse_bibcodes('2019ApJ...880L..12B'),
+                         {'bibcode': '2019ApJ...880L..12B', 'year': '2019',
+                          'bibstem': 'ApJ..', 'volume': '.880', 'qualifier': 'L',
+                          'page': '..12', 'initial': 'B'})
+        self.assertEqual(utils.parse_bibcodes('2001sdss.conf...45M')['bibstem'], '2001sdss.conf')
+        self.assertIsNone(utils.parse_bibcodes('2001sdss.conf...45M')['volume'])
+        self.assertEqual(utils.parse_bibcodes('2019ApJ...880'), {})
+        self.assertEqual(utils.parse_bibcodes(None), {})
+
+    def test_block_matches_scalar(self):
+        columns = utils.parse_bibcode_block(self.bibcodes)
+        self.assertEqual(columns['valid'], [True, True, True, True, True, False, True, False, False])
+        for (i, bibcode) in enumerate(self.bibcodes):
+            expected = parse_bibcode(bibcode)
+            for name in ['bibcode', 'year', 'bibstem', 'volume', 'qualifier', 'page', 'initial']:
+                self.assertEqual(columns[name][i], expected.get(name, None))
+
+    def test_iter_parsed_bibcodes(self):
+        parsed = list(utils.iter_parsed_bibcodes(self.bibcodes, block_size=2))
+        self.assertEqual([p['bibcode'] for p in parsed], [b for b in self.bibcodes if parse_bibcode(b)])
+
+
+class TestMasterDict(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'masterdict.bin')
+        self.dictionary = {'ApJ': 1, 'A&A': 2, 'MNRAS': 3, 'Jéunk': 4, 'AJ': 5}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_and_lookup(self):
+        self.assertEqual(write_masterdict(self.path, self.dictionary, '5:5:2024'), 5)
+        cached = MasterDict(self.path)
+        self.assertEqual(cached.signature, '5:5:2024')
+        self.assertEqual(dict(cached), self.dictionary)
+        self.assertEqual(cached['Jéunk'], 4)
+        self.assertIn('MNRAS', cached.keys())
+        self.assertNotIn('ApJL', cached)
+        self.assertIsNone(cached.get('ApJL'))
+        self.assertEqual(len(cached), 5)
+
+    def test_load_checks_signature(self):
+        self.assertIsNone(load_masterdict(self.path, '5:5:2024'))
+        write_masterdict(self.path, self.dictionary, '5:5:2024')
+        self.assertEqual(len(load_masterdict(self.path, '5:5:2024')), 5)
+        self.assertIsNone(load_masterdict(self.path, '6:6:2024'))
+        with open(self.path, 'wb') as f:
+            f.write(b'junk')
+        self.assertIsNone(load_masterdict(self.path, '5:5:2024'))
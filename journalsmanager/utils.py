@@ -1,26 +1,37 @@
 from __future__ import print_function
-import chardet
 import csv
 import grp
 import json
 import pwd
 import os
-import requests
 import shutil
+import stat
 import string
-import urllib3
+import tempfile
 from adsputils import load_config
-from bs4 import BeautifulSoup as bs
+from contextlib import contextmanager
 from glob import glob
 from operator import itemgetter
 from journalsmanager.exceptions import *
 from journalsmanager.refsource import RefCount, RefVolume, RefSource
+from journalsdb.holdingsindex import write_index
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 proj_home = os.path.realpath(os.path.dirname(__file__)+ '/../')
 config = load_config(proj_home=proj_home)
 
 JDB_DATA_DIR = config.get('JDB_DATA_DIR', '/')
 
+# bibcode volume fields that are part of the bibstem (see parse_bibcodes)
+BIBSTEM_VOLUMES = frozenset(config.get('BIBSTEM_VOLUMES', []))
+
+# bibcodes parsed per parse_bibcode_block call in bulk loops
+BIBCODE_BLOCK_SIZE = 100000
+
 def chowner(filename, uname='ads', ugroup='ads'):
     try:
         uid = pwd.getpwnam(uname).pw_uid
@@ -30,31 +41,201 @@ def chowner(filename, uname='ads', ugroup='ads'):
         raise FileOwnershipError(err)
 
 
-def parse_bibcodes(bibcode):
-    parsed_bib = {}
-    if not isinstance(bibcode, str):
-        pass
-    else:
+@contextmanager
+def atomic_write(filepath, mode=None, owner=False, encoding=None):
+    '''
+    Yields a file object for a temporary file in the same directory as
+    filepath.  When the block exits cleanly, the data is fsynced and the
+    temporary file is renamed over filepath, so readers only ever see the
+    old or the new file.  If the block raises, the temporary file is
+    removed and filepath is left untouched.
+
+    The new file keeps the mode (and, where allowed, the owner) of the
+    file it replaces, or gets the usual mode for a new file.  mode and
+    owner=True (chowner) override that, for the files that are published
+    read-only.
+    '''
+    filedir = os.path.dirname(filepath) or '.'
+    prefix = '.' + os.path.basename(filepath) + '.'
+    try:
+        current = os.stat(filepath)
+    except OSError:
+        current = None
+    if mode is None:
+        if current is not None:
+            mode = stat.S_IMODE(current.st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+    (fd, tmpfile) = tempfile.mkstemp(dir=filedir, prefix=prefix)
+    try:
+        with os.fdopen(fd, 'w', encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpfile, mode)
+        if owner:
+            chowner(tmpfile)
+        elif current is not None:
+            try:
+                os.chown(tmpfile, current.st_uid, current.st_gid)
+            except OSError:
+                pass
+        os.replace(tmpfile, filepath)
+    except BaseException:
         try:
-            year = bibcode[0:4]
-            stem = bibcode[4:9]
-            volm = bibcode[9:13]
-            qual = bibcode[13]
-            page = bibcode[14:18]
-            auth = bibcode[18]
-            if volm in config.get('BIBSTEM_VOLUMES'):
-                stem = year + stem + volm
-                volm = None
-            parsed_bib = {"bibcode": bibcode, "year": year, "bibstem": stem,
-                          "volume": volm, "qualifier": qual, "page": page,
-                          "initial": auth}
-        except Exception as err:
-            # logger.warn("Nonstandard bibcode: {0}".format(bibcode))
+            os.unlink(tmpfile)
+        except OSError:
             pass
-    return parsed_bib
+        raise
+    try:
+        dirfd = os.open(filedir, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+    except OSError:
+        pass
+
+
+def parse_bibcode_block(bibcodes):
+    '''
+    Parses a list of bibcodes at once.  Returns a dict of columns (lists
+    as long as bibcodes): bibcode, year, bibstem, volume, qualifier, page
+    and initial, plus valid, which is False for entries that aren't
+    strings of at least 19 characters (their other columns are None).
+
+    Bibcodes are fixed width, so each column is one slice over the whole
+    block, and the BIBSTEM_VOLUMES rule is applied to the volume column,
+    instead of building a dict per bibcode.
+    '''
+    bibcodes = list(bibcodes)
+    valid = [isinstance(b, str) and len(b) >= 19 for b in bibcodes]
+    if all(valid):
+        packed = bibcodes
+    else:
+        packed = [b for (b, ok) in zip(bibcodes, valid) if ok]
+    year = [b[0:4] for b in packed]
+    stem = [b[4:9] for b in packed]
+    volume = [b[9:13] for b in packed]
+    special = [v in BIBSTEM_VOLUMES for v in volume]
+    columns = {'bibcode': packed,
+               'year': year,
+               'bibstem': [y + s + v if sp else s for (y, s, v, sp) in zip(year, stem, volume, special)],
+               'volume': [None if sp else v for (v, sp) in zip(volume, special)],
+               'qualifier': [b[13] for b in packed],
+               'page': [b[14:18] for b in packed],
+               'initial': [b[18] for b in packed]}
+    if packed is not bibcodes:
+        # spread the parsed rows back out, with None for the invalid ones
+        for (name, column) in columns.items():
+            values = iter(column)
+            columns[name] = [next(values) if ok else None for ok in valid]
+    columns['valid'] = valid
+    return columns
+
+
+def iter_bibcode_blocks(bibcodes, block_size=None):
+    # parse_bibcode_block columns for an iterable of bibcodes, block_size
+    # bibcodes at a time
+    block_size = block_size or BIBCODE_BLOCK_SIZE
+    block = []
+    for bibcode in bibcodes:
+        block.append(bibcode)
+        if len(block) >= block_size:
+            yield parse_bibcode_block(block)
+            block = []
+    if block:
+        yield parse_bibcode_block(block)
+
+
+def iter_parsed_bibcodes(bibcodes, block_size=None):
+    # parse_bibcodes dicts for an iterable of bibcodes; invalid bibcodes
+    # are skipped
+    names = ['bibcode', 'year', 'bibstem', 'volume', 'qualifier', 'page', 'initial']
+    for columns in iter_bibcode_blocks(bibcodes, block_size):
+        for row in zip(columns['valid'], *[columns[name] for name in names]):
+            if row[0]:
+                yield dict(zip(names, row[1:]))
+
+
+def parse_bibcodes(bibcode):
+    # parse_bibcode_block for a single bibcode: a dict of its fields, or
+    # {} if it isn't a bibcode
+    if not isinstance(bibcode, str):
+        return {}
+    columns = parse_bibcode_block([bibcode])
+    if not columns['valid'][0]:
+        return {}
+    return dict((name, columns[name][0]) for name in ['bibcode', 'year', 'bibstem', 'volume', 'qualifier', 'page', 'initial'])
+
+
+def iter_json_array(filename, chunk_size=65536):
+    '''
+    Yields the elements of the top-level JSON array in filename one at a
+    time, so memory use is bounded by the largest element rather than by
+    the file.  Uses ijson when it is installed, and otherwise a pure-Python
+    reader built on json.JSONDecoder.raw_decode.
+    '''
+    if ijson:
+        with open(filename, 'rb') as fj:
+            for item in ijson.items(fj, 'item', use_float=True):
+                yield item
+        return
+
+    decoder = json.JSONDecoder()
+    with open(filename, 'r', encoding='utf-8') as fj:
+        buf = ''
+        idx = 0
+        eof = False
+        started = False
+        while True:
+            # skip whitespace (and separators once inside the array),
+            # reading more as needed
+            skip = ' \t\r\n,' if started else ' \t\r\n'
+            while True:
+                while idx < len(buf) and buf[idx] in skip:
+                    idx += 1
+                if idx < len(buf) or eof:
+                    break
+                buf = fj.read(chunk_size)
+                idx = 0
+                eof = not buf
+            if idx >= len(buf):
+                raise ValueError("Unterminated JSON array in %s" % filename)
+            if not started:
+                if buf[idx] != '[':
+                    raise ValueError("%s does not contain a JSON array" % filename)
+                started = True
+                idx += 1
+                continue
+            if buf[idx] == ']':
+                return
+            try:
+                (item, end) = decoder.raw_decode(buf, idx)
+                # a number at the very end of the buffer may be cut short
+                if end == len(buf) and not eof:
+                    raise ValueError('incomplete element')
+            except ValueError:
+                if eof:
+                    raise
+                more = fj.read(max(chunk_size, len(buf) - idx))
+                eof = not more
+                buf = buf[idx:] + more
+                idx = 0
+                continue
+            yield item
+            idx = end
+            if idx > chunk_size:
+                buf = buf[idx:]
+                idx = 0
 
 
 def get_encoding(filename):
+    # chardet, bs4 and html5lib are only needed to read the data files, so
+    # they're imported where they are used
+    import chardet
     try:
         encoding = chardet.detect(open(filename, 'rb').read())['encoding']
         return encoding
@@ -81,6 +262,55 @@ def read_bibstems_list():
     return data
 
 
+def bibstemsdat_line(r):
+    # default value is 'C'
+    out_type = 'C'
+    if r.get('refereed', None) == 'yes':
+        out_type = 'R'
+    else:
+        if r['pubtype'] == 'Conf. Proc.':
+            out_type = 'C'
+        elif r['pubtype'] == 'Journal':
+            out_type = 'J'
+    out_bibstem = ''
+    if len(r['bibstem']) <= 9 and (r['bibstem'][0] not in ['1','2']):
+        out_bibstem = '....' + r['bibstem']
+    else:
+        out_bibstem = r['bibstem']
+    if len(out_bibstem) < 13:
+        out_bibstem = out_bibstem.ljust(13, '.')
+    return "%s\t%s\t%s\n" % (out_bibstem, out_type, r['pubname'])
+
+
+def issn2journal_line(r):
+    return '%s\t%s\n' % (r['issn'], r['bibstem'])
+
+
+def journal_issn_line(r):
+    return '%s\t%s\t%s\n' % (r['bibstem'], r['issn'], r['name'])
+
+
+def publisher_line(r):
+    return '%s\t%s\n' % (r['bibstem'], r['publisher'])
+
+
+def issn_identifier_line(r):
+    return '%s\t%s\t%s\n' % (r.get('bibstem', ''), r.get('id_type', ''), r.get('id_value', ''))
+
+
+def abbreviation_line(r):
+    return '%s\t%s\n' % (r.get('bibstem', ''), r.get('abbrev', ''))
+
+
+def sorted_lines(lines, keycol=0):
+    # export lines in the order every classic file is written in, full or
+    # patched: by the bibstem in column keycol (without the dot padding),
+    # then by the whole line, in Python (codepoint) order
+    def linekey(l):
+        return (l.rstrip('\n').split('\t')[keycol].strip('.'), l)
+    return sorted(lines, key=linekey)
+
+
 def export_to_bibstemsdat(rows):
     if rows:
         try:
@@ -90,33 +320,15 @@ def export_to_bibstemsdat(rows):
             ExportBibstemsException(err)
         else:
             nrows = str(len(rows))
-            os.chmod(outfile, 0o666)
-            with open(outfile, 'w') as f:
+            lines = []
+            for r in rows:
+                try:
+                    lines.append(bibstemsdat_line(r))
+                except Exception as err:
+                    raise ExportBibstemsException('%s: %s' % (err, r))
+            with atomic_write(outfile, mode=0o444, owner=True) as f:
                 f.write(' %s\n' % nrows)
-                for r in rows:
-                    try:
-                        # default value is 'C'
-                        out_type = 'C'
-                        if r.get('refereed', None) == 'yes':
-                            out_type = 'R'
-                        else:
-                            if r['pubtype'] == 'Conf. Proc.':
-                                out_type = 'C'
-                            elif r['pubtype'] == 'Journal':
-                                out_type = 'J'
-                        out_bibstem = ''
-                        if len(r['bibstem']) <= 9 and (r['bibstem'][0] not in ['1','2']):
-                            out_bibstem = '....' + r['bibstem']
-                        else:
-                            out_bibstem = r['bibstem']
-                        if len(out_bibstem) < 13:
-                            out_bibstem = out_bibstem.ljust(13, '.')
-                        f.write("%s\t%s\t%s\n" % (out_bibstem, out_type, r['pubname']))
-                    except Exception as err:
-                        f.close()
-                        raise ExportBibstemsException(err+': '+str(r))
-            os.chmod(outfile, 0o444)
-            chowner(outfile)
+                f.writelines(sorted_lines(lines))
             return "Success: %s rows exported." % nrows
 
 
@@ -129,17 +341,15 @@ def export_issns(rows):
 
             # for issn2journals...
             if i2j_file:
-                with open(i2j_file, 'w') as f:
-                    for r in rows:
-                        f.write('%s\t%s\n' % (r['issn'], r['bibstem']))
+                with atomic_write(i2j_file) as f:
+                    f.writelines(sorted_lines([issn2journal_line(r) for r in rows], keycol=1))
 
             # for journal_issn...
             size = "0"
             if j2i_file:
-                with open(j2i_file, 'w') as f:
+                with atomic_write(j2i_file) as f:
                     f.write('\t%s %s\n' % (nrows, size))
-                    for r in rows:
-                        f.write('%s\t%s\t%s\n' % (r['bibstem'], r['issn'], r['name']))
+                    f.writelines(sorted_lines([journal_issn_line(r) for r in rows]))
         except Exception as err:
             raise ExportISSNException(err)
         else:
@@ -150,11 +360,10 @@ def export_publishers(rows):
     if rows:
         try:
             if publisher_file:
-                with open(publisher_file, 'w') as fout:
+                with atomic_write(publisher_file) as fout:
                     nrows = len(rows)
                     fout.write('%s\n' % nrows)
-                    for r in rows:
-                        fout.write('%s\t%s\n' % (r['bibstem'], r['publisher']))
+                    fout.writelines(sorted_lines([publisher_line(r) for r in rows]))
         except Exception as err:
             raise ExportPublisherException(err)
         else:
@@ -166,10 +375,9 @@ def export_issn_identifiers(rows):
         try:
             if issn_ident_file:
                 backup_export_file(issn_ident_file)
-                with open(issn_ident_file, 'w') as fout:
+                with atomic_write(issn_ident_file) as fout:
                     nrows = len(rows)
-                    for r in rows:
-                        fout.write('%s\t%s\t%s\n' % (r.get('bibstem', ''), r.get('id_type', ''), r.get('id_value', '')))
+                    fout.writelines(sorted_lines([issn_identifier_line(r) for r in rows]))
         except Exception as err:
             raise ExportISSNIdentException(err)
         else:
@@ -180,17 +388,76 @@ def export_abbreviations(rows):
     if rows and bibstem_abbrev_file:
         try:
             backup_export_file(bibstem_abbrev_file)
-            with open(bibstem_abbrev_file, 'w') as fout:
+            with atomic_write(bibstem_abbrev_file) as fout:
                 nrows = len(rows)
                 fout.write('%s\n' % nrows)
-                for r in rows:
-                    fout.write('%s\t%s\n' % (r.get('bibstem', ''), r.get('abbrev', '')))
+                fout.writelines(sorted_lines([abbreviation_line(r) for r in rows]))
         except Exception as err:
             raise ExportAbbrevException(err)
         else:
             return "Success: %s rows exported." % nrows
-                
-           
+
+
+def patch_export_file(outfile, lines, bibstems, keycol=0, header=None, backup=False):
+    '''
+    Replaces the lines belonging to bibstems in an existing export file
+    with the new lines.  The result is written in sorted_lines order, so
+    it is the same file a full export of the same rows writes.  header,
+    if given, is a function of the new line count that returns the
+    header line of the file.
+    '''
+    def bibstem(l):
+        return l.rstrip('\n').split('\t')[keycol].strip('.')
+
+    with open(outfile, 'r') as f:
+        if header:
+            f.readline()
+        kept = [l for l in f if bibstem(l) not in bibstems]
+    merged = sorted_lines(kept + list(lines), keycol=keycol)
+    if backup:
+        backup_export_file(outfile)
+    with atomic_write(outfile) as fout:
+        if header:
+            fout.write(header(len(merged)))
+        fout.writelines(merged)
+    return len(merged)
+
+
+def patch_classic_exports(rowsets, bibstems):
+    '''
+    Incremental counterpart of the export_* functions: rowsets holds the
+    current export rows for the changed journals only, keyed as in
+    tasks.get_classic_export_rows, and bibstems is every bibstem (old and
+    new) those journals have had.  Raises ExportDeltaException if any
+    file can't be patched, in which case the caller should fall back to
+    a full export.
+    '''
+    bibstems = set(b.strip('.') for b in bibstems)
+    datadir = JDB_DATA_DIR + '/'
+    try:
+        patch_export_file(datadir + config.get('BIBSTEMS_FILE', 'error.file'),
+                          [bibstemsdat_line(r) for r in rowsets['bibstems']],
+                          bibstems, header=lambda n: ' %s\n' % n,
+                          backup=True)
+        patch_export_file(datadir + config.get('ISSN_JOURNAL_FILE', 'error.file'),
+                          [issn2journal_line(r) for r in rowsets['issns']],
+                          bibstems, keycol=1)
+        patch_export_file(datadir + config.get('JOURNAL_ISSN_FILE', 'error.file'),
+                          [journal_issn_line(r) for r in rowsets['issns']],
+                          bibstems, header=lambda n: '\t%s %s\n' % (n, 0))
+        patch_export_file(datadir + config.get('BIBSTEM_PUBLISHER_FILE', 'error.file'),
+                          [publisher_line(r) for r in rowsets['publishers']],
+                          bibstems, header=lambda n: '%s\n' % n)
+        patch_export_file(datadir + config.get('ISSN_IDENTIFIER', 'error.file'),
+                          [issn_identifier_line(r) for r in rowsets['issn_identifiers']],
+                          bibstems, backup=True)
+        patch_export_file(datadir + config.get('BIBSTEM_CANONICAL_ABBREV', 'error.file'),
+                          [abbreviation_line(r) for r in rowsets['abbreviations']],
+                          bibstems, header=lambda n: '%s\n' % n, backup=True)
+    except Exception as err:
+        raise ExportDeltaException(err)
+    return "Success: %s bibstems patched." % len(bibstems)
+
 
 def export_to_autocomplete(rows):
     data = []
@@ -245,16 +512,58 @@ def export_to_autocomplete(rows):
         result = {'data': sorted_data}
         bib2name_file = JDB_DATA_DIR + '/' + config.get('JOURNALS_AUTOCOMPLETE_FILE', 'error.file')
 
-        os.chmod(bib2name_file, 0o666)
-        with open(bib2name_file, 'w') as fo:
+        with atomic_write(bib2name_file, mode=0o444, owner=True) as fo:
             fo.write(json.dumps(result))
-        os.chmod(bib2name_file, 0o444)
-        chowner(bib2name_file)
 
     except Exception as err:
         raise AutocompleteExportException("Unable to export autocomplete json: %s" % err)
 
 
+def holdings_page(qualifier, page):
+    # the page as the search API gives it, without the dot padding: a
+    # digit qualifier is the first digit of a page over 9999 (12345), an
+    # upper case letter is a page prefix (L12), and a lower case letter
+    # is the first two digits of a six digit article id, a=01 (h4001 is
+    # 084001)
+    qual = qualifier.strip('.')
+    page = page.strip('.')
+    if qual.isdigit() or qual.isupper():
+        return qual + page
+    if qual.islower() and page.isdigit():
+        return '%02d%s' % (ord(qual) - ord('a') + 1, page.zfill(4))
+    return page
+
+
+def build_holdings_index(bibcodes):
+    # {(bibstem, volume): set of pages} from an iterable of bibcodes, with
+    # the padding dots of bibstem and volume removed; volume is None for
+    # the BIBSTEM_VOLUMES bibstems (see parse_bibcodes)
+    holdings = {}
+    for columns in iter_bibcode_blocks(bibcode.strip() for bibcode in bibcodes):
+        for (valid, bibstem, volume, qualifier, page) in zip(columns['valid'], columns['bibstem'], columns['volume'], columns['qualifier'], columns['page']):
+            if not valid:
+                continue
+            page = holdings_page(qualifier, page)
+            if not page:
+                continue
+            if volume is not None:
+                volume = volume.strip('.')
+            holdings.setdefault((bibstem.strip('.'), volume), set()).add(page)
+    return holdings
+
+
+def export_holdings_index():
+    try:
+        bibcodeFile = JDB_DATA_DIR + '/' + config.get('CANONICAL_BIBS', 'error.file')
+        with open(bibcodeFile, 'r') as fb:
+            holdings = build_holdings_index(fb)
+        indexFile = JDB_DATA_DIR + '/' + config.get('HOLDINGS_INDEX_FILE', 'error.file')
+        count = write_index(indexFile, holdings)
+    except Exception as err:
+        raise HoldingsIndexExportException("Unable to export holdings index: %s" % err)
+    return count
+
+
 def read_abbreviations_list():
     datadict = {}
     infile = JDB_DATA_DIR + '/' + config.get('JOURNAL_ABBREV_FILE', 'error.file')
@@ -371,6 +680,7 @@ def parse_raster_pub_data(pubsoup):
 
 
 def read_raster_xml(masterdict):
+    from bs4 import BeautifulSoup as bs
     raster_dir = config.get('RASTER_CONFIG_DIR')
     xml_files = glob(raster_dir+"*.xml")
     recs = []
@@ -490,25 +800,33 @@ def create_refsource():
     volume pair a row.
     '''
     refsources = {}
+    bibcodes = []
+    srcfiles = []
     infile = JDB_DATA_DIR + '/' + config.get('BIB_TO_REFS_FILE')
     with open(infile, 'r') as fin:
-        for l in fin.readlines():
+        for l in fin:
             try:
                 (bibcode, srcfile) = l.strip().split('\t')
             except Exception as err:
                 # logger.debug('Malformed line in source file: "%s"' % l.strip())
                 pass
             else:
-                try:
-                    parsed_bib = parse_bibcodes(bibcode)
-                    year = parsed_bib['year']
-                    bibstem = parsed_bib['bibstem'].strip('.')
-                    volume = parsed_bib['volume'].strip('.')
-                    source = parse_refsource_str(srcfile)
-                    refsources = update_refsources(refsources, bibstem, year, volume, source)
-                except Exception as err:
-                    # logger.debug('failed update_refsources: %s' % err)
-                    pass
+                bibcodes.append(bibcode)
+                srcfiles.append(srcfile)
+    for (start, columns) in zip(range(0, len(bibcodes), BIBCODE_BLOCK_SIZE), iter_bibcode_blocks(bibcodes)):
+        for (i, valid) in enumerate(columns['valid']):
+            # BIBSTEM_VOLUMES bibcodes have no volume to count under
+            if not valid or columns['volume'][i] is None:
+                continue
+            try:
+                year = columns['year'][i]
+                bibstem = columns['bibstem'][i].strip('.')
+                volume = columns['volume'][i].strip('.')
+                source = parse_refsource_str(srcfiles[start + i])
+                refsources = update_refsources(refsources, bibstem, year, volume, source)
+            except Exception as err:
+                # logger.debug('failed update_refsources: %s' % err)
+                pass
     return refsources
 
 
@@ -1,5 +1,5 @@
-import os
-import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app, request
 
 class HoldingsInitException(Exception):
@@ -16,40 +16,149 @@ class EmptyBibstemException(Exception):
 
 class ADSQuery(object):
 
-    def __init__(self):
+    # client, queryurl and token default to the app's shared session and
+    # config and the incoming request's token; they are all read here so
+    # the worker threads of search_volumes never touch the app context
+    def __init__(self, client=None, queryurl=None, token=None, rows=None, max_pages=None, max_workers=None):
         try:
-            self.token = current_app.config.get('SERVICE_TOKEN', None) or \
-                         request.headers.get('X-Forwarded-Authorization', \
-                         request.headers.get('Authorization', ''))
-            self.queryurl = current_app.config.get('HOLDINGS_ADS_QUERY_URL', None)
+            self.client = client if client is not None else current_app.client
+            if token is None:
+                token = current_app.config.get('SERVICE_TOKEN', None) or \
+                        request.headers.get('X-Forwarded-Authorization', \
+                        request.headers.get('Authorization', ''))
+            self.token = token
+            self.queryurl = queryurl or current_app.config.get('HOLDINGS_ADS_QUERY_URL', None)
+            self.rows = rows or current_app.config.get('HOLDINGS_ROWS', 2000)
+            self.max_pages = max_pages or current_app.config.get('HOLDINGS_MAX_PAGES', 100)
+            self.max_workers = max_workers or current_app.config.get('HOLDINGS_MAX_WORKERS', 8)
         except Exception as err:
             raise HoldingsInitException(err)
         else:
             pass
 
+    def first_page(self, bibstem, volume):
+        params = {
+            'q': 'bibstem:%s,volume:%s' % (bibstem, volume),
+            'wt': 'json',
+            'rows': self.rows,
+            'sort': 'bibcode asc,id asc',
+            'fl': 'bibstem,year,volume,page,esources',
+            'cursorMark': '*'
+        }
+        headers = {
+            'Authorization': self.token
+        }
+        return (params, headers)
+
+    def add_page(self, params, results, docs):
+        # adds the docs of one page; returns False on the last page, or
+        # moves params on to the next cursorMark
+        data = results.get('response', {})
+        docs.extend(data.get('docs', []))
+        cursor = results.get('nextCursorMark', None)
+        if not cursor or cursor == params['cursorMark'] or len(docs) >= data.get('numFound', 0):
+            return False
+        params['cursorMark'] = cursor
+        return True
+
+    def all_pages(self, results, docs):
+        # the last page's response carrying the docs of every page
+        data = results.get('response', {})
+        results.pop('nextCursorMark', None)
+        results['response'] = {'numFound': data.get('numFound', len(docs)),
+                               'start': 0,
+                               'docs': docs}
+        return results
+
     def search(self, bibstem=None, volume='*'):
+        # every page of bibstem/volume, following cursorMark until it stops
+        # changing; the docs of all pages are returned as one response
         if bibstem:
             try:
-                params = {
-                    'q': 'bibstem:%s,volume:%s' % (bibstem, volume),
-                    'wt': 'json',
-                    'rows': 2000,
-                    'sort': 'bibcode asc',
-                    'fl': 'bibstem,year,volume,page,esources'
-                }
-                headers = {
-                    'Authorization': self.token
-                }
-                response = current_app.client.get(
-                    url=self.queryurl,
-                    params=params,
-                    headers=headers,
-                )
-                response.raise_for_status()
-                results = response.json()
+                (params, headers) = self.first_page(bibstem, volume)
+                docs = []
+                for page in range(self.max_pages):
+                    response = self.client.get(
+                        url=self.queryurl,
+                        params=params,
+                        headers=headers,
+                    )
+                    response.raise_for_status()
+                    results = response.json()
+                    if not self.add_page(params, results, docs):
+                        break
+                results = self.all_pages(results, docs)
             except Exception as err:
                 raise HoldingsQueryException(err)
             else:
                 return results
         else:
             raise EmptyBibstemException('You must provide a bibstem.')
+
+    def search_volumes(self, bibstem=None, volumes=[], search=None):
+        # the volumes are searched concurrently over the shared client with
+        # search(bibstem, volume), self.search by default; returns
+        # [(volume, result)] in the order requested, with the exception as
+        # the result of a volume whose search failed
+        if not bibstem:
+            raise EmptyBibstemException('You must provide a bibstem.')
+        if not volumes:
+            return []
+        search = search or self.search
+
+        def search_one(volume):
+            try:
+                return search(bibstem, volume)
+            except HoldingsQueryException as err:
+                return err
+
+        workers = min(self.max_workers, len(volumes))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(search_one, volumes))
+        return list(zip(volumes, results))
+
+
+class AsyncADSQuery(ADSQuery):
+
+    # ADSQuery for the ASGI service: client is an httpx.AsyncClient, and
+    # since there is no Flask context every argument must be given
+    async def search(self, bibstem=None, volume='*'):
+        if bibstem:
+            try:
+                (params, headers) = self.first_page(bibstem, volume)
+                docs = []
+                for page in range(self.max_pages):
+                    response = await self.client.get(
+                        self.queryurl,
+                        params=params,
+                        headers=headers,
+                    )
+                    response.raise_for_status()
+                    results = response.json()
+                    if not self.add_page(params, results, docs):
+                        break
+                results = self.all_pages(results, docs)
+            except Exception as err:
+                raise HoldingsQueryException(err)
+            else:
+                return results
+        else:
+            raise EmptyBibstemException('You must provide a bibstem.')
+
+    async def search_volumes(self, bibstem=None, volumes=[], search=None):
+        # as ADSQuery.search_volumes, with at most max_workers volumes
+        # searched at once
+        if not bibstem:
+            raise EmptyBibstemException('You must provide a bibstem.')
+        search = search or self.search
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def search_one(volume):
+            async with semaphore:
+                try:
+                    return await search(bibstem, volume)
+                except HoldingsQueryException as err:
+                    return err
+
+        results = await asyncio.gather(*[search_one(v) for v in volumes])
+        return list(zip(volumes, results))
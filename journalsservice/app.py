@@ -1,7 +1,13 @@
 from __future__ import absolute_import
 from werkzeug.serving import run_simple
-from .views import Summary, Journal, Holdings, Refsource, ISSN, Browse
+from .views import Summary, Journal, Holdings, HoldingsBatch, Refsource, ISSN, Browse, Dump, Changes, Metrics
+from .pool import warm_pool
+from .holdingscache import HoldingsCache
+from .issnresolver import ISSNResolver
+from journalsdb.snapshot import Snapshot
+from journalsdb.holdingsindex import HoldingsIndex
 from flask_restful import Api
+from requests.adapters import HTTPAdapter
 from flask_discoverer import Discoverer
 from adsmutils import ADSFlask
 
@@ -23,12 +29,85 @@ def create_app(**config):
     api.add_resource(Summary, '/summary/<string:bibstem>')
     api.add_resource(Journal, '/journal/<string:journalname>')
     api.add_resource(Holdings, '/holdings/<string:bibstem>/<string:volume>')
+    api.add_resource(HoldingsBatch, '/holdings/<string:bibstem>')
     api.add_resource(Refsource, '/refsource/<string:bibstem>')
     api.add_resource(ISSN, '/issn/<string:issn>')
     api.add_resource(Browse, '/browse/<string:bibstem>')
+    api.add_resource(Dump, '/dump')
+    api.add_resource(Changes, '/changes')
+    api.add_resource(Metrics, '/metrics')
 
     discoverer = Discoverer(app)
 
+    # holdings searches run concurrently over app.client; size its
+    # keep-alive pool so they don't open and drop connections
+    if getattr(app, 'client', None) is not None:
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=app.config.get('HOLDINGS_POOL_SIZE', 20))
+        app.client.mount('https://', adapter)
+        app.client.mount('http://', adapter)
+
+    # per-process holdings cache; HOLDINGS_CACHE_SIZE = 0 turns it off
+    if app.config.get('HOLDINGS_CACHE_SIZE', 0):
+        app.holdings_cache = HoldingsCache(maxsize=app.config.get('HOLDINGS_CACHE_SIZE'),
+                                           ttl_closed=app.config.get('HOLDINGS_CACHE_TTL_CLOSED', 7*86400),
+                                           ttl_current=app.config.get('HOLDINGS_CACHE_TTL_CURRENT', 3600),
+                                           stale_ttl=app.config.get('HOLDINGS_CACHE_STALE_TTL', 86400),
+                                           closed_age=app.config.get('HOLDINGS_CACHE_CLOSED_AGE', 2))
+    else:
+        app.holdings_cache = None
+
+    # snapshot mode: serve the database endpoints from the newest snapshot
+    # the manager published, and pick up new ones as requests come in
+    app.snapshot = None
+    if app.config.get('SNAPSHOT_MODE', False):
+        snapshot = Snapshot(app.config.get('SNAPSHOT_DIRECTORY'),
+                            refresh_interval=app.config.get('SNAPSHOT_REFRESH', 60),
+                            pool_size=app.config.get('SNAPSHOT_POOL_SIZE', 10),
+                            mmap_size=app.config.get('SNAPSHOT_MMAP_SIZE', 256*1024*1024),
+                            logger=app.logger)
+        try:
+            snapshot.load()
+        except Exception as err:
+            app.logger.error('No journals snapshot to serve, using the database: %s' % err)
+        else:
+            app.snapshot = snapshot
+
+            @app.before_request
+            def refresh_snapshot():
+                snapshot.maybe_refresh()
+
+    # page-level holdings from the manager's index, for requests that
+    # don't need esources
+    app.holdings_index = None
+    if app.config.get('HOLDINGS_INDEX_PATH', None):
+        try:
+            app.holdings_index = HoldingsIndex(app.config.get('HOLDINGS_INDEX_PATH'),
+                                               refresh_interval=app.config.get('HOLDINGS_INDEX_REFRESH', 300))
+        except Exception as err:
+            app.logger.warning('Holdings index not loaded, using the search API: %s' % err)
+
+    if app.config.get('JOURNALSDB_POOL_WARMUP', False) and app.db and app.snapshot is None:
+        with app.app_context():
+            warm_pool(app.db.engine,
+                      connections=app.config.get('JOURNALSDB_POOL_WARMUP_CONNECTIONS', 1),
+                      logger=app.logger)
+
+    # ISSN lookups are answered from memory; if the first load fails the
+    # issn endpoint queries the database as before
+    app.issn_resolver = None
+    if app.config.get('ISSN_RESOLVER', False) and (app.db or app.snapshot):
+        with app.app_context():
+            resolver = ISSNResolver(app.snapshot or app.db.engine,
+                                    refresh_interval=app.config.get('ISSN_RESOLVER_REFRESH', 60),
+                                    logger=app.logger)
+            try:
+                resolver.load()
+            except Exception as err:
+                app.logger.warning('ISSN resolver failed to load, using the database: %s' % err)
+            else:
+                app.issn_resolver = resolver
+
     return app
 
 if __name__ == "__main__":
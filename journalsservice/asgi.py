@@ -0,0 +1,229 @@
+'''
+ASGI variant of journalsservice.
+
+The holdings endpoints are served natively: searches go to the ADS API over
+one shared httpx.AsyncClient, so a slow upstream holds an open socket rather
+than a worker thread.  Every other request goes to the Flask app from
+create_app, run on a bounded thread pool (ASGI_THREADS) so the database
+views are served as before.
+'''
+import asyncio
+import json
+import re
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from .app import create_app
+from .adsquery import AsyncADSQuery, HoldingsInitException
+from .views import holdings_json, index_holdings, is_true
+
+HOLDINGS_VOLUME = re.compile(r'^/holdings/([^/]+)/([^/]+)/?$')
+HOLDINGS_BATCH = re.compile(r'^/holdings/([^/]+)/?$')
+
+
+class PooledWsgiInstance(WsgiToAsgiInstance):
+
+    # asgiref's run_wsgi_app runs every WSGI call on one shared thread;
+    # this one runs them on the service's own pool instead, sending the
+    # response back through the event loop the request came in on
+    executor = None
+
+    async def __call__(self, scope, receive, send):
+        self.loop = asyncio.get_running_loop()
+        self.send = send
+        await WsgiToAsgiInstance.__call__(self, scope, receive, send)
+
+    async def run_wsgi_app(self, body):
+        await self.loop.run_in_executor(self.executor, self.run_wsgi_app_sync, body)
+
+    def send_sync(self, message):
+        asyncio.run_coroutine_threadsafe(self.send(message), self.loop).result()
+
+    def run_wsgi_app_sync(self, body):
+        environ = self.build_environ(self.scope, body)
+        result = self.wsgi_application(environ, self.start_response)
+        try:
+            for output in result:
+                if not self.response_started:
+                    self.response_started = True
+                    self.send_sync(self.response_start)
+                self.send_sync({'type': 'http.response.body', 'body': output, 'more_body': True})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if not self.response_started:
+            self.response_started = True
+            self.send_sync(self.response_start)
+        self.send_sync({'type': 'http.response.body'})
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+
+    def __init__(self, wsgi_application, executor):
+        WsgiToAsgi.__init__(self, wsgi_application)
+        self.instance = type('Instance', (PooledWsgiInstance,), {'executor': executor})
+
+    async def __call__(self, scope, receive, send):
+        await self.instance(self.wsgi_application)(scope, receive, send)
+
+
+class JournalsASGI(object):
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.executor = ThreadPoolExecutor(max_workers=self.config.get('ASGI_THREADS', 16))
+        self.wsgi = PooledWsgiToAsgi(flask_app, self.executor)
+        self.client = None
+
+    def get_client(self):
+        # created on first use so it belongs to the server's event loop
+        if self.client is None:
+            pool = self.config.get('HOLDINGS_POOL_SIZE', 20)
+            self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=pool,
+                                                                max_keepalive_connections=pool),
+                                            timeout=self.config.get('HOLDINGS_TIMEOUT', 60))
+        return self.client
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.get_client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http':
+            path = scope['path']
+            root_path = scope.get('root_path', '')
+            if root_path and path.startswith(root_path):
+                path = path[len(root_path):]
+            match = HOLDINGS_VOLUME.match(path)
+            if match and scope['method'] == 'GET':
+                (result, status) = await self.holdings(scope, *match.groups())
+                return await self.respond(send, result, status)
+            match = HOLDINGS_BATCH.match(path)
+            if match and scope['method'] == 'POST':
+                body = await self.read_body(receive)
+                (result, status) = await self.holdings_batch(scope, match.group(1), body)
+                return await self.respond(send, result, status)
+        return await self.wsgi(scope, receive, send)
+
+    async def read_body(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                return body
+
+    async def respond(self, send, result, status):
+        body = (json.dumps(result) + '\n').encode('utf-8')
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode('latin-1'))]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def query(self, scope):
+        headers = dict((k.decode('latin-1').lower(), v.decode('latin-1')) for (k, v) in scope.get('headers', []))
+        token = self.config.get('SERVICE_TOKEN', None) or \
+                headers.get('x-forwarded-authorization', headers.get('authorization', ''))
+        queryurl = self.config.get('HOLDINGS_ADS_QUERY_URL', None)
+        if not queryurl:
+            raise HoldingsInitException('HOLDINGS_ADS_QUERY_URL is not set')
+        return AsyncADSQuery(client=self.get_client(), queryurl=queryurl, token=token,
+                             rows=self.config.get('HOLDINGS_ROWS', 2000),
+                             max_pages=self.config.get('HOLDINGS_MAX_PAGES', 100),
+                             max_workers=self.config.get('HOLDINGS_MAX_WORKERS', 8))
+
+    async def cached_holdings(self, q, bibstem, volume):
+        # as views.cached_holdings, on the same cache as the Flask app
+        cache = getattr(self.flask_app, 'holdings_cache', None)
+        if cache is None:
+            return holdings_json(await q.search(bibstem, volume))
+
+        async def load():
+            solr_result = await q.search(bibstem, volume)
+            years = [rec.get('year', None) for rec in solr_result.get('response', {}).get('docs', [])]
+            return (holdings_json(solr_result), cache.volume_ttl(years))
+
+        return await cache.aget((bibstem, volume), load)
+
+    def local_index(self, scope):
+        # as views.local_holdings_index
+        index = getattr(self.flask_app, 'holdings_index', None)
+        if index is None:
+            return None
+        args = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        if is_true(args.get('esources', [True])[0]):
+            return None
+        index.maybe_refresh()
+        return index
+
+    async def holdings(self, scope, bibstem, volume):
+        try:
+            bibstem = bibstem.rstrip('.')
+            index = self.local_index(scope)
+            if index is not None:
+                return (index_holdings(index, bibstem, volume), 200)
+            q = self.query(scope)
+            result = await self.cached_holdings(q, bibstem, volume)
+        except Exception as err:
+            return ({'Error': 'Holdings search failed',
+                     'Error Info': str(err)}, 500)
+        else:
+            return (result, 200)
+
+    async def holdings_batch(self, scope, bibstem, body):
+        try:
+            volumes = json.loads(body.decode('utf-8')).get('volumes', [])
+            if not isinstance(volumes, list):
+                raise ValueError('volumes must be a list')
+            volumes = [str(v) for v in volumes]
+        except Exception as err:
+            return ({'Error': 'Holdings search failed',
+                     'Error Info': 'Request body must be {"volumes": [...]}: %s' % err}, 400)
+        max_volumes = self.config.get('JOURNALSDB_MAX_SUBMITTED', 100)
+        if len(volumes) > max_volumes:
+            return ({'Error': 'Holdings search failed',
+                     'Error Info': 'No more than %s volumes per request' % max_volumes}, 400)
+        try:
+            bibstem = bibstem.rstrip('.')
+            index = self.local_index(scope)
+            if index is not None:
+                return ({'holdings': [index_holdings(index, bibstem, volume) for volume in volumes]}, 200)
+            q = self.query(scope)
+            holdings = []
+            for (volume, result) in await q.search_volumes(bibstem, volumes, search=lambda b, v: self.cached_holdings(q, b, v)):
+                if isinstance(result, Exception):
+                    holdings.append({'volume': volume,
+                                     'Error': 'Holdings search failed',
+                                     'Error Info': str(result)})
+                else:
+                    holdings.append(result)
+        except Exception as err:
+            return ({'Error': 'Holdings search failed',
+                     'Error Info': str(err)}, 500)
+        else:
+            return ({'holdings': holdings}, 200)
+
+
+def create_asgi_app(**config):
+    """
+    Create the ASGI application around the Flask app from create_app
+    :return: ASGI application
+    """
+    return JournalsASGI(create_app(**config))
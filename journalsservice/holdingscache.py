@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+
+
+class HoldingsCache(object):
+    '''
+    In-process LRU cache of holdings results keyed by (bibstem, volume).
+
+    Each entry is fresh for its TTL, then served stale for up to
+    stale_ttl seconds more while one background refresh runs.  Concurrent
+    misses for the same key share a single load.  get is for threaded
+    callers and aget for asyncio ones.
+    '''
+
+    def __init__(self, maxsize=20000, ttl_closed=7*86400, ttl_current=3600,
+                 stale_ttl=86400, closed_age=2, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl_closed = ttl_closed
+        self.ttl_current = ttl_current
+        self.stale_ttl = stale_ttl
+        self.closed_age = closed_age
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._ainflight = {}
+        self._lock = threading.Lock()
+        self._refresher = ThreadPoolExecutor(max_workers=2)
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0, 'coalesced': 0,
+                      'errors': 0}
+
+    def volume_ttl(self, years):
+        # volumes whose latest record is closed_age or more years old are
+        # not going to change, anything newer (or empty) may still grow
+        years = [int(y) for y in years if str(y).isdigit()]
+        if years and max(years) <= datetime.now().year - self.closed_age:
+            return self.ttl_closed
+        return self.ttl_current
+
+    def get(self, key, loader):
+        # loader() returns (value, ttl); exceptions are not cached
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                (value, expires, stale_until) = entry
+                if now < expires:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return value
+                if now < stale_until:
+                    self._entries.move_to_end(key)
+                    self.stats['stale'] += 1
+                    if key not in self._inflight:
+                        future = Future()
+                        self._inflight[key] = future
+                        self._refresher.submit(self._load, key, loader, future)
+                    return value
+            future = self._inflight.get(key, None)
+            if future is None:
+                future = Future()
+                self._inflight[key] = future
+                owner = True
+                self.stats['misses'] += 1
+            else:
+                owner = False
+                self.stats['coalesced'] += 1
+        if owner:
+            self._load(key, loader, future)
+        return future.result()
+
+    async def aget(self, key, loader):
+        # get for the ASGI service: loader is a coroutine function, and the
+        # background refresh and coalesced loads are asyncio tasks
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                (value, expires, stale_until) = entry
+                if now < expires:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return value
+                if now < stale_until:
+                    self._entries.move_to_end(key)
+                    self.stats['stale'] += 1
+                    if key not in self._ainflight:
+                        task = asyncio.ensure_future(self._aload(key, loader))
+                        # nobody awaits a refresh, so retrieve its error here
+                        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                        self._ainflight[key] = task
+                    return value
+            task = self._ainflight.get(key, None)
+            if task is None:
+                task = asyncio.ensure_future(self._aload(key, loader))
+                self._ainflight[key] = task
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
+        return await asyncio.shield(task)
+
+    async def _aload(self, key, loader):
+        try:
+            (value, ttl) = await loader()
+        except Exception:
+            with self._lock:
+                self.stats['errors'] += 1
+                self._ainflight.pop(key, None)
+            raise
+        now = self.clock()
+        with self._lock:
+            self._store(key, value, ttl, now)
+            self._ainflight.pop(key, None)
+        return value
+
+    def _store(self, key, value, ttl, now):
+        self._entries[key] = (value, now + ttl, now + ttl + self.stale_ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _load(self, key, loader, future):
+        try:
+            (value, ttl) = loader()
+        except Exception as err:
+            with self._lock:
+                self.stats['errors'] += 1
+                self._inflight.pop(key, None)
+            future.set_exception(err)
+        else:
+            now = self.clock()
+            with self._lock:
+                self._store(key, value, ttl, now)
+                self._inflight.pop(key, None)
+            future.set_result(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def status(self):
+        with self._lock:
+            status = dict(self.stats)
+            status['size'] = len(self._entries)
+        return status
@@ -0,0 +1,136 @@
+import re
+import sys
+import threading
+import time
+
+from journalsdb import queries
+
+ISSN_FORMAT = re.compile(r'^[0-9]{7}[0-9X]$')
+
+
+def issn_check_digit(digits):
+    # ISSN check digit of the first seven digits (mod 11, 10 written X)
+    check = (11 - sum((8 - i) * int(d) for (i, d) in enumerate(digits)) % 11) % 11
+    return 'X' if check == 10 else str(check)
+
+
+def compact_issn(issn):
+    # '0004-637x', '0004637X', ' 0004-637X ' -> '0004637X'; None if it
+    # isn't eight ISSN characters
+    issn = re.sub(r'[\s-]', '', str(issn or '')).upper()
+    if ISSN_FORMAT.match(issn):
+        return issn
+    return None
+
+
+def normalize_issn(issn):
+    # the canonical NNNN-NNNC form, or None if malformed or the check
+    # digit is wrong
+    issn = compact_issn(issn)
+    if issn and issn_check_digit(issn[0:7]) == issn[7]:
+        return issn[0:4] + '-' + issn[4:]
+    return None
+
+
+def resolve_issn(issn, lookup):
+    # lookup(compact ISSN) for issn, {} if it finds nothing; raises
+    # ValueError for input that is malformed, or has a bad check digit
+    # and isn't found as such.  Both the resolver and the database lookup
+    # it falls back on go through here, so they answer bad input alike
+    key = compact_issn(issn)
+    if not key:
+        raise ValueError('"%s" is not an ISSN' % issn)
+    result = lookup(key)
+    if not result:
+        if not normalize_issn(key):
+            raise ValueError('"%s" has an invalid check digit' % issn)
+        return {}
+    return result
+
+
+class ISSNResolver(object):
+    '''
+    In-memory map of every ISSN in idents to the issn endpoint's response,
+    keyed by the compact (dashless, upper case) ISSN.  It is reloaded in
+    the background when editcontrol, master, idents, titlehistory or
+    publisher changed since the last load (queries.get_issn_signature),
+    checked at most every refresh_interval seconds.
+    '''
+
+    def __init__(self, engine, refresh_interval=60, logger=None, clock=time.time):
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self.logger = logger
+        self.clock = clock
+        self.issns = None
+        self.signature = None
+        self.last_check = 0
+        self._refreshing = threading.Lock()
+
+    def load(self):
+        with queries.read_only(self.engine) as conn:
+            signature = queries.get_issn_signature(conn)
+            records = queries.get_issn_records(conn)
+        issns = {}
+        invalid = 0
+        for (id_value, id_type, bibstem, journal_name, publisher) in records:
+            key = compact_issn(id_value)
+            if not key:
+                invalid += 1
+                continue
+            if not normalize_issn(key):
+                invalid += 1
+            # the first ident wins, as in the database lookup
+            if key not in issns:
+                issns[key] = (id_value, sys.intern(id_type), bibstem, journal_name,
+                              sys.intern(publisher) if publisher else None)
+        self.issns = issns
+        self.signature = signature
+        self.last_check = self.clock()
+        if self.logger:
+            self.logger.info('ISSN resolver loaded %s ISSNs (%s malformed or with a bad check digit)' % (len(issns), invalid))
+        return len(issns)
+
+    def refresh(self):
+        # reload if the ISSN tables changed; only one refresh runs at a time
+        if not self._refreshing.acquire(False):
+            return
+        try:
+            self.last_check = self.clock()
+            with queries.read_only(self.engine) as conn:
+                signature = queries.get_issn_signature(conn)
+            if signature != self.signature or self.issns is None:
+                self.load()
+        except Exception as err:
+            if self.logger:
+                self.logger.warning('ISSN resolver refresh failed: %s' % err)
+        finally:
+            self._refreshing.release()
+
+    def maybe_refresh(self):
+        # called per request; the check runs on a background thread so the
+        # request itself never waits on the database
+        if self.clock() - self.last_check >= self.refresh_interval:
+            self.last_check = self.clock()
+            thread = threading.Thread(target=self.refresh)
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def loaded(self):
+        return self.issns is not None
+
+    def resolve(self, issn):
+        # the issn response for issn, {} if unknown (see resolve_issn)
+        return resolve_issn(issn, self.response)
+
+    def response(self, key):
+        record = self.issns.get(key, None)
+        if record is None:
+            return {}
+        (id_value, id_type, bibstem, journal_name, publisher) = record
+        return {'ISSN': id_value,
+                'ISSN_type': id_type,
+                'bibstem': bibstem,
+                'publisher': publisher,
+                'journal_name': journal_name}
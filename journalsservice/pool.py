@@ -0,0 +1,40 @@
+from sqlalchemy import and_, select
+from journalsdb.models import JournalsMaster, JournalsIdentifiers, JournalsAbbreviations
+
+
+def pool_status(engine):
+    # QueuePool counters; pools without them (e.g. sqlite's) report None
+    pool = engine.pool
+    stats = {'class': pool.__class__.__name__}
+    for name in ['size', 'checkedin', 'checkedout', 'overflow']:
+        method = getattr(pool, name, None)
+        stats[name] = method() if callable(method) else None
+    return stats
+
+
+def prime_queries(connection):
+    # one pass over the lookups every endpoint starts with, so the first
+    # requests after a deploy don't pay for cold caches
+    bibstem = connection.execute(select([JournalsMaster.bibstem]).limit(1)).scalar()
+    connection.execute(select([JournalsMaster]).where(JournalsMaster.bibstem==bibstem)).fetchall()
+    connection.execute(select([JournalsAbbreviations.masterid]).where(JournalsAbbreviations.abbreviation.ilike('%%%s%%' % bibstem))).fetchall()
+    connection.execute(select([JournalsIdentifiers]).where(and_(JournalsIdentifiers.id_value=='0000-0000', JournalsIdentifiers.id_type.like('ISSN%')))).fetchall()
+
+
+def warm_pool(engine, connections=1, logger=None):
+    # check out several connections at once so the pool really opens them,
+    # then return them all to the pool
+    opened = []
+    try:
+        for i in range(max(connections, 1)):
+            opened.append(engine.connect())
+        prime_queries(opened[0])
+    except Exception as err:
+        if logger:
+            logger.warning('Connection pool warm-up failed: %s' % err)
+    finally:
+        for conn in opened:
+            conn.close()
+    if logger:
+        logger.info('Connection pool warmed: %s' % pool_status(engine))
+    return len(opened)
@@ -0,0 +1,72 @@
+import threading
+import unittest
+
+from journalsservice.adsquery import ADSQuery, HoldingsQueryException
+
+
+class StubResponse(object):
+
+    def __init__(self, data, status=200):
+        self.data = data
+        self.status = status
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise Exception('HTTP %s' % self.status)
+
+    def json(self):
+        return self.data
+
+
+class StubSearchClient(object):
+    # answers bibstem:X,volume:V queries with cursorMark paging over
+    # `count` synthetic records per volume; volume 'bad' returns a 500
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get(self, url=None, params=None, headers=None):
+        with self.lock:
+            self.calls.append(dict(params))
+        volume = params['q'].split('volume:')[1]
+        if volume == 'bad':
+            return StubResponse({}, status=500)
+        count = self.counts.get(volume, 0)
+        start = 0 if params['cursorMark'] == '*' else int(params['cursorMark'])
+        end = min(start + params['rows'], count)
+        docs = [{'bibstem': ['ApJ'], 'volume': volume, 'page': [str(i + 1)], 'esources': ['PUB_PDF']} for i in range(start, end)]
+        return StubResponse({'responseHeader': {'status': 0},
+                             'response': {'numFound': count, 'start': 0, 'docs': docs},
+                             'nextCursorMark': str(end)})
+
+
+class TestADSQuery(unittest.TestCase):
+
+    def query(self, client, rows=10):
+        return ADSQuery(client=client, queryurl='http://localhost/search', token='Bearer x', rows=rows, max_pages=100, max_workers=4)
+
+    def test_search_follows_cursor(self):
+        client = StubSearchClient({'880': 25})
+        result = self.query(client).search('ApJ', '880')
+        docs = result['response']['docs']
+        self.assertEqual(result['response']['numFound'], 25)
+        self.assertEqual([d['page'][0] for d in docs], [str(i + 1) for i in range(25)])
+        self.assertEqual([c['cursorMark'] for c in client.calls], ['*', '10', '20'])
+        self.assertNotIn('nextCursorMark', result)
+
+    def test_search_single_page(self):
+        client = StubSearchClient({'1': 3})
+        result = self.query(client).search('ApJ', '1')
+        self.assertEqual(len(result['response']['docs']), 3)
+        self.assertEqual(len(client.calls), 1)
+
+    def test_search_volumes(self):
+        client = StubSearchClient({'1': 5, '2': 12, '3': 0})
+        results = self.query(client).search_volumes('ApJ', ['1', '2', 'bad', '3'])
+        self.assertEqual([v for (v, r) in results], ['1', '2', 'bad', '3'])
+        self.assertEqual(len(results[0][1]['response']['docs']), 5)
+        self.assertEqual(len(results[1][1]['response']['docs']), 12)
+        self.assertIsInstance(results[2][1], HoldingsQueryException)
+        self.assertEqual(results[3][1]['response']['docs'], [])
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from urllib.parse import parse_qs
+
+import httpx
+from flask import Flask
+
+from journalsdb.holdingsindex import HoldingsIndex, write_index
+from journalsservice.asgi import JournalsASGI
+from journalsservice.holdingscache import HoldingsCache
+
+
+async def stub_search_api(scope, receive, send):
+    # minimal search API: `count` records per volume, paged by cursorMark
+    counts = {'880': 25, '881': 3}
+    params = dict((k, v[0]) for (k, v) in parse_qs(scope['query_string'].decode()).items())
+    volume = params['q'].split('volume:')[1]
+    start = 0 if params['cursorMark'] == '*' else int(params['cursorMark'])
+    end = min(start + int(params['rows']), counts.get(volume, 0))
+    docs = [{'bibstem': ['ApJ'], 'volume': volume, 'year': '1990', 'page': [str(i + 1)], 'esources': ['PUB_PDF']} for i in range(start, end)]
+    body = json.dumps({'response': {'numFound': counts.get(volume, 0), 'start': 0, 'docs': docs},
+                       'nextCursorMark': str(end)}).encode()
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class TestJournalsASGI(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.config.update({'HOLDINGS_ADS_QUERY_URL': 'http://upstream/search',
+                           'HOLDINGS_ROWS': 10,
+                           'JOURNALSDB_MAX_SUBMITTED': 2,
+                           'ASGI_THREADS': 2})
+        app.holdings_cache = HoldingsCache(maxsize=10)
+
+        @app.route('/ping')
+        def ping():
+            return 'pong'
+
+        barrier = threading.Barrier(2, timeout=5)
+
+        @app.route('/wait')
+        def wait():
+            # returns only once two requests are in views at the same time
+            barrier.wait()
+            return threading.current_thread().name
+
+        self.asgi = JournalsASGI(app)
+        self.asgi.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub_search_api))
+
+    def tearDown(self):
+        self.asgi.executor.shutdown(wait=True)
+
+    def run_requests(self, *requests):
+        async def run():
+            transport = httpx.ASGITransport(app=self.asgi)
+            async with httpx.AsyncClient(transport=transport, base_url='http://service') as client:
+                return [await client.request(method, url, **kwargs) for (method, url, kwargs) in requests]
+        return asyncio.run(run())
+
+    def test_holdings(self):
+        (r,) = self.run_requests(('GET', '/holdings/ApJ./880', {}))
+        self.assertEqual(r.status_code, 200)
+        result = r.json()
+        self.assertEqual(result['numFound'], 25)
+        self.assertEqual(len(result['holdings']), 25)
+        self.assertEqual(result['bibstem'], 'ApJ')
+        self.assertEqual(self.asgi.flask_app.holdings_cache.status()['size'], 1)
+
+    def test_holdings_batch(self):
+        (r, too_many) = self.run_requests(('POST', '/holdings/ApJ', {'json': {'volumes': ['880', '881']}}),
+                                          ('POST', '/holdings/ApJ', {'json': {'volumes': ['1', '2', '3']}}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([h['numFound'] for h in r.json()['holdings']], [25, 3])
+        self.assertEqual(too_many.status_code, 400)
+
+    def test_other_routes_go_to_flask(self):
+        (r,) = self.run_requests(('GET', '/ping', {}))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, 'pong')
+
+    def test_flask_views_run_on_the_pool(self):
+        async def run():
+            transport = httpx.ASGITransport(app=self.asgi)
+            async with httpx.AsyncClient(transport=transport, base_url='http://service') as client:
+                return await asyncio.gather(client.get('/wait'), client.get('/wait'))
+        responses = asyncio.run(run())
+        self.assertEqual([r.status_code for r in responses], [200, 200])
+        self.assertEqual(len(set(r.text for r in responses)), 2)
+
+    def test_holdings_from_index(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            write_index(os.path.join(tmpdir, 'index'), {('ApJ', '880'): ['2', '1']})
+            self.asgi.flask_app.holdings_index = HoldingsIndex(os.path.join(tmpdir, 'index'))
+            (local, upstream) = self.run_requests(('GET', '/holdings/ApJ/880?esources=false', {}),
+                                                  ('GET', '/holdings/ApJ/880', {}))
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(local.json(), {'bibstem': 'ApJ', 'volume': '880', 'numFound': 2,
+                                        'holdings': [{'page': '1'}, {'page': '2'}]})
+        self.assertEqual(upstream.json()['numFound'], 25)
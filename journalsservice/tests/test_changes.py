@@ -0,0 +1,95 @@
+import unittest
+
+from datetime import datetime
+from sqlalchemy import create_engine
+
+from journalsdb import edits, queries
+from journalsdb.models import JournalsIdentifiersHistory, JournalsMasterHistory, JournalsPublisherHistory
+from journalsservice.tests.test_queries import create_tables
+
+
+def when(hour):
+    return datetime(2026, 1, 1, hour)
+
+
+class TestChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_tables(self.engine)
+        master = {'primary_language': 'en', 'multilingual': False, 'defunct': False, 'pubtype': 'Journal', 'refereed': 'yes', 'not_indexed': False, 'deprecated': False}
+        with self.engine.begin() as conn:
+            conn.execute(queries.master.insert(), [dict(master, masterid=1, bibstem='ApJ', journal_name='The Astrophysical Journal', created=when(0)),
+                                                   dict(master, masterid=3, bibstem='AJ', journal_name='The Astronomical Journal', created=when(0))])
+            conn.execute(queries.publisher.insert(), {'publisherid': 1, 'pubabbrev': 'IOP', 'created': when(0)})
+            conn.execute(queries.titlehistory.insert(), {'titlehistoryid': 1, 'masterid': 3, 'publisherid': 1, 'created': when(0)})
+            # 1: idents checkin, updating identid 1 and creating identid 2
+            # 2: deletion of MNRAS, 3: publisher checkin, 4: still active,
+            # 5: completed after 4 started
+            conn.execute(queries.editctrl.insert(), [{'editid': 1, 'tablename': 'idents', 'editstatus': 'completed', 'editfileid': 'a', 'created': when(1), 'updated': when(2)},
+                                                     {'editid': 2, 'tablename': 'master', 'editstatus': 'completed', 'editfileid': 'Command line deletion', 'created': when(3), 'updated': when(3)},
+                                                     {'editid': 3, 'tablename': 'publisher', 'editstatus': 'completed', 'editfileid': 'c', 'created': when(4), 'updated': when(5)},
+                                                     {'editid': 4, 'tablename': 'names', 'editstatus': 'active', 'editfileid': 'd', 'created': when(6), 'updated': None},
+                                                     {'editid': 5, 'tablename': 'abbrevs', 'editstatus': 'completed', 'editfileid': 'e', 'created': when(7), 'updated': when(8)}])
+            conn.execute(queries.idents.insert(), [{'identid': 1, 'masterid': 1, 'id_type': 'ISSN_print', 'id_value': '0004-637X', 'created': when(0)},
+                                                   {'identid': 2, 'masterid': 1, 'id_type': 'ISSN_electronic', 'id_value': '1538-4357', 'created': when(1)}])
+            conn.execute(JournalsIdentifiersHistory.__table__.insert(), {'histid': 1, 'editid': 1, 'identid': 1, 'masterid': 1, 'id_type': 'ISSN_print', 'id_value': '0004-6370'})
+            conn.execute(JournalsMasterHistory.__table__.insert(), {'histid': 1, 'editid': 2, 'masterid': 2, 'bibstem': 'MNRAS'})
+            conn.execute(JournalsPublisherHistory.__table__.insert(), {'histid': 1, 'editid': 3, 'publisherid': 1, 'pubabbrev': 'IoP'})
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_changes(self):
+        with queries.read_only(self.engine) as conn:
+            result = queries.changes_json(conn, 0)
+        self.assertEqual(result['latest'], 3)
+        self.assertIsNone(result['next'])
+        self.assertEqual([(c['editid'], c['table'], c['id'], c['change'], c['bibstem']) for c in result['changes']],
+                         [(1, 'idents', 1, 'updated', 'ApJ'),
+                          (1, 'idents', 2, 'created', 'ApJ'),
+                          (2, 'master', 2, 'deleted', 'MNRAS'),
+                          (3, 'publisher', 1, 'updated', None)])
+        self.assertEqual(result['bibstems'], ['AJ', 'ApJ', 'MNRAS'])
+
+    def test_reverts(self):
+        # 6 deletes AJ and 7 reverts it; 8 reverts the idents checkin
+        with self.engine.begin() as conn:
+            conn.execute(queries.editctrl.update().where(queries.editctrl.c.editid==4).values(editstatus='cancelled', updated=when(6)))
+            conn.execute(queries.editctrl.insert(), [{'editid': 6, 'tablename': 'master', 'editstatus': 'completed', 'editfileid': edits.DELETION_EDITFILEIDS[0], 'created': when(9), 'updated': when(9)},
+                                                     {'editid': 7, 'tablename': 'master', 'editstatus': 'completed', 'editfileid': edits.REVERT_EDITFILEID, 'created': when(10), 'updated': when(11)},
+                                                     {'editid': 8, 'tablename': 'idents', 'editstatus': 'completed', 'editfileid': edits.REVERT_EDITFILEID, 'created': when(12), 'updated': when(13)}])
+            edits.archive_and_delete(conn, [3], 6)
+            edits.revert_edit(conn, 6, reinsert=True, revertid=7)
+            edits.revert_edit(conn, 1, revertid=8)
+        with queries.read_only(self.engine) as conn:
+            result = queries.changes_json(conn, 5)
+            self.assertEqual([(c['editid'], c['table'], c['id'], c['change'], c['bibstem']) for c in result['changes']],
+                             [(6, 'master', 3, 'deleted', 'AJ'),
+                              (6, 'titlehistory', 1, 'deleted', 'AJ'),
+                              (7, 'master', 3, 'created', 'AJ'),
+                              (7, 'titlehistory', 1, 'created', 'AJ'),
+                              (8, 'idents', 1, 'updated', 'ApJ')])
+            # the edit keeps reporting what it did, not the live state
+            self.assertEqual([c['change'] for c in queries.changes_json(conn, 1)['changes'] if c['editid'] == 6],
+                             ['deleted', 'deleted'])
+            # the revert archived the value it overwrote
+            hist = JournalsIdentifiersHistory.__table__
+            self.assertEqual([(r.editid, r.id_value) for r in conn.execute(hist.select().order_by(hist.c.histid))],
+                             [(1, '0004-6370'), (8, '0004-637X')])
+            self.assertEqual(conn.execute(queries.idents.select().where(queries.idents.c.identid==1)).first().id_value, '0004-6370')
+
+    def test_pages(self):
+        seen = []
+        after = None
+        with queries.read_only(self.engine) as conn:
+            while True:
+                result = queries.changes_json(conn, 1, after=after, limit=1)
+                seen.extend((c['editid'], c['id']) for c in result['changes'])
+                if not result['next']:
+                    break
+                after = queries.parse_change_cursor(result['next'])
+            self.assertEqual(seen, [(2, 2), (3, 1)])
+            self.assertEqual(queries.changes_json(conn, result['latest'])['changes'], [])
+        with self.assertRaises(ValueError):
+            queries.parse_change_cursor('1,editcontrol,1')
@@ -0,0 +1,87 @@
+import gzip
+import json
+import unittest
+import zlib
+
+from types import SimpleNamespace
+
+from flask import Flask
+from mock import patch
+from sqlalchemy import create_engine
+
+from journalsdb import queries
+from journalsservice.views import Dump
+from journalsservice.tests.test_queries import create_tables
+
+
+class TestDump(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_tables(self.engine)
+        master = {'primary_language': 'en', 'multilingual': False, 'defunct': False, 'not_indexed': False, 'deprecated': False}
+        with self.engine.begin() as conn:
+            conn.execute(queries.master.insert(), [dict(master, masterid=1, bibstem='ApJ', journal_name='The Astrophysical Journal', pubtype='Journal', refereed='yes', collection='AST'),
+                                                   dict(master, masterid=2, bibstem='PhRvD', journal_name='Physical Review D', pubtype='Journal', refereed='yes', collection='PHY'),
+                                                   dict(master, masterid=3, bibstem='IAUS', journal_name='IAU Symposium', pubtype='Conf. Proc.', refereed='na', collection='AST')])
+            conn.execute(queries.profile.insert(), queries.build_profiles(conn, [1]))
+
+        self.app = Flask(__name__)
+        self.app.config['DUMP_BATCH_SIZE'] = 2
+        self.app.db = SimpleNamespace(engine=self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_iter_dump(self):
+        with queries.read_only(self.engine) as conn:
+            batches = list(queries.iter_dump(conn, batch_size=2))
+            self.assertEqual([len(b) for b in batches], [2, 1])
+            # the profile row and the live fallback give the same document
+            self.assertEqual(json.loads(batches[0][0]), queries.get_summary(conn, 'ApJ')[1])
+            self.assertEqual(json.loads(batches[0][1])['master']['bibstem'], 'PhRvD')
+            ast = [json.loads(j)['master']['bibstem'] for b in queries.iter_dump(conn, collection='ast') for j in b]
+            self.assertEqual(ast, ['ApJ', 'IAUS'])
+            proc = [json.loads(j)['master']['bibstem'] for b in queries.iter_dump(conn, pubtype='Conf. Proc.') for j in b]
+            self.assertEqual(proc, ['IAUS'])
+
+    def get(self, url, headers={}):
+        with self.app.test_request_context(url, headers=headers):
+            r = Dump().get()
+            return (r, [chunk for chunk in r.response])
+
+    def test_stream(self):
+        (r, chunks) = self.get('/dump?refereed=yes')
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        self.assertTrue(r.is_streamed)
+        self.assertEqual(len(chunks), 1)
+        lines = b''.join(chunks).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(l)['master']['bibstem'] for l in lines], ['ApJ', 'PhRvD'])
+
+    def test_gzip(self):
+        (r, chunks) = self.get('/dump', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(b''.join(chunks)).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 3)
+
+    def test_failure_mid_stream(self):
+        def failing(conn, **kwargs):
+            yield ['{"master": {}}']
+            raise RuntimeError('connection lost')
+
+        for headers in [{}, {'Accept-Encoding': 'gzip'}]:
+            with patch('journalsservice.views.queries.iter_dump', failing):
+                with self.app.test_request_context('/dump', headers=headers):
+                    chunks = []
+                    with self.assertRaises(RuntimeError):
+                        for chunk in Dump().get().response:
+                            chunks.append(chunk)
+            body = b''.join(chunks)
+            if headers:
+                d = zlib.decompressobj(31)
+                body = d.decompress(body)
+                # no gzip trailer, so the stream reads as truncated
+                self.assertFalse(d.eof)
+            lines = body.decode('utf-8').splitlines()
+            self.assertEqual(json.loads(lines[0]), {'master': {}})
+            self.assertEqual(json.loads(lines[-1]), {'error': 'Dump failed: connection lost'})
@@ -0,0 +1,135 @@
+import unittest
+
+from datetime import datetime
+from sqlalchemy import create_engine, select
+
+from journalsdb import edits, queries
+from journalsservice.tests.test_queries import create_tables
+
+T = edits.TABLES
+
+
+class TestEdits(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_tables(self.engine)
+        master = {'primary_language': 'en', 'multilingual': False, 'defunct': False, 'pubtype': 'Journal', 'refereed': 'yes', 'not_indexed': False, 'deprecated': False}
+        with self.engine.begin() as conn:
+            conn.execute(T['master'].insert(), [dict(master, masterid=1, bibstem='ApJ', journal_name='The Astrophysical Journal'),
+                                                dict(master, masterid=2, bibstem='AJ', journal_name='The Astronomical Journal')])
+            conn.execute(T['abbrevs'].insert(), [{'abbrevid': 1, 'masterid': 1, 'abbreviation': 'Astrophys. J.'},
+                                                 {'abbrevid': 2, 'masterid': 2, 'abbreviation': 'Astron. J.'}])
+            conn.execute(T['idents'].insert(), [{'identid': 1, 'masterid': 1, 'id_type': 'ISSN_print', 'id_value': '0004-637X'}])
+            conn.execute(T['publisher'].insert(), [{'publisherid': 1, 'pubabbrev': 'IOP'}])
+            conn.execute(T['titlehistory'].insert(), [{'titlehistoryid': 1, 'masterid': 1, 'year_start': 1895, 'publisherid': 1}])
+            conn.execute(T['raster'].insert(), [{'rasterid': 1, 'masterid': 1}])
+            conn.execute(T['rastervolume'].insert(), [{'rvolid': 1, 'rasterid': 1, 'volume_number': '1'}])
+            conn.execute(T['refsource'].insert(), [{'refsourceid': 1, 'masterid': 1, 'refsource_list': '{}'}])
+            conn.execute(T['completeness'].insert(), [{'complid': 1, 'masterid': 1, 'volume': '1', 'details': '{}'}])
+            conn.execute(queries.profile.insert(), queries.build_profiles(conn, [1, 2]))
+            conn.execute(T['editcontrol'].insert(), {'editid': 5, 'tablename': 'master', 'editstatus': 'active', 'editfileid': 'Command line deletion'})
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def rows(self, conn, tablename, **where):
+        t = T[tablename]
+        query = select([t])
+        for (k, v) in where.items():
+            query = query.where(t.c[k]==v)
+        return [dict(r) for r in conn.execute(query)]
+
+    def test_archive_and_delete(self):
+        with self.engine.begin() as conn:
+            counts = edits.archive_and_delete(conn, [1], 5)
+        self.assertEqual(counts, {'rastervol': 1, 'names': 0, 'abbrevs': 1, 'idents': 1, 'raster': 1, 'titlehistory': 1,
+                                  'refsource': 1, 'completeness': 1, 'profile': 1, 'master': 1})
+        with self.engine.connect() as conn:
+            for tablename in ['master', 'abbrevs', 'idents', 'raster', 'titlehistory', 'refsource', 'completeness', 'profile']:
+                self.assertEqual(self.rows(conn, tablename, masterid=1), [], tablename)
+            self.assertEqual(self.rows(conn, 'rastervolume'), [])
+            # the other journal is untouched
+            self.assertEqual([r['bibstem'] for r in self.rows(conn, 'master')], ['AJ'])
+            self.assertEqual([r['abbreviation'] for r in self.rows(conn, 'abbrevs')], ['Astron. J.'])
+            # and the deleted rows are archived under the edit
+            hist = self.rows(conn, 'master_hist')
+            self.assertEqual([(r['editid'], r['masterid'], r['bibstem']) for r in hist], [(5, 1, 'ApJ')])
+            self.assertIsNotNone(hist[0]['superseded'])
+            self.assertEqual([(r['editid'], r['abbrevid'], r['abbreviation']) for r in self.rows(conn, 'abbrevs_hist')], [(5, 1, 'Astrophys. J.')])
+            self.assertEqual([(r['editid'], r['id_value']) for r in self.rows(conn, 'idents_hist')], [(5, '0004-637X')])
+            self.assertEqual([(r['editid'], r['rasterid']) for r in self.rows(conn, 'raster_hist')], [(5, 1)])
+            self.assertEqual([(r['editid'], r['year_start']) for r in self.rows(conn, 'titlehistory_hist')], [(5, 1895)])
+
+    def test_revert_deletion(self):
+        with self.engine.begin() as conn:
+            before = dict((t, self.rows(conn, t, masterid=1)) for t in ['master', 'abbrevs', 'idents', 'raster', 'titlehistory'])
+            edits.archive_and_delete(conn, [1], 5)
+        with self.engine.begin() as conn:
+            self.assertEqual(edits.revert_edit(conn, 5, reinsert=True, dry_run=True)['master'], {'updated': 0, 'inserted': 1})
+            self.assertEqual(self.rows(conn, 'master', masterid=1), [])
+            counts = edits.revert_edit(conn, 5, reinsert=True)
+        self.assertEqual(counts, {'master': {'updated': 0, 'inserted': 1},
+                                  'abbrevs': {'updated': 0, 'inserted': 1},
+                                  'idents': {'updated': 0, 'inserted': 1},
+                                  'raster': {'updated': 0, 'inserted': 1},
+                                  'titlehistory': {'updated': 0, 'inserted': 1}})
+        with self.engine.connect() as conn:
+            for (tablename, rows) in before.items():
+                self.assertEqual(self.rows(conn, tablename, masterid=1), rows, tablename)
+            # the archived rows stay in _hist
+            self.assertEqual(len(self.rows(conn, 'master_hist', editid=5)), 1)
+
+    def test_revert_update(self):
+        # an edit that renamed a journal archived the old row under editid 6
+        with self.engine.begin() as conn:
+            conn.execute(T['master_hist'].insert(), dict(self.rows(conn, 'master', masterid=1)[0], histid=1, editid=6))
+            conn.execute(T['master'].update().where(T['master'].c.masterid==1).values(bibstem='ApJ..', journal_name='Astrophysical Journal', updated=datetime(2020, 1, 1)))
+            signature = queries.get_master_signature(conn)
+        with self.engine.begin() as conn:
+            counts = edits.revert_edit(conn, 6)
+        self.assertEqual(counts, {'master': {'updated': 1, 'inserted': 0}})
+        with self.engine.connect() as conn:
+            self.assertEqual([(r['bibstem'], r['journal_name']) for r in self.rows(conn, 'master')],
+                             [('ApJ', 'The Astrophysical Journal'), ('AJ', 'The Astronomical Journal')])
+            # the reverted row is stamped as updated, so the masterdict
+            # cache sees the rename back
+            self.assertGreater(self.rows(conn, 'master', masterid=1)[0]['updated'], datetime(2020, 1, 1))
+            self.assertNotEqual(queries.get_master_signature(conn), signature)
+
+    def test_load_completeness(self):
+        with self.engine.begin() as conn:
+            conn.execute(T['master'].insert(), dict(self.rows(conn, 'master', masterid=2)[0], masterid=3, bibstem='PASP', journal_name='PASP'))
+        masterdict = {'ApJ': 1, 'AJ': 2, 'PASP': 3}
+        journals = [{'bibstem': 'ApJ', 'title_completeness_fraction': 0.9,
+                     'completeness_details': [{'volume': '1', 'completeness_fraction': 1.0},
+                                              {'volume': 'L1', 'completeness_fraction': 0.5}]},
+                    {'bibstem': 'XXX', 'title_completeness_fraction': 0.8, 'completeness_details': []},
+                    {'bibstem': 'AJ', 'title_completeness_fraction': 0.7, 'completeness_details': [{'volume': 2}]},
+                    {'bibstem': 'PASP', 'title_completeness_fraction': 0.1, 'completeness_details': [{'volume': '3'}]},
+                    {'bibstem': 'AJ', 'title_completeness_fraction': 0.75, 'completeness_details': [{'volume': '4'}]}]
+        with self.engine.begin() as conn:
+            result = edits.load_completeness(conn, iter(journals), masterdict, critc=0.5, batch_size=1)
+        self.assertEqual(result, {'updated': set([1, 2]), 'missing': ['XXX'], 'duplicates': ['AJ'], 'skipped': 1})
+        with self.engine.connect() as conn:
+            fractions = dict((r['bibstem'], r['completeness_fraction']) for r in self.rows(conn, 'master'))
+            self.assertEqual(fractions, {'ApJ': '0.9', 'AJ': '0.75', 'PASP': None})
+            volumes = sorted((r['masterid'], r['volume'], r['volume_number']) for r in self.rows(conn, 'completeness'))
+            # ApJ's old row is replaced, and AJ keeps only its last entry
+            self.assertEqual(volumes, [(1, '1', 1), (1, 'L1', None), (2, '4', 4)])
+
+        # a second load in one batch replaces the rows again
+        with self.engine.begin() as conn:
+            edits.load_completeness(conn, journals[0:1], masterdict, batch_size=1000)
+            self.assertEqual(len(self.rows(conn, 'completeness', masterid=1)), 2)
+
+    def test_completeness_volume_range(self):
+        details = [{'volume': str(v), 'completeness_fraction': v / 10.0} for v in range(1, 6)] + [{'volume': 'S1'}]
+        with self.engine.begin() as conn:
+            edits.load_completeness(conn, [{'bibstem': 'ApJ', 'title_completeness_fraction': 0.5, 'completeness_details': details}], {'ApJ': 1})
+        with self.engine.connect() as conn:
+            self.assertEqual(queries.get_completeness_details(conn, 1)['completeness_by_volume'], details)
+            self.assertEqual(queries.get_completeness_details(conn, 1, vol_start=2, vol_end=3)['completeness_by_volume'], details[1:3])
+            # volumes that aren't plain integers only come back without a range
+            self.assertEqual(queries.get_completeness_details(conn, 1, vol_start=5)['completeness_by_volume'], details[4:5])
+            self.assertEqual(queries.get_completeness_details(conn, 2)['completeness_by_volume'], [])
@@ -0,0 +1,88 @@
+import threading
+import time
+import unittest
+
+from datetime import datetime
+
+from journalsservice.holdingscache import HoldingsCache
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestHoldingsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = HoldingsCache(maxsize=2, ttl_closed=100, ttl_current=10,
+                                   stale_ttl=50, closed_age=2, clock=self.clock)
+        self.calls = 0
+
+    def loader(self, value, ttl=10):
+        def load():
+            self.calls += 1
+            return (value, ttl)
+        return load
+
+    def test_fresh_and_expired(self):
+        self.assertEqual(self.cache.get(('ApJ', '1'), self.loader('a')), 'a')
+        self.assertEqual(self.cache.get(('ApJ', '1'), self.loader('b')), 'a')
+        self.assertEqual(self.calls, 1)
+        self.clock.now += 100
+        self.assertEqual(self.cache.get(('ApJ', '1'), self.loader('c')), 'c')
+        self.assertEqual(self.calls, 2)
+
+    def test_stale_while_revalidate(self):
+        self.cache.get(('ApJ', '1'), self.loader('a'))
+        self.clock.now += 20
+        # stale value is returned while the refresh runs in the background
+        self.assertEqual(self.cache.get(('ApJ', '1'), self.loader('b')), 'a')
+        self.cache._refresher.shutdown(wait=True)
+        self.assertEqual(self.cache.get(('ApJ', '1'), self.loader('c')), 'b')
+        self.assertEqual(self.cache.status()['stale'], 1)
+
+    def test_coalesced_loads(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_load():
+            self.calls += 1
+            started.set()
+            release.wait(5)
+            return ('slow', 10)
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(self.cache.get(('ApJ', '2'), slow_load)))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=lambda: results.append(self.cache.get(('ApJ', '2'), slow_load)))
+        second.start()
+        time.sleep(0.05)
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(results, ['slow', 'slow'])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.status()['coalesced'], 1)
+
+    def test_errors_not_cached_and_lru(self):
+        def fail():
+            raise ValueError('upstream down')
+        self.assertRaises(ValueError, self.cache.get, ('ApJ', '3'), fail)
+        self.assertEqual(self.cache.get(('ApJ', '3'), self.loader('ok')), 'ok')
+        self.cache.get(('ApJ', '4'), self.loader('x'))
+        self.cache.get(('ApJ', '5'), self.loader('y'))
+        self.assertEqual(self.cache.status()['size'], 2)
+        self.assertEqual(self.cache.get(('ApJ', '3'), self.loader('new')), 'new')
+
+    def test_volume_ttl(self):
+        year = datetime.now().year
+        self.assertEqual(self.cache.volume_ttl(['1995', '1996']), 100)
+        self.assertEqual(self.cache.volume_ttl([str(year)]), 10)
+        self.assertEqual(self.cache.volume_ttl([]), 10)
@@ -0,0 +1,108 @@
+import unittest
+
+from types import SimpleNamespace
+
+from flask import Flask
+from sqlalchemy import create_engine
+
+from journalsdb import queries
+from journalsservice.issnresolver import ISSNResolver, compact_issn, normalize_issn
+from journalsservice.tests.test_queries import create_tables
+from journalsservice.views import ISSN
+
+
+class TestNormalize(unittest.TestCase):
+
+    def test_compact(self):
+        self.assertEqual(compact_issn('0004-637x'), '0004637X')
+        self.assertEqual(compact_issn(' 0004637X '), '0004637X')
+        self.assertIsNone(compact_issn('0004-63'))
+        self.assertIsNone(compact_issn('X004-6370'))
+        self.assertIsNone(compact_issn(None))
+
+    def test_check_digit(self):
+        self.assertEqual(normalize_issn('0004637x'), '0004-637X')
+        self.assertEqual(normalize_issn('0035-8711'), '0035-8711')
+        self.assertIsNone(normalize_issn('0035-8712'))
+
+
+class TestISSNResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_tables(self.engine)
+        with self.engine.begin() as conn:
+            master = {'primary_language': 'en', 'multilingual': False, 'defunct': False, 'pubtype': 'Journal', 'refereed': 'yes', 'not_indexed': False, 'deprecated': False}
+            conn.execute(queries.master.insert(), [dict(master, masterid=1, bibstem='ApJ', journal_name='The Astrophysical Journal'),
+                                                   dict(master, masterid=2, bibstem='MNRAS', journal_name='Monthly Notices of the Royal Astronomical Society')])
+            conn.execute(queries.idents.insert(), [{'identid': 1, 'masterid': 1, 'id_type': 'ISSN_print', 'id_value': '0004-637X'},
+                                                   {'identid': 2, 'masterid': 2, 'id_type': 'ISSN_print', 'id_value': '0035-8711'},
+                                                   {'identid': 3, 'masterid': 2, 'id_type': 'ISSN_electronic', 'id_value': '1365-2966'},
+                                                   {'identid': 4, 'masterid': 2, 'id_type': 'CODEN', 'id_value': 'MNRAA4'}])
+            conn.execute(queries.publisher.insert(), [{'publisherid': 1, 'pubabbrev': 'IOP'},
+                                                      {'publisherid': 2, 'pubabbrev': 'OUP'},
+                                                      {'publisherid': 3, 'pubabbrev': 'Blackwell'}])
+            conn.execute(queries.titlehistory.insert(), [{'titlehistoryid': 1, 'masterid': 1, 'year_start': 1895, 'year_end': None, 'publisherid': 1},
+                                                         {'titlehistoryid': 2, 'masterid': 2, 'year_start': 1827, 'year_end': 2012, 'publisherid': 3},
+                                                         {'titlehistoryid': 3, 'masterid': 2, 'year_start': 2013, 'year_end': None, 'publisherid': 2}])
+        self.resolver = ISSNResolver(self.engine, refresh_interval=0)
+        self.resolver.load()
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_resolve(self):
+        self.assertEqual(len(self.resolver.issns), 3)
+        with queries.read_only(self.engine) as conn:
+            expected = queries.issn_json(conn, '1365-2966')
+        self.assertEqual(self.resolver.resolve('13652966'), expected)
+        self.assertEqual(self.resolver.resolve('0035-8711')['publisher'], 'OUP')
+        self.assertEqual(self.resolver.resolve('0004-637x')['bibstem'], 'ApJ')
+        self.assertEqual(self.resolver.resolve('1234-5679'), {})
+        with self.assertRaises(ValueError):
+            self.resolver.resolve('1234-5678')
+        with self.assertRaises(ValueError):
+            self.resolver.resolve('MNRAA4')
+
+    def test_refresh(self):
+        self.resolver.refresh()
+        self.assertEqual(self.resolver.resolve('2041-8205'), {})
+        with self.engine.begin() as conn:
+            conn.execute(queries.editctrl.insert(), {'editid': 1, 'tablename': 'idents', 'editstatus': 'completed', 'editfileid': 'x'})
+            conn.execute(queries.idents.insert(), {'identid': 5, 'masterid': 1, 'id_type': 'ISSN_electronic', 'id_value': '2041-8205'})
+        self.resolver.refresh()
+        self.assertEqual(self.resolver.resolve('2041-8205')['bibstem'], 'ApJ')
+
+    def test_refresh_without_edit(self):
+        # loads that bypass editcontrol still trigger a reload
+        with self.engine.begin() as conn:
+            conn.execute(queries.master.update().where(queries.master.c.masterid==1).values(bibstem='ApJ.'))
+        self.resolver.refresh()
+        self.assertEqual(self.resolver.resolve('0004-637X')['bibstem'], 'ApJ.')
+        with self.engine.begin() as conn:
+            conn.execute(queries.idents.insert(), {'identid': 5, 'masterid': 1, 'id_type': 'ISSN_electronic', 'id_value': '2041-8205'})
+        self.resolver.refresh()
+        self.assertEqual(self.resolver.resolve('2041-8205')['bibstem'], 'ApJ.')
+        with self.engine.begin() as conn:
+            conn.execute(queries.titlehistory.update().where(queries.titlehistory.c.titlehistoryid==1).values(publisherid=2))
+        self.resolver.refresh()
+        self.assertEqual(self.resolver.resolve('0004-637X')['publisher'], 'OUP')
+
+    def test_endpoint_with_and_without_resolver(self):
+        # the database fallback answers every input as the resolver does
+        app = Flask(__name__)
+        app.db = SimpleNamespace(engine=self.engine)
+        inputs = ['0004637x', '0035-8711', '1234-5679', '1234-5678', 'MNRAA4', '']
+        answers = {}
+        for resolver in [self.resolver, None, ISSNResolver(self.engine)]:
+            app.issn_resolver = resolver
+            for issn in inputs:
+                with app.test_request_context('/issn/%s' % issn):
+                    answers.setdefault(issn, []).append(ISSN().get(issn))
+        for issn in inputs:
+            self.assertEqual(len(set(repr(a) for a in answers[issn])), 1, issn)
+        self.assertEqual(answers['0004637x'][1][0]['issn']['bibstem'], 'ApJ')
+        self.assertEqual(answers['1234-5679'][1], ({}, 200))
+        self.assertEqual(answers['1234-5678'][1][1], 400)
+        self.assertEqual(answers['MNRAA4'][1][1], 400)
+        self.assertEqual(answers[''][1], ({'issn': {}}, 200))
@@ -0,0 +1,32 @@
+import unittest
+from mock import patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from journalsservice import pool
+
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', poolclass=QueuePool,
+                                    pool_size=3, max_overflow=0)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    @patch('journalsservice.pool.prime_queries')
+    def test_warm_pool_opens_connections(self, mock_prime):
+        opened = pool.warm_pool(self.engine, connections=3)
+        self.assertEqual(opened, 3)
+        self.assertEqual(mock_prime.call_count, 1)
+        stats = pool.pool_status(self.engine)
+        self.assertEqual(stats['class'], 'QueuePool')
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['checkedin'], 3)
+        self.assertEqual(stats['checkedout'], 0)
+
+    def test_warm_pool_failure_is_not_raised(self):
+        engine = create_engine('sqlite:////nonexistent/dir/journals.db')
+        self.assertEqual(pool.warm_pool(engine, connections=2), 0)
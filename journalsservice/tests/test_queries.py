@@ -0,0 +1,87 @@
+import unittest
+
+from sqlalchemy import create_engine, MetaData
+
+from journalsdb.models import Base
+from journalsdb import queries
+
+
+def create_tables(engine):
+    # sqlite can't autoincrement composite primary keys, so the test copy of
+    # the schema takes explicit ids instead
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        copy = table.to_metadata(metadata)
+        if len(copy.primary_key.columns) > 1:
+            for column in copy.primary_key.columns:
+                column.autoincrement = False
+    metadata.create_all(engine)
+
+
+class TestQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        create_tables(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute(queries.master.insert(), {'masterid': 1, 'bibstem': 'ApJ', 'journal_name': 'The Astrophysical Journal', 'primary_language': 'en', 'multilingual': False, 'defunct': False, 'pubtype': 'Journal', 'refereed': 'yes', 'completeness_fraction': '0.9', 'not_indexed': False, 'deprecated': False})
+            conn.execute(queries.abbrevs.insert(), [{'abbrevid': 1, 'masterid': 1, 'abbreviation': 'Astrophys. J.', 'canonical': True},
+                                                    {'abbrevid': 2, 'masterid': 1, 'abbreviation': 'ApJ', 'canonical': False}])
+            conn.execute(queries.idents.insert(), [{'identid': 1, 'masterid': 1, 'id_type': 'ISSN_print', 'id_value': '0004-637X'}])
+            conn.execute(queries.names.insert(), [{'nameid': 1, 'masterid': 1, 'name_english_translated': 'The Astrophysical Journal', 'title_language': 'en', 'name_native_language': 'The Astrophysical Journal', 'name_normalized': 'astrophysical journal'}])
+            conn.execute(queries.publisher.insert(), [{'publisherid': 1, 'pubabbrev': 'IOP'}])
+            conn.execute(queries.titlehistory.insert(), [{'titlehistoryid': 1, 'masterid': 1, 'year_start': 1895, 'vol_start': '1', 'publisherid': 1},
+                                                         {'titlehistoryid': 2, 'masterid': 1, 'year_start': 1850, 'vol_start': None, 'publisherid': None}])
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_summary(self):
+        with queries.read_only(self.engine) as conn:
+            summary = queries.summary_json(conn, queries.get_master(conn, bibstem='ApJ'))
+        self.assertEqual(summary['master']['journal_name'], 'The Astrophysical Journal')
+        self.assertNotIn('masterid', summary['master'])
+        self.assertEqual(sorted(summary['abbrev']), ['ApJ', 'Astrophys. J.'])
+        self.assertEqual(summary['idents'], [{'id_type': 'ISSN_print', 'id_value': '0004-637X'}])
+        self.assertEqual(sorted([p['publisher'] for p in summary['pubhist']]), ['IOP', 'n/a'])
+        self.assertNotIn('publisherid', summary['pubhist'][0]['title'])
+
+    def test_browse(self):
+        with queries.read_only(self.engine) as conn:
+            browse = queries.browse_json(conn, queries.get_master(conn, bibstem='ApJ'))
+        self.assertEqual(browse['canonical_abbreviation'], 'Astrophys. J.')
+        self.assertEqual(browse['completeness_estimate'], '0.9')
+        self.assertEqual(browse['title_language'], 'en')
+        self.assertEqual(browse['publication_history'], [{'publisher': 'IOP', 'start_year': 1895, 'start_volume': '1'}])
+
+    def test_issn_and_search(self):
+        with queries.read_only(self.engine) as conn:
+            issn = queries.issn_json(conn, '0004-637X')
+            missing = queries.issn_json(conn, '1234-5678')
+            journals = queries.search_journals(conn, '%Astrophys%')
+        self.assertEqual(issn['bibstem'], 'ApJ')
+        self.assertEqual(issn['publisher'], 'IOP')
+        self.assertEqual(missing, {})
+        self.assertEqual(journals, [{'bibstem': 'ApJ', 'name': 'The Astrophysical Journal', 'pubtype': 'Journal', 'refereed': 'yes'}])
+
+    def test_profiles(self):
+        with self.engine.begin() as conn:
+            conn.execute(queries.profile.insert(), queries.build_profiles(conn, [1]))
+        with queries.read_only(self.engine) as conn:
+            live = queries.summary_json(conn, queries.get_master(conn, bibstem='ApJ'))
+            dat_profile = queries.get_profile(conn, 'ApJ')
+            (masterid, summary) = queries.get_summary(conn, 'ApJ')
+            browse = queries.get_browse(conn, 'ApJ')
+            self.assertEqual(queries.get_summary(conn, 'XXX'), (None, None))
+        self.assertEqual(dat_profile.masterid, 1)
+        self.assertEqual(masterid, 1)
+        self.assertEqual(summary, live)
+        self.assertEqual(browse['classic_bibstem'], 'ApJ')
+
+    def test_master_signature(self):
+        with queries.read_only(self.engine) as conn:
+            before = queries.get_master_signature(conn)
+        with self.engine.begin() as conn:
+            conn.execute(queries.master.update().values(bibstem='ApJ..'))
+        with queries.read_only(self.engine) as conn:
+            self.assertNotEqual(queries.get_master_signature(conn), before)
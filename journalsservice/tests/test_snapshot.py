@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+
+from journalsdb import queries, snapshot
+from journalsservice.tests.test_queries import create_tables
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite://')
+        create_tables(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute(queries.master.insert(), {'masterid': 1, 'bibstem': 'ApJ', 'journal_name': 'The Astrophysical Journal', 'primary_language': 'en', 'multilingual': False, 'defunct': False, 'pubtype': 'Journal', 'refereed': 'yes', 'not_indexed': False, 'deprecated': False})
+            conn.execute(queries.idents.insert(), {'identid': 1, 'masterid': 1, 'id_type': 'ISSN_print', 'id_value': '0004-637X'})
+            conn.execute(queries.profile.insert(), queries.build_profiles(conn, [1]))
+            conn.execute(queries.editctrl.insert(), {'editid': 7, 'tablename': 'idents', 'editstatus': 'completed', 'editfileid': 'x'})
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def publish(self):
+        with self.engine.connect() as conn:
+            return snapshot.write_snapshot(conn, self.directory, batch_size=1, keep=2)
+
+    def test_write_and_serve(self):
+        (path, counts) = self.publish()
+        self.assertEqual(snapshot.current_snapshot(self.directory), path)
+        self.assertEqual(counts['master'], 1)
+        self.assertEqual(os.listdir(self.directory).count(os.path.basename(path)), 1)
+
+        db = snapshot.Snapshot(self.directory)
+        self.assertTrue(db.load())
+        self.assertEqual(db.status()['editid'], '7')
+        with queries.read_only(db) as conn:
+            (masterid, summary) = queries.get_summary(conn, 'ApJ')
+            self.assertEqual(summary['idents'], [{'id_type': 'ISSN_print', 'id_value': '0004-637X'}])
+            self.assertEqual(queries.issn_json(conn, '0004-637X')['bibstem'], 'ApJ')
+        db.engine.dispose()
+
+    def test_refresh_and_prune(self):
+        self.publish()
+        db = snapshot.Snapshot(self.directory, refresh_interval=0)
+        db.load()
+        first = db.path
+        self.assertFalse(db.load())
+        with self.engine.begin() as conn:
+            conn.execute(queries.master.update().values(journal_name='Astrophysical Journal'))
+        self.publish()
+        self.publish()
+        db.maybe_refresh()
+        self.assertNotEqual(db.path, first)
+        with queries.read_only(db) as conn:
+            self.assertEqual(queries.get_master(conn, bibstem='ApJ').journal_name, 'Astrophysical Journal')
+        snapshots = [f for f in os.listdir(self.directory) if f.endswith(snapshot.SUFFIX)]
+        self.assertEqual(len(snapshots), 2)
+        self.assertNotIn(os.path.basename(first), snapshots)
+        db.engine.dispose()
@@ -1,15 +1,17 @@
 import json
 import re
+import zlib
 
-from flask import current_app
+from flask import Response, current_app, request
 from flask_restful import Resource
 from flask_discoverer import advertise
 from datetime import datetime
 from dateutil import parser
-from journalsdb.models import JournalsMaster, JournalsAbbreviations, JournalsIdentifiers, JournalsPublisher, JournalsRefSource, JournalsTitleHistory, JournalsNames
+from journalsdb import queries
 from journalsservice.adsquery import ADSQuery
+from journalsservice.issnresolver import resolve_issn
+from journalsservice.pool import pool_status
 import adsmutils
-from sqlalchemy import or_, and_
 
 def liken(text):
     text_out = re.sub(r'[. ]{1,}', '%', text)
@@ -40,6 +42,29 @@ def sort_journals(results):
     except:
         return results
 
+def is_true(value):
+    return str(value).lower() in ['true', 't', 'yes', 'y', '1']
+
+def volume_range():
+    # optional numeric volume_start / volume_end request arguments
+    vol_start = request.args.get('volume_start', None)
+    vol_end = request.args.get('volume_end', None)
+    if vol_start is not None:
+        vol_start = int(vol_start)
+    if vol_end is not None:
+        vol_end = int(vol_end)
+    return (vol_start, vol_end)
+
+def journals_engine():
+    # the snapshot in snapshot mode, otherwise the database
+    snapshot = getattr(current_app, 'snapshot', None)
+    if snapshot is not None:
+        return snapshot
+    return current_app.db.engine
+
+def read_only_connection():
+    return queries.read_only(journals_engine())
+
 class Summary(Resource):
 
     scopes = []
@@ -50,39 +75,21 @@ class Summary(Resource):
         if bibstem:
             bibstem = bibstem.rstrip('.')
             try:
-                with current_app.session_scope() as session:
-                    dat_master = session.query(JournalsMaster).filter_by(bibstem=bibstem).first()
-                    try:
-                        masterid = dat_master.masterid
-                    except Exception as err:
+                with read_only_connection() as conn:
+                    (masterid, summary) = queries.get_summary(conn, bibstem)
+                    if not summary:
                         return {'Error': 'Search failed',
                                 'Error Info': 'Bibstem "%s" not found.' % bibstem}, 200
-                    else:
-                        dat_abbrev = [rec.toJSON()['abbreviation'] for rec in session.query(JournalsAbbreviations).filter_by(masterid=masterid).all()]
-                        dat_idents = [rec.toJSON() for rec in session.query(JournalsIdentifiers).filter_by(masterid=masterid).all()]
-                        dat_names = [rec.toJSON() for rec in session.query(JournalsNames).filter_by(masterid=masterid).all()]
-                        dat_titlehist = [rec.toJSON() for rec in session.query(JournalsTitleHistory).filter_by(masterid=masterid).all()]
-                        dat_pubhist = []
-                    
-                        if dat_titlehist:
-                            for t in dat_titlehist:
-                                publisherid = t.pop('publisherid', None)
-                                if publisherid:
-                                    pub = session.query(JournalsPublisher).filter_by(publisherid=publisherid).first()
-                                    pubhist = {'publisher': pub.toJSON()['pubabbrev'], 'title': t}
-                                else:
-                                    pubhist = {'publisher': 'n/a', 'title': t}
-                                dat_pubhist.append(pubhist)
-                        result_json = {'summary':
-                                          {'master': dat_master.toJSON(),
-                                           'idents': dat_idents,
-                                           'abbrev': dat_abbrev,
-                                           'pubhist': dat_pubhist,
-                                           'names': dat_names
-                                          }
-                                      }
-
-                        return result_json, 200
+                    result_json = {'summary': summary}
+                    # per-volume completeness is only sent on request
+                    if is_true(request.args.get('details', False)):
+                        try:
+                            (vol_start, vol_end) = volume_range()
+                        except ValueError:
+                            return {'Error': 'Search failed',
+                                    'Error Info': 'volume_start and volume_end must be integers'}, 400
+                        result_json['summary']['master']['completeness_details'] = queries.get_completeness_details(conn, masterid, vol_start, vol_end)
+                    return result_json, 200
             except Exception as err:
                 return {'Error': 'Summary search failed',
                         'Error Info': str(err)}, 500
@@ -101,22 +108,8 @@ class Journal(Resource):
         if journalname:
             jname = liken(journalname)
             try:
-                with current_app.session_scope() as session:
-                    rec_found = []
-                    # search Abbreviations
-                    dat_abbrev = session.query(JournalsAbbreviations).filter(JournalsAbbreviations.abbreviation.ilike(jname)).all()
-                    dat_names = session.query(JournalsNames).filter(or_(JournalsNames.name_english_translated.ilike(jname),
-                                                                        JournalsNames.name_native_language.ilike(jname),
-                                                                        JournalsNames.name_normalized.ilike(jname))).all()
-                    dat_master = session.query(JournalsMaster).filter(or_(JournalsMaster.journal_name.ilike(jname),
-                                                                          JournalsMaster.bibstem.ilike(jname))).all()
-                    rec_found.extend([rec.masterid for rec in dat_abbrev])
-                    rec_found.extend([rec.masterid for rec in dat_names])
-                    rec_found.extend([rec.masterid for rec in dat_master])
-                    rec_found = list(set(rec_found))
-                    for mid in rec_found:
-                        dat_master = session.query(JournalsMaster).filter_by(masterid=mid).first()
-                        journal_list.append({"bibstem": dat_master.bibstem, "name": dat_master.journal_name, "pubtype": dat_master.pubtype, "refereed": dat_master.refereed})
+                with read_only_connection() as conn:
+                    journal_list = queries.search_journals(conn, jname)
                 journal_list = sort_journals(journal_list)
             except Exception as err:
                 return {'Error': 'Journal search failed',
@@ -125,6 +118,59 @@ class Journal(Resource):
         return result_json, 200
 
 
+def holdings_json(solr_result):
+    data = solr_result.get('response', None)
+    if data:
+        count = data.get('numFound', 0)
+        docs = data.get('docs', [])
+        if docs:
+            volume = docs[0].get('volume', None)
+            bibstem = docs[0].get('bibstem', [])
+            if bibstem:
+                bibstem = bibstem[0]
+            holdings = [{'esources': rec.get('esources', None), 'page': rec.get('page', [None])[0]} for rec in docs]
+            return {'bibstem': bibstem,
+                    'volume': volume,
+                    'numFound': count,
+                    'holdings': holdings}
+    return {}
+
+
+def index_holdings(index, bibstem, volume):
+    # holdings_json of bibstem/volume from the local holdings index, with
+    # pages only
+    pages = index.lookup(bibstem, volume)
+    if not pages:
+        return {}
+    return {'bibstem': bibstem,
+            'volume': volume,
+            'numFound': len(pages),
+            'holdings': [{'page': page} for page in pages]}
+
+
+def local_holdings_index():
+    # the app's holdings index if the request doesn't need esources
+    index = getattr(current_app, 'holdings_index', None)
+    if index is None or is_true(request.args.get('esources', True)):
+        return None
+    index.maybe_refresh()
+    return index
+
+
+def cached_holdings(cache, q, bibstem, volume):
+    # holdings_json of bibstem/volume, through the holdings cache if the
+    # app has one; the TTL depends on the years of the volume's records
+    if cache is None:
+        return holdings_json(q.search(bibstem, volume))
+
+    def load():
+        solr_result = q.search(bibstem, volume)
+        years = [rec.get('year', None) for rec in solr_result.get('response', {}).get('docs', [])]
+        return (holdings_json(solr_result), cache.volume_ttl(years))
+
+    return cache.get((bibstem, volume), load)
+
+
 class Holdings(Resource):
 
     scopes = []
@@ -133,32 +179,58 @@ class Holdings(Resource):
 
     def get(self, bibstem, volume):
         try:
+            bibstem = bibstem.rstrip('.')
+            index = local_holdings_index()
+            if index is not None:
+                return index_holdings(index, bibstem, volume), 200
             q = ADSQuery()
+            result = cached_holdings(getattr(current_app, 'holdings_cache', None), q, bibstem, volume)
+        except Exception as err:
+            return {'Error': 'Holdings search failed',
+                    'Error Info': str(err)}, 500
+        else:
+            return result, 200
+
+
+class HoldingsBatch(Resource):
+
+    scopes = []
+    rate_limit = [1000, 60 * 60 * 24]
+    decorators = [advertise('scopes', 'rate_limit')]
+
+    def post(self, bibstem):
+        try:
+            volumes = request.get_json(force=True).get('volumes', [])
+            if not isinstance(volumes, list):
+                raise ValueError('volumes must be a list')
+            volumes = [str(v) for v in volumes]
+        except Exception as err:
+            return {'Error': 'Holdings search failed',
+                    'Error Info': 'Request body must be {"volumes": [...]}: %s' % err}, 400
+        max_volumes = current_app.config.get('JOURNALSDB_MAX_SUBMITTED', 100)
+        if len(volumes) > max_volumes:
+            return {'Error': 'Holdings search failed',
+                    'Error Info': 'No more than %s volumes per request' % max_volumes}, 400
+        try:
             bibstem = bibstem.rstrip('.')
-            solr_result = q.search(bibstem, volume)
-            data = solr_result.get('response', None)
-            if data:
-                count = data.get('numFound', 0)
-                docs = data.get('docs', [])
-                if docs:
-                    volume = docs[0].get('volume', None)
-                    bibstem = docs[0].get('bibstem', [])
-                    if bibstem:
-                        bibstem = bibstem[0]
-                    holdings = [{'esources': rec.get('esources', None), 'page': rec.get('page', [None])[0]} for rec in docs]
-                    result = {'bibstem': bibstem,
-                              'volume': volume,
-                              'numFound': count,
-                              'holdings': holdings}
+            index = local_holdings_index()
+            if index is not None:
+                return {'holdings': [index_holdings(index, bibstem, volume) for volume in volumes]}, 200
+            q = ADSQuery()
+            cache = getattr(current_app, 'holdings_cache', None)
+            holdings = []
+            for (volume, result) in q.search_volumes(bibstem, volumes, search=lambda b, v: cached_holdings(cache, q, b, v)):
+                if isinstance(result, Exception):
+                    holdings.append({'volume': volume,
+                                     'Error': 'Holdings search failed',
+                                     'Error Info': str(result)})
                 else:
-                    result = {}
-            else:
-                result = {}
+                    holdings.append(result)
         except Exception as err:
             return {'Error': 'Holdings search failed',
                     'Error Info': str(err)}, 500
         else:
-            return result, 200
+            return {'holdings': holdings}, 200
 
 
 class Refsource(Resource):
@@ -172,18 +244,11 @@ class Refsource(Resource):
         if bibstem:
             bibstem = bibstem.rstrip('.')
             try:
-                with current_app.session_scope() as session:
-                    try:
-                        # exact match to bibstem
-                        id_master = session.query(JournalsMaster).filter_by(bibstem=bibstem).first()
-                        # case-insensitive match to bibstem
-                        # id_master = session.query(JournalsMaster).filter(JournalsMaster.bibstem.ilike(bibstem)).first()
-                        masterid = id_master.masterid
-                    except Exception as err:
-                        pass
-                    else:
-                        dat_refsource = session.query(JournalsRefSource).filter_by(masterid=masterid).first()
-                        request_json = json.loads(dat_refsource.refsource_list)
+                with read_only_connection() as conn:
+                    # exact match to bibstem
+                    refsource_list = queries.get_refsource(conn, bibstem)
+                    if refsource_list:
+                        request_json = json.loads(refsource_list)
             except Exception as err:
                 return {'Error': 'Refsource search failed',
                         'Error Info': str(err)}, 500
@@ -197,46 +262,25 @@ class ISSN(Resource):
     decorators = [advertise('scopes', 'rate_limit')]
 
     def get(self, issn):
-        request_json = {}
-        if issn:
-            try:
-                if len(issn) == 8:
-                    issn = issn[0:4] + "-" + issn[4:]
-                with current_app.session_scope() as session:
-                    dat_idents = session.query(JournalsIdentifiers).filter(and_(JournalsIdentifiers.id_value==issn, JournalsIdentifiers.id_type.like("ISSN%"))).first()
-                    if dat_idents:
-                        pub_abbrev = None
-                        masterid = dat_idents.masterid
-                        id_value = dat_idents.id_value
-                        id_type = dat_idents.id_type
-                        dat_master = session.query(JournalsMaster).filter_by(masterid=masterid).first()
-                        bibstem = dat_master.bibstem
-                        journal_name = dat_master.journal_name
-                        dat_titlehist = [rec.toJSON() for rec in session.query(JournalsTitleHistory).filter_by(masterid=masterid).all()]
-                        if dat_titlehist:
-                            dat_pubhist = []
-                            for t in dat_titlehist:
-                                publisherid = t.pop('publisherid', None)
-                                if publisherid:
-                                    pub = session.query(JournalsPublisher).filter_by(publisherid=publisherid).first()
-                                    pubhist = {'publisher': pub.toJSON()['pubabbrev'], 'title': t}
-                                    dat_pubhist.append(pubhist)
-                            for p in dat_pubhist:
-                                if not p.get("title", {}).get("year_end", None):
-                                    if p.get("publisher", None):
-                                        pub_abbrev = p.get("publisher")
-
-                        request_json = {'issn': {'ISSN': id_value,
-                                                'ISSN_type': id_type,
-                                                'bibstem': bibstem,
-                                                'publisher': pub_abbrev,
-                                                'journal_name': journal_name}}
-            except Exception as err:
-                return {'Error': 'issn search failed',
-                        'Error Info': str(err)}, 500
-        else:
-            request_json = {'issn': {}}
-        return request_json, 200
+        if not issn:
+            return {'issn': {}}, 200
+        resolver = getattr(current_app, 'issn_resolver', None)
+        try:
+            if resolver is not None and resolver.loaded:
+                resolver.maybe_refresh()
+                issn_json = resolver.resolve(issn)
+            else:
+                with read_only_connection() as conn:
+                    issn_json = resolve_issn(issn, lambda key: queries.issn_json(conn, key[0:4] + '-' + key[4:]))
+        except ValueError as err:
+            return {'Error': 'issn search failed',
+                    'Error Info': str(err)}, 400
+        except Exception as err:
+            return {'Error': 'issn search failed',
+                    'Error Info': str(err)}, 500
+        if issn_json:
+            return {'issn': issn_json}, 200
+        return {}, 200
 
 class Browse(Resource):
 
@@ -248,87 +292,108 @@ class Browse(Resource):
         if bibstem:
             bibstem = bibstem.rstrip('.')
             try:
-                with current_app.session_scope() as session:
-                    dat_master = session.query(JournalsMaster).filter_by(bibstem=bibstem).first()
-                    try:
-                        masterid = dat_master.masterid
-                    except Exception as err:
-                        return {'Error': 'Search failed',
-                                'Error Info': 'Bibstem "%s" not found.' % bibstem}, 200
-                    else:
-                        dat_abbrev = [rec.toJSON()['abbreviation'] for rec in session.query(JournalsAbbreviations).filter_by(masterid=masterid, canonical=True).all()]
-                        dat_idents = [rec.toJSON() for rec in session.query(JournalsIdentifiers).filter_by(masterid=masterid).all()]
-                        dat_names = [rec.toJSON() for rec in session.query(JournalsNames).filter_by(masterid=masterid).all()]
-                        dat_titlehist = [rec.toJSON() for rec in session.query(JournalsTitleHistory).filter_by(masterid=masterid).all()]
-                        dat_pubhist = [] 
-                        if dat_titlehist:
-                            for t in dat_titlehist:
-                                publisherid = t.pop('publisherid', None)
-                                if publisherid:
-                                    pub = session.query(JournalsPublisher).filter_by(publisherid=publisherid).first()
-                                    pubhist = {'publisher': pub.toJSON()['pubabbrev'], 'title': t}
-                                    dat_pubhist.append(pubhist)
-
-                        # browse return data
-                        request_json = {}
-
-                        # master
-                        canonical_name = dat_master.toJSON().get("journal_name", "")
-                        refereed_status = dat_master.toJSON().get("refereed", "")
-                        completeness_fraction = dat_master.toJSON().get("completeness_fraction", "")
-                        classic_bibstem = dat_master.toJSON().get("bibstem", "")
-                        primary_language = dat_master.toJSON().get("primary_language", "")
-
-                        # abbrevs
-                        if dat_abbrev:
-                            canonical_abbreviation = dat_abbrev[0]
-                        else:
-                            canonical_abbreviation = ""
-
-                        # idents
-                        if dat_idents:
-                            identifiers = dat_idents
-                        else:
-                            identifiers = []
-
-                        # names
-                        if dat_names and type(dat_names[0]) == dict:
-                            native_language_title = dat_names[0].get("name_native_language", "")
-                            title_language = dat_names[0].get("title_language", "")
-                        else:
-                            native_language_title = ""
-                            title_language = ""
-
-                        # pubhist
-                        if dat_pubhist:
-                            pubhist = []
-                            for p in dat_pubhist:
-                                pubhist.append(
-                                    {
-                                        "publisher": p.get("publisher", ""), 
-                                        "start_year": p.get("title", {}).get("year_start", ""),
-                                        "start_volume": p.get("title", {}).get("vol_start", "")
-                                    }
-                                )
-                        else:
-                            pubhist = []
-                        request_json = {
-                            "browse": {
-                                "canonical_name": canonical_name,
-                                "classic_bibstem": classic_bibstem,
-                                "canonical_abbreviation": canonical_abbreviation,
-                                "primary_language": primary_language,
-                                "native_language_title": native_language_title,
-                                "title_language": title_language,
-                                "completeness_estimate": completeness_fraction,
-                                "external_identifiers": identifiers,
-                                "publication_history": pubhist
-                            }
-                        }
-                        return request_json, 200
-
+                with read_only_connection() as conn:
+                    browse = queries.get_browse(conn, bibstem)
+                if not browse:
+                    return {'Error': 'Search failed',
+                            'Error Info': 'Bibstem "%s" not found.' % bibstem}, 200
+                return {'browse': browse}, 200
             except Exception as err:
                 return {"Error": "browse search failed",
                         "Error Info": str(err)}, 500
         else:
             return {"browse": {}}, 200
+
+
+class Dump(Resource):
+
+    scopes = []
+    rate_limit = [100, 60 * 60 * 24]
+    decorators = [advertise('scopes', 'rate_limit')]
+
+    def get(self):
+        filters = dict((k, request.args.get(k, None)) for k in ['collection', 'pubtype', 'refereed'])
+        batch_size = current_app.config.get('DUMP_BATCH_SIZE', 500)
+        engine = journals_engine()
+        logger = current_app.logger
+        compress = 'gzip' in request.accept_encodings
+
+        def generate():
+            # one chunk per batch of journals; when gzipped each batch is
+            # flushed so the client gets it without waiting for the end
+            gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+            def encode(lines):
+                chunk = ('\n'.join(lines) + '\n').encode('utf-8')
+                if gzip:
+                    chunk = gzip.compress(chunk) + gzip.flush(zlib.Z_SYNC_FLUSH)
+                return chunk
+
+            try:
+                with queries.read_only(engine) as conn:
+                    for batch in queries.iter_dump(conn, batch_size=batch_size, **filters):
+                        yield encode(batch)
+            except Exception as err:
+                # the status line has been sent, so the client gets an
+                # error line, and the exception cuts the response off
+                # before the end of the chunked body and gzip trailer, so
+                # it can't be taken for a complete dump
+                logger.error('Dump failed: %s' % err)
+                yield encode([json.dumps({'error': 'Dump failed: %s' % err})])
+                raise
+            if gzip:
+                yield gzip.flush()
+
+        headers = {'Vary': 'Accept-Encoding'}
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+        return Response(generate(), mimetype='application/x-ndjson', headers=headers)
+
+
+class Changes(Resource):
+
+    scopes = []
+    rate_limit = [1000, 60 * 60 * 24]
+    decorators = [advertise('scopes', 'rate_limit')]
+
+    def get(self):
+        try:
+            since = int(request.args.get('since', 0))
+            after = request.args.get('after', None)
+            if after:
+                after = queries.parse_change_cursor(after)
+            max_rows = current_app.config.get('CHANGES_PAGE_SIZE', 1000)
+            limit = min(int(request.args.get('limit', max_rows)), max_rows)
+            if limit < 1:
+                raise ValueError('limit must be positive')
+        except Exception as err:
+            return {'Error': 'Changes search failed',
+                    'Error Info': 'Bad since, after or limit: %s' % err}, 400
+        try:
+            with read_only_connection() as conn:
+                result = queries.changes_json(conn, since, after=after, limit=limit)
+        except Exception as err:
+            return {'Error': 'Changes search failed',
+                    'Error Info': str(err)}, 500
+        return result, 200
+
+
+class Metrics(Resource):
+
+    scopes = []
+    rate_limit = [1000, 60 * 60 * 24]
+    decorators = [advertise('scopes', 'rate_limit')]
+
+    def get(self):
+        try:
+            metrics = {'db_pool': pool_status(journals_engine())}
+            snapshot = getattr(current_app, 'snapshot', None)
+            if snapshot is not None:
+                metrics['snapshot'] = snapshot.status()
+            cache = getattr(current_app, 'holdings_cache', None)
+            if cache is not None:
+                metrics['holdings_cache'] = cache.status()
+            return {'metrics': metrics}, 200
+        except Exception as err:
+            return {'Error': 'Metrics failed',
+                    'Error Info': str(err)}, 500
@@ -5,12 +5,15 @@ from __future__ import print_function
 import argparse
 import json
 import os
-from adsputils import setup_logging, load_config
+from adsputils import setup_logging
+from journalsmanager import pipeline
 from journalsmanager import tasks
 from journalsmanager import utils
+from journalsmanager.exceptions import LoadChunksException
 
 proj_home = os.path.realpath(os.path.dirname(__file__))
-config = load_config(proj_home=proj_home)
+# the same config.py/local_config.py, already loaded by utils
+config = utils.config
 logger = setup_logging('run.py', proj_home=proj_home,
                        level=config.get('LOGGING_LEVEL', 'INFO'),
                        attach_stdout=config.get('LOG_STDOUT', False))
@@ -45,6 +48,21 @@ def get_arguments():
                         default=None,
                         help='Delete a bibstem and ALL related data (USE WITH CAUTION)')
 
+    parser.add_argument('-dl',
+                        '--delete-stem-list',
+                        dest='delete_stem_list',
+                        action='store',
+                        nargs='+',
+                        default=None,
+                        help='Delete a list of bibstems and ALL related data (USE WITH CAUTION)')
+
+    parser.add_argument('-df',
+                        '--delete-stem-file',
+                        dest='delete_stem_file',
+                        action='store',
+                        default=None,
+                        help='Delete the bibstems listed one per line in FILE and ALL related data (USE WITH CAUTION)')
+
     parser.add_argument('-lf',
                         '--load-full',
                         dest='load_full',
@@ -89,6 +107,27 @@ def get_arguments():
                         default=False,
                         help='Export journal name & bibstem data to json')
 
+    parser.add_argument('-hi',
+                        '--holdings-index',
+                        dest='holdings_index',
+                        action='store_true',
+                        default=False,
+                        help='Build the holdings index from the canonical bibcodes')
+
+    parser.add_argument('-rp',
+                        '--refresh-profiles',
+                        dest='refresh_profiles',
+                        action='store_true',
+                        default=False,
+                        help='Rebuild the precomputed summary/browse profiles of all journals')
+
+    parser.add_argument('-ps',
+                        '--publish-snapshot',
+                        dest='publish_snapshot',
+                        action='store_true',
+                        default=False,
+                        help='Write a read-only SQLite snapshot of the database for journalsservice')
+
     parser.add_argument('-re',
                         '--revert-edit',
                         dest='revertid',
@@ -96,6 +135,13 @@ def get_arguments():
                         default=None,
                         help='Undo edit # from editcontrol')
 
+    parser.add_argument('-dr',
+                        '--dry-run',
+                        dest='dry_run',
+                        action='store_true',
+                        default=False,
+                        help='With -re, report the rows that would be reverted without writing')
+
     parser.add_argument('-cc',
                         '--cancel-checkout',
                         dest='cancelxo',
@@ -103,6 +149,13 @@ def get_arguments():
                         default=None,
                         help='Cancel active export id # from editcontrol')
 
+    parser.add_argument('-as',
+                        '--async',
+                        dest='async_load',
+                        action='store_true',
+                        default=False,
+                        help='With -lf or -ls, send abbreviation, identifier and refsource loads to the load-datafiles workers in chunks')
+
     parser.add_argument('-aa',
                         '--abandon-all',
                         dest='abandonall',
@@ -114,6 +167,19 @@ def get_arguments():
     return args
 
 
+def load_records(label, task, recs, args=(), async_load=False):
+    # load recs with task here, or with async_load on the load-datafiles
+    # workers, LOAD_CHUNK_SIZE records per task, waiting for all of them
+    if not async_load:
+        return task(recs, *args)
+    result = pipeline.dispatch_chunks(task, recs, config.get('LOAD_CHUNK_SIZE', 1000), *args)
+    summary = pipeline.collect_chunks(result, label, logger=logger,
+                                      timeout=config.get('LOAD_CHUNK_TIMEOUT', None))
+    if summary['errors']:
+        raise LoadChunksException("%s of %s %s chunks failed: %s" % (len(summary['errors']), summary['chunks'], label, summary['errors'][0]))
+    return summary['loaded']
+
+
 def load_master():
     '''
     No.
@@ -141,16 +207,13 @@ def load_rasterconfig(masterdict):
         recsr = utils.read_raster_xml(masterdict)
     except Exception as e:
         logger.warning('error in utils.read_raster_xml: %s' % e)
-    else:
-        logger.debug("Inserting %s raster config records" % len(recsr))
-        try:
-            tasks.task_db_load_raster(recsr)
-        except Exception as err:
-            logger.warning("Could not load raster config: %s" % err)
+        raise
+    logger.debug("Inserting %s raster config records" % len(recsr))
+    tasks.task_db_load_raster(recsr)
     return
 
 
-def load_abbreviations(masterdict):
+def load_abbreviations(masterdict, async_load=False):
     '''
     No.
     '''
@@ -171,10 +234,7 @@ def load_abbreviations(masterdict):
     if recs:
         logger.debug("Inserting %s abbreviations into Abbreviations",
                      len(recs))
-        try:
-            tasks.task_db_load_abbrevs(recs)
-        except Exception as err:
-            logger.warning("Could not load abbreviations: %s" % err)
+        load_records('abbrevs', tasks.task_db_load_abbrevs, recs, async_load=async_load)
     else:
         logger.debug("There are no abbreviations to load.")
     return
@@ -185,6 +245,12 @@ def load_completeness_old(masterdict):
     Completeness loads multiple tables: publisher, idents, titlehistory
     '''
     pub_dict = utils.read_complete_csvs()
+    publisherdict = load_publishers(pub_dict)
+    load_completeness_idents(pub_dict, masterdict)
+    load_completeness_titlehist(pub_dict, masterdict, publisherdict)
+
+
+def load_publishers(pub_dict):
     recsp = []
     for key, value in list(pub_dict.items()):
         if value.get('publisher', None):
@@ -193,8 +259,10 @@ def load_completeness_old(masterdict):
         recsp = list(set(recsp))
         recsp.sort()
         tasks.task_db_load_publisher(recsp)
-    publisherdict = tasks.task_db_get_publisherid()
+    return tasks.task_db_get_publisherid()
 
+
+def load_completeness_idents(pub_dict, masterdict, async_load=False):
     recsi = []
     recsx = []
     for key, value in list(pub_dict.items()):
@@ -205,10 +273,12 @@ def load_completeness_old(masterdict):
             if value.get('xref', None):
                 recsx.append((mid, value['xref']))
     if recsi:
-        tasks.task_db_load_identifier(recsi, idtype='ISSN_print')
+        load_records('ISSN_print', tasks.task_db_load_identifier, recsi, args=('ISSN_print',), async_load=async_load)
     if recsx:
-        tasks.task_db_load_identifier(recsx, idtype='Crossref')
+        load_records('Crossref', tasks.task_db_load_identifier, recsx, args=('Crossref',), async_load=async_load)
+
 
+def load_completeness_titlehist(pub_dict, masterdict, publisherdict):
     recsh = []
     for key, value in list(pub_dict.items()):
         if key in masterdict:
@@ -226,7 +296,7 @@ def load_completeness_old(masterdict):
         tasks.task_db_load_titlehist(recsh)
 
 
-def load_refsources(masterdict):
+def load_refsources(masterdict, async_load=False):
     refsources = utils.create_refsource()
     missing_stems = []
     loaded_stems = []
@@ -236,7 +306,9 @@ def load_refsources(masterdict):
             tasks.task_db_clear_refsource()
         except Exception as err:
             logger.warning("Unable to clear existing refsources table: %s" % err)
+            raise
         else:
+            recs = []
             for bibstem, refsource in refsources.items():
                 try:
                     bibstem = bibstem.rstrip('.')
@@ -245,37 +317,45 @@ def load_refsources(masterdict):
                     logger.debug("missing masterdict bibstem: (%s)" % bibstem)
                     missing_stems.append(bibstem)
                 else:
-                    tasks.task_db_load_refsource(masterid,refsource)
+                    recs.append((masterid, refsource.toJSON()))
                     loaded_stems.append(bibstem)
+            if recs:
+                load_records('refsource', tasks.task_db_load_refsources, recs, async_load=async_load)
+            else:
+                logger.error("No refsource data to load!")
 
             logger.debug("Loaded bibstems: %s\tMissing bibstems: %s" % (len(loaded_stems), len(missing_stems)))
+    else:
+        logger.error("No refsource data to load!")
 
 
-def load_nonindexed():
+def load_nonindexed(refresh=True):
+    # refresh=False leaves the profile refresh, classic export and
+    # snapshot to the caller, as the full load does once all tables are in
     try:
         nonindexed = utils.read_nonindexed()
         tasks.task_db_insert_nonindexed_bibstems(nonindexed)
     except Exception as err:
         logger.error("Failed to load nonindexed bibstems from %s: %s" % ((config.get('JDB_DATA_DIR','/') + config.get('NONINDEXED_FILE', 'error.file')), err))
-    else:
-        masterdict = tasks.task_db_get_bibstem_masterid()
-        recsi = []
-        for k, v in nonindexed.items():
-            try:
-                mid = masterdict[k]
-            except Exception as err:
-                logger.warning("missing masterid for bibstem %s" % k)
-            else:
-                r = {'masterid': mid, 'id_type': 'ISSN_print', 'id_value': v['issn']}
-                recsi.append(r)
-        if len(recsi) != len(nonindexed.keys()):
-            logger.warning("Lines were skipped when reading ISSNs from file")
-        if recsi:
-            checkin = {'tablename': 'idents',
-                       'editid': -1,
-                       'data': recsi
-                      }
-            status = tasks.task_update_table(checkin, masterdict)
+        raise
+    masterdict = tasks.task_db_get_bibstem_masterid()
+    recsi = []
+    for k, v in nonindexed.items():
+        try:
+            mid = masterdict[k]
+        except Exception as err:
+            logger.warning("missing masterid for bibstem %s" % k)
+        else:
+            r = {'masterid': mid, 'id_type': 'ISSN_print', 'id_value': v['issn']}
+            recsi.append(r)
+    if len(recsi) != len(nonindexed.keys()):
+        logger.warning("Lines were skipped when reading ISSNs from file")
+    if recsi:
+        checkin = {'tablename': 'idents',
+                   'editid': -1,
+                   'data': recsi
+                  }
+        status = tasks.task_update_table(checkin, masterdict, refresh=refresh)
 
     return
 
@@ -299,26 +379,91 @@ def checkout_table(tablename):
         logger.warning("Table %s is available in Sheets" % tablename)
 
 
-def load_full_database():
-    # This is used to create a database from scratch from all
-    # input files: master, abbreviations, completeness (publisher, ids), raster,
-    # refsources.
+def read_bibstem_file(filename):
+    bibstems = []
+    with open(filename, 'r') as fb:
+        for l in fb.readlines():
+            l = l.strip()
+            if l and not l.startswith('#'):
+                bibstems.append(l)
+    return bibstems
+
+
+def delete_bibstems(bibstems, masterdict):
+    # archive and delete all bibstems under one editcontrol id, then
+    # regenerate the classic files once
+    masterids = []
+    for bibstem in bibstems:
+        masterid = masterdict.get(bibstem, None)
+        if masterid:
+            masterids.append(masterid)
+        else:
+            logger.warning("Bibstem '%s' not found: exact match required for deletion" % bibstem)
+            for bib in masterdict.keys():
+                if bib.lower() == bibstem.lower():
+                    logger.warning("Possible matching bibstem: '%s'" % bib)
+                    break
+    if masterids:
+        try:
+            if len(masterids) == 1:
+                tasks.task_delete_masterid(masterids[0])
+            else:
+                tasks.task_delete_masterids(masterids, editfileid=tasks.DELETION_EDITFILEIDS[1])
+            tasks.task_export_classic_files()
+        except Exception as err:
+            logger.warning("Error deleting bibstems %s: %s" % (",".join(bibstems), err))
+        else:
+            logger.info("%s bibstem(s) and related data successfully deleted" % len(masterids))
+            publish_snapshot()
+
 
+def publish_snapshot():
     try:
-        load_master()
-        masterdict = tasks.task_db_get_bibstem_masterid()
-        logger.debug("masterdict has %s records", len(masterdict))
+        tasks.task_publish_snapshot()
     except Exception as err:
-        logger.warning("Error loading master table: %s" % err)
+        logger.error("Unable to publish database snapshot: %s" % err)
+
+
+def load_master_stage():
+    load_master()
+    masterdict = tasks.task_db_get_bibstem_masterid()
+    logger.debug("masterdict has %s records", len(masterdict))
+    return masterdict
+
+
+def full_load_stages(async_load=False):
+    # master -> publisher -> titlehistory, and master -> abbrevs, raster,
+    # refsource, idents; nonindexed adds master rows and ISSNs, so it
+    # waits for the idents load.  Profiles and classic files are built
+    # once, after every table is loaded
+    Stage = pipeline.Stage
+    loaded = ['titlehistory', 'abbrevs', 'raster', 'refsource', 'nonindexed']
+    return [Stage('master', load_master_stage, []),
+            Stage('completeness', utils.read_complete_csvs, []),
+            Stage('publisher', lambda completeness, master: load_publishers(completeness), ['completeness', 'master']),
+            Stage('idents', lambda completeness, master: load_completeness_idents(completeness, master, async_load=async_load), ['completeness', 'master']),
+            Stage('titlehistory', lambda completeness, master, publisher: load_completeness_titlehist(completeness, master, publisher), ['completeness', 'master', 'publisher']),
+            Stage('abbrevs', lambda master: load_abbreviations(master, async_load=async_load), ['master']),
+            Stage('raster', lambda master: load_rasterconfig(master), ['master']),
+            Stage('refsource', lambda master: load_refsources(master, async_load=async_load), ['master']),
+            Stage('nonindexed', lambda master, idents: load_nonindexed(refresh=False), ['master', 'idents']),
+            Stage('profiles', lambda **kwargs: tasks.task_refresh_profiles(), loaded),
+            Stage('export', lambda **kwargs: tasks.task_export_classic_files(), loaded)]
+
+
+def load_full_database(async_load=False):
+    # This is used to create a database from scratch from all
+    # input files: master, abbreviations, completeness (publisher, ids), raster,
+    # refsources.  Stages that don't depend on each other run concurrently,
+    # and with async_load the larger loads are spread over the workers.
+    (reports, results) = pipeline.run_stages(full_load_stages(async_load=async_load),
+                                             max_workers=config.get('LOAD_PIPELINE_WORKERS', 4),
+                                             logger=logger)
+    pipeline.log_report(logger, reports)
+    if all(r.status == pipeline.OK for r in reports):
+        publish_snapshot()
     else:
-        try:
-            load_completeness_old(masterdict)
-            load_abbreviations(masterdict)
-            load_rasterconfig(masterdict)
-            load_refsources(masterdict)
-            load_nonindexed()
-        except Exception as err:
-            logger.warning("Error loading auxilliary tables: %s" % err)
+        logger.warning("Full load incomplete, no snapshot published")
 
 
 def main():
@@ -330,7 +475,7 @@ def main():
 
     # These don't require masterdict
     if args.load_full:
-        load_full_database()
+        load_full_database(async_load=args.async_load)
 
     elif args.abandonall:
         tasks.task_abandon_active_checkouts()
@@ -345,8 +490,23 @@ def main():
     elif args.autocomplete:
         tasks.task_export_autocomplete_data()
 
+    elif args.holdings_index:
+        tasks.task_export_holdings_index()
+
+    elif args.refresh_profiles:
+        try:
+            tasks.task_refresh_profiles()
+        except Exception as err:
+            logger.error("Unable to refresh journal profiles: %s" % err)
+
+    elif args.publish_snapshot:
+        if not config.get('SNAPSHOT_DIRECTORY', None):
+            logger.warning("SNAPSHOT_DIRECTORY is not set, no snapshot published")
+        else:
+            publish_snapshot()
+
     elif args.revertid:
-        tasks.task_revert_editid(args.revertid)
+        tasks.task_revert_editid(args.revertid, dry_run=args.dry_run)
 
     elif args.cancelxo:
         tasks.task_cancel_checkout(args.cancelxo)
@@ -366,22 +526,18 @@ def main():
                 except Exception as err:
                     logger.warning("Error checking in table %s: %s" % (tablename, err))
             elif args.delete_stem:
-                masterid = masterdict.get(args.delete_stem, None)
-                if masterid:
-                    try:
-                        tasks.task_delete_masterid(masterid) 
-                        tasks.task_export_classic_files()
-                    except Exception as err:
-                        logger.warning("Error deleting bibstem %s: %s" % (args.delete_stem, err))
-                    else:
-                        logger.info("Bibstem '%s' and related data successfully deleted" % args.delete_stem)
+                delete_bibstems([args.delete_stem], masterdict)
+
+            elif args.delete_stem_list:
+                delete_bibstems(args.delete_stem_list, masterdict)
+
+            elif args.delete_stem_file:
+                try:
+                    bibstems = read_bibstem_file(args.delete_stem_file)
+                except Exception as err:
+                    logger.warning("Error reading bibstems from %s: %s" % (args.delete_stem_file, err))
                 else:
-                    logger.warning("Bibstem '%s' not found: exact match required for deletion" % args.delete_stem)
-                    for bib in masterdict.keys():
-                        if bib.lower() == args.delete_stem.lower():
-                            logger.warning("Possible matching bibstem: '%s'" % bib)
-                            break
-                        
+                    delete_bibstems(bibstems, masterdict)
 
             elif args.load_raster:
                 try:
@@ -390,7 +546,10 @@ def main():
                 except Exception as err:
                     logger.warning("Error clearing raster tables: %s" % err)
                 else:
-                    load_rasterconfig(masterdict)
+                    try:
+                        load_rasterconfig(masterdict)
+                    except Exception as err:
+                        logger.warning("Could not load raster config: %s" % err)
 
             elif args.load_refsources:
                 try:
@@ -398,7 +557,7 @@ def main():
                 except Exception as err:
                     logger.warning("Error clearing refsource table: %s" % err)
                 else:
-                    load_refsources(masterdict)
+                    load_refsources(masterdict, async_load=args.async_load)
 
             elif args.load_completeness:
                 try:
@@ -0,0 +1,210 @@
+'''
+Reports query plans and latencies for the lookups done by journalsservice.
+
+Run it against a local database (never production): --seed fills the
+tables with synthetic journals, and --compare repeats every query inside
+a transaction with the service indexes dropped, then rolls back, so the
+plans and timings without and with the indexes are shown side by side.
+
+    python3 scripts/benchmark_service_queries.py --seed 20000 --compare
+'''
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+if proj_home not in sys.path:
+    sys.path.append(proj_home)
+
+from adsputils import load_config
+from sqlalchemy import and_, create_engine, func, or_, select, text
+from journalsdb.models import JournalsMaster, JournalsAbbreviations, JournalsIdentifiers, JournalsPublisher, JournalsRefSource, JournalsTitleHistory, JournalsNames
+
+config = load_config(proj_home=proj_home)
+
+# indexes added by alembic revision e5a7c3d1f2b4
+SERVICE_INDEXES = ['ix_abbrevs_masterid', 'ix_idents_masterid',
+                   'ix_names_masterid', 'ix_titlehistory_masterid',
+                   'ix_idents_id_value_id_type',
+                   'ix_abbrevs_abbreviation_trgm',
+                   'ix_names_name_english_translated_trgm',
+                   'ix_names_name_native_language_trgm',
+                   'ix_names_name_normalized_trgm',
+                   'ix_master_journal_name_trgm', 'ix_master_bibstem_trgm']
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark journalsservice queries.')
+
+    parser.add_argument('-d',
+                        '--db-uri',
+                        dest='db_uri',
+                        action='store',
+                        default=config.get('SQLALCHEMY_DATABASE_URI'),
+                        help='Database to benchmark (default: SQLALCHEMY_DATABASE_URI)')
+
+    parser.add_argument('-s',
+                        '--seed',
+                        dest='seed',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='Insert SEED synthetic journals before benchmarking')
+
+    parser.add_argument('-r',
+                        '--repeat',
+                        dest='repeat',
+                        action='store',
+                        type=int,
+                        default=50,
+                        help='Number of timed executions per query')
+
+    parser.add_argument('-c',
+                        '--compare',
+                        dest='compare',
+                        action='store_true',
+                        default=False,
+                        help='Also run every query with the service indexes dropped (rolled back afterwards)')
+
+    parser.add_argument('-p',
+                        '--plans',
+                        dest='plans',
+                        action='store_true',
+                        default=False,
+                        help='Print the full EXPLAIN ANALYZE output')
+
+    return parser.parse_args()
+
+
+def seed_database(conn, count):
+    pubid = conn.execute(JournalsPublisher.__table__.insert().returning(JournalsPublisher.publisherid),
+                         {'pubabbrev': 'BENCH'}).scalar()
+    batch = 1000
+    for start in range(0, count, batch):
+        masters = [{'bibstem': 'Bn%06d' % i,
+                    'journal_name': 'Benchmark Journal of Topic %d' % i,
+                    'primary_language': 'en', 'multilingual': False,
+                    'defunct': False, 'pubtype': 'Journal',
+                    'refereed': 'yes', 'not_indexed': False,
+                    'deprecated': False}
+                   for i in range(start, min(start + batch, count))]
+        conn.execute(JournalsMaster.__table__.insert(), masters)
+        rows = conn.execute(select([JournalsMaster.masterid, JournalsMaster.bibstem]).where(JournalsMaster.bibstem.in_([m['bibstem'] for m in masters]))).fetchall()
+        abbrevs = []
+        idents = []
+        names = []
+        titles = []
+        for (masterid, bibstem) in rows:
+            i = int(bibstem[2:])
+            for j in range(5):
+                abbrevs.append({'masterid': masterid,
+                                'abbreviation': 'Bench. J. Top. %d v%d' % (i, j),
+                                'canonical': j == 0})
+            idents.append({'masterid': masterid, 'id_type': 'ISSN_print',
+                           'id_value': '%04d-%04d' % (i // 10000, i % 10000)})
+            idents.append({'masterid': masterid, 'id_type': 'ISSN_electronic',
+                           'id_value': '%04d-%04dX' % (i // 10000, i % 10000)})
+            names.append({'masterid': masterid,
+                          'name_english_translated': 'Benchmark Journal %d' % i,
+                          'title_language': 'en',
+                          'name_native_language': 'Benchmark Zeitschrift %d' % i,
+                          'name_normalized': 'benchmark journal %d' % i})
+            titles.append({'masterid': masterid, 'year_start': 1900 + i % 100,
+                           'vol_start': '1', 'publisherid': pubid})
+        conn.execute(JournalsAbbreviations.__table__.insert(), abbrevs)
+        conn.execute(JournalsIdentifiers.__table__.insert(), idents)
+        conn.execute(JournalsNames.__table__.insert(), names)
+        conn.execute(JournalsTitleHistory.__table__.insert(), titles)
+    conn.execute(text('ANALYZE'))
+
+
+def service_queries(conn):
+    # the statements issued by journalsservice.views, with parameters
+    # picked from the middle of the table
+    middle = conn.execute(select([func.count()]).select_from(JournalsMaster.__table__)).scalar() // 2
+    (masterid, bibstem) = conn.execute(select([JournalsMaster.masterid, JournalsMaster.bibstem]).order_by(JournalsMaster.masterid).offset(middle).limit(1)).first()
+    issn = conn.execute(select([JournalsIdentifiers.id_value]).where(JournalsIdentifiers.id_type.like('ISSN%')).order_by(JournalsIdentifiers.identid.desc()).limit(1)).scalar()
+    jname = '%Journal%Topic%1234%'
+    return [('master by bibstem', select([JournalsMaster]).where(JournalsMaster.bibstem==bibstem)),
+            ('abbrevs by masterid', select([JournalsAbbreviations]).where(JournalsAbbreviations.masterid==masterid)),
+            ('idents by masterid', select([JournalsIdentifiers]).where(JournalsIdentifiers.masterid==masterid)),
+            ('names by masterid', select([JournalsNames]).where(JournalsNames.masterid==masterid)),
+            ('titlehistory by masterid', select([JournalsTitleHistory]).where(JournalsTitleHistory.masterid==masterid)),
+            ('refsource by masterid', select([JournalsRefSource]).where(JournalsRefSource.masterid==masterid)),
+            ('idents by ISSN', select([JournalsIdentifiers]).where(and_(JournalsIdentifiers.id_value==issn, JournalsIdentifiers.id_type.like('ISSN%')))),
+            ('abbrevs ILIKE', select([JournalsAbbreviations.masterid]).where(JournalsAbbreviations.abbreviation.ilike(jname))),
+            ('names ILIKE', select([JournalsNames.masterid]).where(or_(JournalsNames.name_english_translated.ilike(jname),
+                                                                          JournalsNames.name_native_language.ilike(jname),
+                                                                          JournalsNames.name_normalized.ilike(jname)))),
+            ('master ILIKE', select([JournalsMaster.masterid]).where(or_(JournalsMaster.journal_name.ilike(jname),
+                                                                            JournalsMaster.bibstem.ilike(jname))))]
+
+
+def explain(conn, stmt):
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True})
+    return [r[0] for r in conn.execute(text('EXPLAIN ANALYZE %s' % compiled))]
+
+
+def time_query(conn, stmt, repeat):
+    timings = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        conn.execute(stmt).fetchall()
+        timings.append((time.perf_counter() - t0) * 1000.0)
+    timings.sort()
+    return (timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.95))])
+
+
+def run_benchmark(conn, queries, repeat, plans):
+    results = {}
+    for (name, stmt) in queries:
+        plan = explain(conn, stmt)
+        (median, p95) = time_query(conn, stmt, repeat)
+        results[name] = {'plan': plan, 'median': median, 'p95': p95}
+        if plans:
+            print('--- %s' % name)
+            print('\n'.join(plan))
+    return results
+
+
+def main():
+    args = get_arguments()
+    engine = create_engine(args.db_uri)
+
+    if args.seed:
+        with engine.begin() as conn:
+            seed_database(conn, args.seed)
+        print('Seeded %s journals' % args.seed)
+
+    with engine.connect() as conn:
+        queries = service_queries(conn)
+
+        before = None
+        if args.compare:
+            trans = conn.begin()
+            try:
+                for index in SERVICE_INDEXES:
+                    conn.execute(text('DROP INDEX IF EXISTS %s' % index))
+                if args.plans:
+                    print('=== without service indexes')
+                before = run_benchmark(conn, queries, args.repeat, args.plans)
+            finally:
+                trans.rollback()
+
+        if args.plans:
+            print('=== with service indexes')
+        after = run_benchmark(conn, queries, args.repeat, args.plans)
+
+    print('%-26s %-34s %10s %10s' % ('query', 'top plan node', 'median ms', 'p95 ms'))
+    for (name, _) in queries:
+        for (label, results) in [('without', before), ('with', after)]:
+            if results:
+                r = results[name]
+                node = r['plan'][0].split('  (')[0].strip()[:34]
+                print('%-26s %-34s %10.3f %10.3f' % (name if label == 'without' or not before else '', node, r['median'], r['p95']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+'''
+Load test for the holdings endpoint against a local stub of the ADS search
+API, comparing one synchronous WSGI worker with one ASGI process.
+
+The stub answers every search after --upstream-delay seconds, so the run
+measures how many slow upstream calls a single service process can have in
+flight.  The holdings cache is turned off so every request goes upstream.
+
+    python3 scripts/loadtest_holdings.py --mode wsgi --requests 200 --concurrency 50
+    python3 scripts/loadtest_holdings.py --mode asgi --requests 200 --concurrency 50
+'''
+from __future__ import print_function
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+from urllib.parse import parse_qs
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+if proj_home not in sys.path:
+    sys.path.append(proj_home)
+
+import httpx
+import uvicorn
+from werkzeug.serving import make_server
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Load test the holdings endpoint against a stub search API.')
+
+    parser.add_argument('-m',
+                        '--mode',
+                        dest='mode',
+                        action='store',
+                        choices=['wsgi', 'asgi'],
+                        default='asgi',
+                        help='Serve journalsservice with one sync WSGI worker or as ASGI')
+
+    parser.add_argument('-n',
+                        '--requests',
+                        dest='requests',
+                        action='store',
+                        type=int,
+                        default=200,
+                        help='Number of holdings requests')
+
+    parser.add_argument('-c',
+                        '--concurrency',
+                        dest='concurrency',
+                        action='store',
+                        type=int,
+                        default=50,
+                        help='Requests in flight at once')
+
+    parser.add_argument('-d',
+                        '--upstream-delay',
+                        dest='delay',
+                        action='store',
+                        type=float,
+                        default=0.2,
+                        help='Seconds the stub search API waits before answering')
+
+    parser.add_argument('-r',
+                        '--records',
+                        dest='records',
+                        action='store',
+                        type=int,
+                        default=150,
+                        help='Records per volume returned by the stub')
+
+    parser.add_argument('--upstream-port',
+                        dest='upstream_port',
+                        action='store',
+                        type=int,
+                        default=8901,
+                        help='Port of the stub search API')
+
+    parser.add_argument('--service-port',
+                        dest='service_port',
+                        action='store',
+                        type=int,
+                        default=8902,
+                        help='Port of the service under test')
+
+    return parser.parse_args()
+
+
+def stub_search_api(delay, records):
+    # ASGI app answering bibstem:X,volume:V searches with `records`
+    # synthetic records per volume, paged by cursorMark
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        params = dict((k, v[0]) for (k, v) in parse_qs(scope['query_string'].decode()).items())
+        volume = params.get('q', 'volume:1').split('volume:')[-1]
+        rows = int(params.get('rows', 2000))
+        cursor = params.get('cursorMark', '*')
+        start = 0 if cursor == '*' else int(cursor)
+        end = min(start + rows, records)
+        await asyncio.sleep(delay)
+        docs = [{'bibstem': ['Stub'], 'volume': volume, 'year': '2001',
+                 'page': [str(i + 1)], 'esources': ['PUB_PDF']} for i in range(start, end)]
+        body = json.dumps({'responseHeader': {'status': 0},
+                           'response': {'numFound': records, 'start': 0, 'docs': docs},
+                           'nextCursorMark': str(end)}).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+    return app
+
+
+def serve_in_thread(server):
+    thread = threading.Thread(target=server.run if hasattr(server, 'run') else server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def start_upstream(port, delay, records):
+    config = uvicorn.Config(stub_search_api(delay, records), host='127.0.0.1', port=port,
+                            log_level='warning', lifespan='off')
+    server = uvicorn.Server(config)
+    serve_in_thread(server)
+    return server
+
+
+def start_service(mode, port, upstream_port):
+    service_config = {'HOLDINGS_ADS_QUERY_URL': 'http://127.0.0.1:%s/search' % upstream_port,
+                      'HOLDINGS_CACHE_SIZE': 0,
+                      'JOURNALSDB_POOL_WARMUP': False,
+                      'SERVICE_TOKEN': 'Bearer loadtest'}
+    if mode == 'asgi':
+        from journalsservice.asgi import create_asgi_app
+        config = uvicorn.Config(create_asgi_app(**service_config), host='127.0.0.1', port=port,
+                                log_level='warning')
+        server = uvicorn.Server(config)
+    else:
+        from journalsservice.app import create_app
+        # a single-threaded server, like one synchronous worker process
+        server = make_server('127.0.0.1', port, create_app(**service_config), threaded=False)
+    serve_in_thread(server)
+    return server
+
+
+def wait_for(url, timeout=30):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except Exception:
+            time.sleep(0.1)
+    raise RuntimeError('%s did not come up' % url)
+
+
+async def run_load(base_url, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+
+        async def one(i):
+            async with semaphore:
+                t0 = time.perf_counter()
+                try:
+                    r = await client.get('/holdings/Stub/%s' % (i + 1))
+                    if r.status_code != 200:
+                        errors.append(r.status_code)
+                except Exception as err:
+                    errors.append(str(err))
+                latencies.append(time.perf_counter() - t0)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(count)])
+        elapsed = time.perf_counter() - start
+    return (elapsed, sorted(latencies), errors)
+
+
+def main():
+    args = get_arguments()
+    start_upstream(args.upstream_port, args.delay, args.records)
+    wait_for('http://127.0.0.1:%s/search' % args.upstream_port)
+    start_service(args.mode, args.service_port, args.upstream_port)
+    base_url = 'http://127.0.0.1:%s' % args.service_port
+    wait_for(base_url + '/holdings/Stub/0')
+
+    (elapsed, latencies, errors) = asyncio.run(run_load(base_url, args.requests, args.concurrency))
+    n = len(latencies)
+    print('mode %s: %s requests, concurrency %s, upstream delay %.3fs' % (args.mode, args.requests, args.concurrency, args.delay))
+    print('  throughput  %8.1f req/s' % (n / elapsed))
+    print('  latency p50 %8.3f s' % latencies[n // 2])
+    print('  latency p95 %8.3f s' % latencies[min(n - 1, int(n * 0.95))])
+    print('  latency max %8.3f s' % latencies[-1])
+    print('  errors      %8d' % len(errors))
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()